@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Local stand-in for the marathon event stream, used to exercise the toolset event subscriber (toolset/events.py)
+without a mesos/marathon cluster. It answers GET /v2/leader and GET /v2/events (server-sent events) and relays any
+json event POSTed to /events to every subscriber. Use --check to run the subscriber against it and verify task and
+deployment events are tracked (including after a malformed event, which must not kill the subscriber).
+
+For instance:
+
+ $ python bench/sse.py -p 8080 &
+ $ curl -XPOST localhost:8080/events -d '{"eventType": "deployment_success", "id": "foo"}'
+ $ PYTHONPATH=images/portal/resources/toolset python bench/sse.py --check
+"""
+
+import json
+import sys
+import time
+
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Queue, Empty
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+
+#: Subscribers currently connected (one queue each).
+subscribers = []
+
+#: Lock guarding the subscribers list.
+lock = Lock()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, js):
+
+        body = json.dumps(js)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        if self.path == '/v2/leader':
+            self._reply(200, {'leader': '%s:%d' % self.server.server_address})
+
+        elif self.path == '/v2/events':
+
+            #
+            # - stream whatever gets relayed to us until the client drops
+            # - send a comment line every second as a keep-alive
+            #
+            queue = Queue()
+            with lock:
+                subscribers.append(queue)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            try:
+                while True:
+                    try:
+                        js = queue.get(timeout=1.0)
+                        self.wfile.write('event: %s\ndata: %s\n\n' % (js.get('eventType', 'unknown'), json.dumps(js)))
+                    except Empty:
+                        self.wfile.write(':\n')
+                    self.wfile.flush()
+
+            except IOError:
+                pass
+
+            finally:
+                with lock:
+                    subscribers.remove(queue)
+
+        else:
+            self._reply(404, {})
+
+    def do_POST(self):
+
+        if self.path != '/events':
+            self._reply(404, {})
+            return
+
+        js = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        self._reply(200, {'subscribers': _relay(js)})
+
+
+def _relay(js):
+
+    with lock:
+        for queue in subscribers:
+            queue.put(js)
+
+        return len(subscribers)
+
+
+def _check(server):
+
+    from toolset.events import Events
+
+    #
+    # - subscribe and wait for the stream to be up
+    # - a malformed task event should be skipped, the subscriber re-connecting and tracking what follows
+    #
+    feed = Events('%s:%d' % server.server_address)
+    assert feed.connected.wait(5.0), 'unable to subscribe'
+    _relay({'eventType': 'status_update_event', 'appId': '/foo'})
+    ts = time.time()
+    while feed.connected.is_set() and time.time() - ts < 5.0:
+        time.sleep(0.05)
+
+    assert feed.connected.wait(5.0), 'subscriber did not re-connect'
+    _relay({'eventType': 'status_update_event', 'appId': '/foo', 'taskId': 't1', 'taskStatus': 'TASK_RUNNING'})
+    _relay({'eventType': 'deployment_success', 'id': 'd1'})
+    assert feed.wait(lambda: feed.deployed('d1') is not None, 5.0), 'deployment event not tracked'
+    assert feed.running('foo') == 1, 'task event not tracked'
+    sys.stderr.write('ok\n')
+
+
+def go():
+
+    parser = ArgumentParser(description='marathon event stream stand-in')
+    parser.add_argument('-p', action='store', dest='port', type=int, default=0, help='TCP port (random by default)')
+    parser.add_argument('--check', action='store_true', dest='check', help='runs the toolset subscriber against it')
+    args = parser.parse_args()
+
+    server = _Server(('127.0.0.1', args.port), _Handler)
+    if not args.check:
+        sys.stderr.write('listening on %s:%d\n' % server.server_address)
+        server.serve_forever()
+
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        _check(server)
+
+    except AssertionError as failure:
+        sys.stderr.write('failed -> %s\n' % failure)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    go()
@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Startup benchmark for the hot path (e.g the toolset sub-process spawned by the portal and the ocho CLI). Each probe
+is run in a fresh interpreter N times and we keep the min/median/max wall-clock time in milliseconds. The following
+probes are available:
+
+ - import.<module>: time to import ochopod, kazoo, pykka, requests and yaml
+ - toolset.help: time to run "toolset help" (e.g the manifest path, no tool is imported)
+ - toolset.<cmd>: time to run "toolset <cmd>" end to end (requires $OCHOPOD_ZK)
+ - toolset.zk: time from spawning "toolset <cmd>" to its first zookeeper query answered (requires $OCHOPOD_ZK)
+ - ocho.<cmd>: time to run "ocho cli <proxy> <cmd>" end to end (requires --proxy or $OCHOPOD_PROXY)
+ - ocho.zk: time from spawning "ocho cli <proxy> <cmd>" to the first zookeeper query answered by the portal
+
+The zookeeper probes run the tool with --profile and subtract whatever it reports as spent after its first query
+from the wall-clock time.
+
+The results are dumped as JSON (one object keyed by probe). Use --baseline to compare against a previous run, in
+which case any probe slower by more than --tolerance percent is flagged and the script exits with 1.
+
+For instance:
+
+ $ python bench/startup.py -n 10 -o before.json
+ $ python bench/startup.py -n 10 --baseline before.json
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE
+
+#: Modules whose import time we track.
+MODULES = ['ochopod', 'kazoo', 'kazoo.client', 'pykka', 'requests', 'yaml']
+
+#: Prefix of the line reported by the toolset when --profile is used.
+PROFILE = 'profile -> '
+
+
+def _spawn(cmdline, env=None):
+
+    #
+    # - run the snippet and return its stdout once done
+    # - a non-zero exit code will fail the probe
+    #
+    pid = Popen(cmdline, shell=isinstance(cmdline, str), stdout=PIPE, stderr=PIPE, env=env)
+    out, _ = pid.communicate()
+    assert pid.returncode == 0, '"%s" failed (exit code %d)' % (cmdline, pid.returncode)
+    return out.decode('utf-8')
+
+
+def _wall(cmdline, env=None):
+
+    ts = time.time()
+    _spawn(cmdline, env)
+    return 1000.0 * (time.time() - ts)
+
+
+def _import(module):
+
+    snippet = 'import time; ts = time.time(); import %s; print(time.time() - ts)' % module
+    return 1000.0 * float(_spawn([sys.executable, '-c', snippet]))
+
+
+def _zk(cmdline, env=None):
+
+    #
+    # - run the tool with --profile and look for what it reports
+    # - whatever it spent after its first zookeeper query is removed from the wall-clock time
+    #
+    ts = time.time()
+    out = _spawn('%s --profile' % cmdline, env)
+    lapse = 1000.0 * (time.time() - ts)
+    for line in reversed(out.strip().split('\n')):
+        if PROFILE in line:
+            js = json.loads(line.split(PROFILE, 1)[1])
+            assert js['zk'] is not None, 'no zookeeper query performed'
+            return lapse - (js['total'] - js['zk'])
+
+    assert 0, 'no profiling information reported'
+
+
+def _sample(func, n):
+
+    #
+    # - run the probe n times and keep the min/median/max
+    #
+    lapses = sorted(func() for _ in range(n))
+    return \
+        {
+            'min': lapses[0],
+            'median': lapses[len(lapses) // 2],
+            'max': lapses[-1],
+            'samples': n
+        }
+
+
+def go():
+
+    parser = ArgumentParser(description='toolset & ocho startup benchmark')
+    parser.add_argument('-n', action='store', dest='samples', type=int, default=5, help='runs per probe')
+    parser.add_argument('-o', action='store', dest='output', type=str, help='output file (defaults to stdout)')
+    parser.add_argument('-c', action='store', dest='command', type=str, default='ls', help='tool to benchmark')
+    parser.add_argument('--baseline', action='store', dest='baseline', type=str, help='previous results to compare with')
+    parser.add_argument('--proxy', action='store', dest='proxy', type=str, help='proxy to run the ocho CLI against')
+    parser.add_argument('--tolerance', action='store', dest='tolerance', type=float, default=20.0, help='regression threshold in %%')
+    args = parser.parse_args()
+
+    probes = [('import.%s' % module, lambda module=module: _import(module)) for module in MODULES]
+    probes += [('toolset.help', lambda: _wall('toolset help'))]
+    if 'OCHOPOD_ZK' in os.environ:
+        probes += [('toolset.%s' % args.command, lambda: _wall('toolset %s' % args.command))]
+        probes += [('toolset.zk', lambda: _zk('toolset %s' % args.command))]
+
+    #
+    # - the proxy is passed explicitly, make sure the CLI does not pick $OCHOPOD_PROXY up on top of it (it would
+    #   otherwise treat the proxy as part of the command)
+    #
+    proxy = args.proxy if args.proxy else os.environ.get('OCHOPOD_PROXY')
+    if proxy:
+        env = {key: value for key, value in os.environ.items() if key != 'OCHOPOD_PROXY'}
+        line = 'ocho cli %s %s' % (proxy, args.command)
+        probes += [('ocho.%s' % args.command, lambda: _wall(line, env))]
+        probes += [('ocho.zk', lambda: _zk(line, env))]
+
+    results = {}
+    for tag, func in probes:
+        try:
+            results[tag] = _sample(func, max(1, args.samples))
+            sys.stderr.write('%s -> %.1f ms (median)\n' % (tag, results[tag]['median']))
+
+        except (AssertionError, ValueError) as failure:
+            sys.stderr.write('%s -> skipped (%s)\n' % (tag, failure))
+
+    js = \
+        {
+            'ts': time.time(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'results': results
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(js, indent=4, sort_keys=True))
+    else:
+        print(json.dumps(js, indent=4, sort_keys=True))
+
+    regressions = 0
+    if args.baseline:
+
+        #
+        # - compare the medians against the baseline
+        # - flag anything slower than the tolerance
+        #
+        with open(args.baseline, 'r') as f:
+            previous = json.loads(f.read())['results']
+
+        for tag in sorted(set(previous.keys()) & set(results.keys())):
+            before = previous[tag]['median']
+            after = results[tag]['median']
+            pct = 100.0 * (after - before) / before if before else 0.0
+            slower = pct > args.tolerance
+            regressions += slower
+            sys.stderr.write('%s %s : %.1f ms -> %.1f ms (%+.1f%%)\n' % ('!' if slower else ' ', tag, before, after, pct))
+
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    go()
@@ -14,16 +14,124 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
 import os
+import requests
 import time
 
 from ochopod.bindings.generic.marathon import Pod
+from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import shell
 from ochopod.models.piped import Actor as Piped
+from os.path import dirname
+from requests.exceptions import RequestException
+from tempfile import mkstemp
+from threading import Thread
 
 logger = logging.getLogger('ochopod')
 
+#: File the ranked marathon masters are published to (read by the toolset via $MARATHON_RANKING).
+RANKING = '/opt/portal/masters.json'
+
+#: Time in seconds between two discovery passes.
+REFRESH = 30.0
+
+
+def _resolve():
+
+    #
+    # - dig master.mesos
+    # - this should give us a list of internal master IPs
+    # - please note this will only work if mesos-dns has been setup (and is running)
+    #
+    _, lines = shell('dig master.mesos +short')
+    if lines:
+        return ['%s:8080' % line for line in lines]
+
+    #
+    # - no mesos-dns running ?
+    # - if so $MARATHON_MASTER must be defined (legacy behavior)
+    #
+    return os.environ['MARATHON_MASTER'].split(',') if 'MARATHON_MASTER' in os.environ else []
+
+
+def _probe(master):
+
+    #
+    # - GET /v2/leader on the master
+    # - return the round-trip time in ms and who it thinks the leader is (or None if unreachable)
+    #
+    try:
+        ts = time.time()
+        reply = requests.get('http://%s/v2/leader' % master, timeout=3.0)
+        if reply.status_code == 200:
+            return 1000 * (time.time() - ts), reply.json()['leader']
+
+    except (RequestException, ValueError, KeyError):
+        pass
+
+    return None, None
+
+
+class Discovery(Thread):
+    """
+    Background thread re-resolving the marathon masters, probing their latency & leadership and publishing them
+    ranked (leader first, then by latency, unreachable masters last) to the RANKING file. The toolset reads this file
+    to route its calls straight to the leader without any redirect hop.
+    """
+
+    def __init__(self, masters):
+        super(Discovery, self).__init__()
+
+        self.daemon = True
+        self.masters = masters
+
+    def run(self):
+
+        while True:
+            try:
+
+                masters = _resolve() or self.masters
+                probes = {master: _probe(master) for master in masters}
+                leaders = set([leader for _, leader in probes.values() if leader])
+                alive = [master for master in masters if probes[master][0] is not None]
+                dead = [master for master in masters if probes[master][0] is None]
+                ranked = sorted(alive, key=lambda master: (master not in leaders, probes[master][0])) + dead
+
+                #
+                # - the leader may be reported under a different address (e.g a hostname)
+                # - if so put it upfront
+                #
+                leader = leaders.pop() if len(leaders) == 1 else None
+                if leader and leader not in ranked:
+                    ranked = [leader] + ranked
+
+                js = \
+                    {
+                        'ts': time.time(),
+                        'leader': leader,
+                        'masters': ranked,
+                        'latency': {master: probes[master][0] for master in alive}
+                    }
+
+                #
+                # - write to a temporary file first and rename (toolset processes may be reading it)
+                #
+                fd, tmp = mkstemp(dir=dirname(RANKING))
+                with os.fdopen(fd, 'w') as f:
+                    f.write(json.dumps(js))
+
+                os.rename(tmp, RANKING)
+                self.masters = masters
+                logger.debug('marathon masters -> %s (leader %s)' % (', '.join(ranked), leader))
+
+            except Exception as failure:
+
+                logger.warning('marathon discovery failed -> %s' % diagnostic(failure))
+
+            time.sleep(REFRESH)
+
 
 if __name__ == '__main__':
 
@@ -39,6 +147,8 @@ if __name__ == '__main__':
         
         check_every = 60.0
 
+        discovery = None
+
         pid = None
 
         since = 0.0
@@ -65,22 +175,19 @@ if __name__ == '__main__':
         def configure(self, _):
 
             #
-            # - dig master.mesos
-            # - this should give us a list of internal master IPs
-            # - please note this will only work if mesos-dns has been setup (and is running)
+            # - resolve the masters once (via mesos-dns or $MARATHON_MASTER)
+            # - this list is passed down as is and used as a fallback by the toolset
             #
-            _, lines = shell('dig master.mesos +short')
-            if lines:
-                logger.debug('retrieved %d ips via dig' % len(lines))
-                masters = ','.join(['%s:8080' % line for line in lines])
+            masters = _resolve()
+            assert masters, 'failed to look mesos-dns up and no $MARATHON_MASTER defined'
+            logger.debug('retrieved %d marathon masters' % len(masters))
 
             #
-            # - no mesos-dns running ?
-            # - if so $MARATHON_MASTER must be defined (legacy behavior)
+            # - start re-resolving & ranking the masters in the background (once)
             #
-            else:
-                assert 'MARATHON_MASTER' in os.environ, 'failed to look mesos-dns up and no $MARATHON_MASTER defined'
-                masters = os.environ['MARATHON_MASTER']
+            if self.discovery is None:
+                self.discovery = Discovery(masters)
+                self.discovery.start()
 
             #
             # - run the webserver
@@ -89,7 +196,8 @@ if __name__ == '__main__':
             return 'python portal.py', \
                    {
                        'token': token,
-                       'MARATHON_MASTER': masters
+                       'MARATHON_MASTER': ','.join(masters),
+                       'MARATHON_RANKING': RANKING
                    }
 
     Pod().boot(Strategy)
\ No newline at end of file
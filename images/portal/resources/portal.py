@@ -25,10 +25,11 @@ import tempfile
 import time
 import shutil
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from ochopod.core.fsm import diagnostic
 from os.path import join
 from subprocess import Popen, PIPE
+from threading import Thread
 
 
 logger = logging.getLogger('ochopod')
@@ -43,17 +44,21 @@ if __name__ == '__main__':
         # - parse our ochopod hints
         # - enable CLI logging
         # - pass down the ZK ensemble coordinate as $OCHOPOD_ZK (all tools use that to perform their queries)
+        # - if $OCHOPOD_SITES is defined (e.g west=10.1.0.1:2181;north=10.2.0.1:2181) federate those remote
+        #   ensembles as well, our own being named after $OCHOPOD_SITE (defaults to local)
         #
         env = os.environ
         hints = json.loads(env['ochopod'])
         ochopod.enable_cli_log(debug=hints['debug'] == 'true')
         env['OCHOPOD_ZK'] = hints['zk']
+        if 'OCHOPOD_SITES' in env and env['OCHOPOD_SITES']:
+            site = env['OCHOPOD_SITE'] if 'OCHOPOD_SITE' in env else 'local'
+            env['OCHOPOD_ZK'] = '%s=%s;%s' % (site, hints['zk'], env['OCHOPOD_SITES'])
 
         @web.route('/shell', methods=['POST'])
         def _from_curl():
 
-            out = []
-            ok = False
+            out = None
             ts = time.time()
             tmp = tempfile.mkdtemp()
             try:
@@ -86,50 +91,96 @@ if __name__ == '__main__':
                 # - open it
                 #
                 logger.debug('http -> shell request "%s"' % line)
-                pid = Popen('toolset %s' % line, shell=True, stdout=PIPE, stderr=None, env=env, cwd=tmp)
-
-                #
-                # - pipe the process stdout
-                # - return as json ('out' contains the verbatim dump from the sub-process stdout)
-                #
-                while 1:
-                    code = pid.poll()
-                    line = pid.stdout.readline()
-                    if not line and code is not None:
-                        break
-                    elif line:
-                        logger.debug(line.rstrip('\n'))
-                        out += [line.rstrip('\n')]
-
-                ok = pid.returncode == 0
+                pid = Popen('exec toolset %s' % line, shell=True, stdout=PIPE, stderr=None, env=env, cwd=tmp)
 
             except AssertionError as failure:
 
-                out = ['failure -> %s' % failure]
+                out = 'failure -> %s' % failure
 
             except Exception as failure:
 
-                out = ['unexpected failure -> %s' % diagnostic(failure)]
+                out = 'unexpected failure -> %s' % diagnostic(failure)
 
-            finally:
+            if out is not None:
 
                 #
-                # - make sure to cleanup our temporary directory
+                # - we failed before even spawning the tool, reply right away
                 #
                 shutil.rmtree(tmp)
+                js = \
+                    {
+                        'ok': False,
+                        'ms': 1000 * (time.time() - ts),
+                        'out': out
+                    }
+
+                return json.dumps(js), 200, \
+                    {
+                        'Content-Type': 'application/json; charset=utf-8'
+                    }
+
+            def _stream():
+
+                #
+                # - pipe the process stdout and stream it back as we go (nothing is buffered, long running tools such
+                #   as log -f do not grow our memory)
+                # - the reply is the same json document as before ('out' contains the verbatim dump from the
+                #   sub-process stdout), just written incrementally
+                #
+                ok = False
+                yield '{"out": "'
+                try:
+                    sep = ''
+                    while 1:
+                        code = pid.poll()
+                        line = pid.stdout.readline()
+                        if not line and code is not None:
+                            break
+                        elif line:
+                            logger.debug(line.rstrip('\n'))
+                            yield json.dumps(sep + line.rstrip('\n'))[1:-1]
+                            sep = '\n'
+
+                    ok = pid.returncode == 0
 
-            ms = 1000 * (time.time() - ts)
-            js = \
-                {
-                    'ok': ok,
-                    'ms': ms,
-                    'out': '\n'.join(out)
-                }
-
-            return json.dumps(js), 200, \
-                {
-                    'Content-Type': 'application/json; charset=utf-8'
-                }
+                except Exception as failure:
+
+                    yield json.dumps('\nunexpected failure -> %s' % diagnostic(failure))[1:-1]
+
+                finally:
+
+                    #
+                    # - if the client went away (or anything failed) make sure the sub-process does not linger
+                    # - cleanup our temporary directory
+                    #
+                    if pid.poll() is None:
+                        logger.debug('http -> shell request aborted, killing the sub-process')
+                        pid.kill()
+
+                    shutil.rmtree(tmp)
+
+                ms = 1000 * (time.time() - ts)
+                yield '", "ok": %s, "ms": %s}' % (json.dumps(ok), json.dumps(ms))
+
+            return Response(_stream(), 200, {'Content-Type': 'application/json; charset=utf-8'})
+
+        #
+        # - if $AUTOSCALE_RULES is set run the autoscaler in the background
+        # - re-spawn it if it ever exits (e.g the rules file was invalid or the portal lost zookeeper)
+        #
+        if 'AUTOSCALE_RULES' in env and env['AUTOSCALE_RULES']:
+
+            def _autoscale():
+                while 1:
+                    logger.debug('spawning the autoscaler (%s)' % env['AUTOSCALE_RULES'])
+                    pid = Popen('toolset autoscale %s' % env['AUTOSCALE_RULES'], shell=True, env=env)
+                    code = pid.wait()
+                    logger.warning('autoscaler exited (code %d), re-spawning in 30 seconds' % code)
+                    time.sleep(30.0)
+
+            thread = Thread(target=_autoscale)
+            thread.daemon = True
+            thread.start()
 
         #
         # - run our flask endpoint on TCP 9000
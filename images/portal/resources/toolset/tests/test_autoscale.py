@@ -0,0 +1,84 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import datetime
+import unittest
+
+from toolset.commands.autoscale import desired
+
+#: Some monday, 10:00 local time.
+MONDAY = datetime.datetime(2015, 6, 1, 10, 0)
+
+
+def _rule(**kwargs):
+
+    rule = \
+        {
+            'min': 1,
+            'max': 10,
+            'target': 50.0,
+            'tolerance': 0.1,
+            'schedule': []
+        }
+
+    rule.update(kwargs)
+    return rule
+
+
+class TestDesired(unittest.TestCase):
+
+    def test_target_tracking(self):
+
+        self.assertEqual(desired(_rule(), 4, [100.0] * 4, MONDAY), 8)
+        self.assertEqual(desired(_rule(), 4, [25.0] * 4, MONDAY), 2)
+
+    def test_rounds_up(self):
+
+        self.assertEqual(desired(_rule(), 3, [60.0, 60.0, 60.0], MONDAY), 4)
+
+    def test_hysteresis(self):
+
+        #
+        # - within 10% of the target nothing changes
+        #
+        self.assertEqual(desired(_rule(), 4, [54.0] * 4, MONDAY), 4)
+        self.assertEqual(desired(_rule(), 4, [46.0] * 4, MONDAY), 4)
+
+    def test_no_samples(self):
+
+        self.assertEqual(desired(_rule(), 4, [], MONDAY), 4)
+
+    def test_capacities(self):
+
+        self.assertEqual(desired(_rule(max=6), 4, [100.0] * 4, MONDAY), 6)
+        self.assertEqual(desired(_rule(min=3), 4, [1.0] * 4, MONDAY), 3)
+
+    def test_schedule(self):
+
+        schedule = [{'from': '09:00', 'to': '12:00', 'days': [0], 'min': 5}]
+        self.assertEqual(desired(_rule(schedule=schedule), 2, [10.0] * 2, MONDAY), 5)
+        self.assertEqual(desired(_rule(schedule=schedule), 2, [10.0] * 2, MONDAY + datetime.timedelta(days=1)), 1)
+        self.assertEqual(desired(_rule(schedule=schedule), 2, [10.0] * 2, MONDAY + datetime.timedelta(hours=3)), 1)
+
+        #
+        # - the scheduled minimum wins over the max capacity
+        #
+        schedule = [{'from': '00:00', 'to': '23:59', 'min': 12}]
+        self.assertEqual(desired(_rule(schedule=schedule), 2, [10.0] * 2, MONDAY), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+
+from toolset import io
+
+
+class _Clock():
+    """
+    Fake clock only moving forward when slept on.
+    """
+
+    def __init__(self):
+
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, lapse):
+        self.now += lapse
+
+
+class _Jitter():
+
+    @staticmethod
+    def uniform(lo, hi):
+        return 1.0
+
+
+class TestDrain(unittest.TestCase):
+
+    def setUp(self):
+
+        #
+        # - swap the zookeeper & HTTP plumbing for a fake cluster (pod key -> list of codes to reply with)
+        # - each call to fire() is recorded along with the clock
+        #
+        self.clock = _Clock()
+        self.calls = []
+        self.codes = {}
+        self.saved = {name: getattr(io, name) for name in ['fire', 'lookup', 'random', 'run', 'time']}
+
+        def _lookup(zk, cluster, subset=None, kids=None):
+            return {key: {'seq': seq} for key, (seq, _) in self.codes.items() if subset is None or seq in subset}
+
+        def _fire(zk, cluster, command, subset=None, timeout=5.0, **kwargs):
+            out = {}
+            for key, (seq, codes) in self.codes.items():
+                if subset is None or seq in subset:
+                    out[key] = (seq, {}, codes.pop(0) if len(codes) > 1 else codes[0])
+            self.calls += [(self.clock.now, sorted(seq for seq, _, _ in out.values()))]
+            return out
+
+        io.fire = _fire
+        io.lookup = _lookup
+        io.random = _Jitter
+        io.run = lambda proxy, func, timeout=None: func(None)
+        io.time = self.clock
+
+    def tearDown(self):
+
+        for name, value in self.saved.items():
+            setattr(io, name, value)
+
+    def test_all_acknowledged(self):
+
+        self.codes = {'a #1': (1, [410]), 'a #2': (2, [410])}
+        done, pending = io.drain(None, 'a', [1, 2])
+        self.assertEqual(done, [1, 2])
+        self.assertEqual(pending, [])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_only_pending_pods_retried(self):
+
+        self.codes = {'a #1': (1, [410]), 'a #2': (2, [200, 200, 410])}
+        done, pending = io.drain(None, 'a', [1, 2])
+        self.assertEqual(done, [1, 2])
+        self.assertEqual([seqs for _, seqs in self.calls], [[1, 2], [2], [2]])
+
+    def test_exponential_backoff(self):
+
+        self.codes = {'a #1': (1, [200, 200, 200, 200, 410])}
+        io.drain(None, 'a', [1])
+        ts = [now for now, _ in self.calls]
+        lapses = [b - a for a, b in zip(ts, ts[1:])]
+        self.assertEqual(lapses, [io.BACKOFF * (2 ** n) for n in range(4)])
+
+    def test_backoff_ceiling(self):
+
+        self.codes = {'a #1': (1, [200])}
+        io.drain(None, 'a', [1], timeout=120.0)
+        ts = [now for now, _ in self.calls]
+        self.assertTrue(max(b - a for a, b in zip(ts, ts[1:])) <= io.CEILING)
+
+    def test_timeout(self):
+
+        self.codes = {'a #1': (1, [410]), 'a #2': (2, [200])}
+        done, pending = io.drain(None, 'a', [1, 2], timeout=10.0)
+        self.assertEqual(done, [1])
+        self.assertEqual(pending, [2])
+        self.assertTrue(self.clock.now - 1000.0 <= 10.0)
+
+    def test_vanished_pods(self):
+
+        #
+        # - the pod never acknowledges but is gone from zookeeper on the second pass
+        #
+        self.codes = {'a #1': (1, [200])}
+        self.calls = []
+
+        def _gone(lapse):
+            self.clock.now += lapse
+            self.codes = {}
+
+        self.clock.sleep = _gone
+        done, pending = io.drain(None, 'a', [1])
+        self.assertEqual(done, [1])
+        self.assertEqual(pending, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,117 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+import unittest
+
+from threading import Lock
+from toolset.tool import Automation, execute
+
+
+class _Sleeper(Automation):
+    """
+    Automation sleeping for a while (checkpointing every 50 ms) and tracking how many of its peers run at once.
+    """
+
+    lock = Lock()
+
+    running = 0
+
+    peak = 0
+
+    def __init__(self, key, lapse):
+        super(_Sleeper, self).__init__(key)
+
+        self.lapse = lapse
+
+    def workflow(self):
+
+        with self.lock:
+            _Sleeper.running += 1
+            _Sleeper.peak = max(_Sleeper.peak, _Sleeper.running)
+
+        try:
+            ts = time.time()
+            while time.time() - ts < self.lapse:
+                self.checkpoint()
+                time.sleep(0.05)
+
+            self.out['ok'] = True
+
+        except AssertionError:
+            pass
+
+        finally:
+            with self.lock:
+                _Sleeper.running -= 1
+
+
+class TestExecute(unittest.TestCase):
+
+    def setUp(self):
+
+        _Sleeper.running = 0
+        _Sleeper.peak = 0
+
+    def test_all_complete(self):
+
+        outcome = execute([_Sleeper(n, 0.1) for n in range(4)])
+        self.assertEqual(sorted(outcome.keys()), range(4))
+        self.assertTrue(all(js['ok'] for js in outcome.values()))
+
+    def test_limit(self):
+
+        outcome = execute([_Sleeper(n, 0.2) for n in range(5)], limit=2)
+        self.assertTrue(all(js['ok'] for js in outcome.values()))
+        self.assertEqual(_Sleeper.peak, 2)
+
+    def test_no_deadline(self):
+
+        #
+        # - without a deadline execute() must keep on waiting past its internal polling slices
+        #
+        outcome = execute([_Sleeper('slow', 2.5)])
+        self.assertTrue(outcome['slow']['ok'])
+        self.assertFalse('cancelled' in outcome['slow'])
+
+    def test_deadline(self):
+
+        ts = time.time()
+        automations = [_Sleeper('fast', 0.1), _Sleeper('slow', 30.0), _Sleeper('queued', 0.1)]
+        outcome = execute(automations, limit=1, deadline=1)
+        self.assertTrue(time.time() - ts < 5.0)
+        self.assertTrue(automations[1].cancelled.is_set())
+        self.assertFalse(automations[2].is_alive())
+        automations[1].join(5.0)
+        self.assertTrue(outcome['fast']['ok'])
+        for key in ['slow', 'queued']:
+            self.assertFalse(outcome[key]['ok'])
+            self.assertTrue(outcome[key]['cancelled'])
+
+    def test_progress(self):
+
+        calls = []
+        execute([_Sleeper(n, 0.1) for n in range(3)], progress=lambda key, out, completed, total: calls.append((completed, total)))
+        self.assertEqual(sorted(calls), [(1, 3), (2, 3), (3, 3)])
+
+    def test_missing_workflow(self):
+
+        automation = Automation('bare')
+        self.assertRaises(AssertionError, automation.workflow)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
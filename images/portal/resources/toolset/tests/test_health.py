@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+
+from toolset.health import predicate
+
+
+class TestPredicate(unittest.TestCase):
+
+    def test_alternatives(self):
+
+        check = predicate(['state=leader|follower'])
+        self.assertTrue(check({'state': 'leader'}))
+        self.assertTrue(check({'state': 'follower'}))
+        self.assertFalse(check({'state': 'observer'}))
+
+    def test_negation(self):
+
+        check = predicate(['state!=dead|stopped'])
+        self.assertTrue(check({'state': 'running'}))
+        self.assertFalse(check({'state': 'dead'}))
+
+    def test_regex(self):
+
+        check = predicate(['status~^ok'])
+        self.assertTrue(check({'status': 'ok (3 peers)'}))
+        self.assertFalse(check({'status': 'not ok'}))
+
+    def test_numerical(self):
+
+        self.assertTrue(predicate(['metrics.errors<1'])({'metrics': {'errors': 0}}))
+        self.assertFalse(predicate(['metrics.errors<1'])({'metrics': {'errors': 1}}))
+        self.assertTrue(predicate(['metrics.errors<=1'])({'metrics': {'errors': 1}}))
+        self.assertTrue(predicate(['metrics.rate>=2.5'])({'metrics': {'rate': '2.5'}}))
+        self.assertFalse(predicate(['metrics.rate>2.5'])({'metrics': {'rate': 'n/a'}}))
+
+    def test_missing_key(self):
+
+        check = predicate(['metrics.errors<1'])
+        self.assertFalse(check({}))
+        self.assertFalse(check({'metrics': 0}))
+
+    def test_all_expressions_must_hold(self):
+
+        check = predicate(['state=leader', 'metrics.errors<1'])
+        self.assertTrue(check({'state': 'leader', 'metrics': {'errors': 0}}))
+        self.assertFalse(check({'state': 'leader', 'metrics': {'errors': 3}}))
+
+    def test_leftmost_operator(self):
+
+        #
+        # - the regex contains < and = but ~ comes first
+        #
+        check = predicate(['status~a<b=c'])
+        self.assertTrue(check({'status': 'xa<b=cx'}))
+
+        #
+        # - <= is picked over < and = when found at the same position
+        #
+        check = predicate(['count<=2'])
+        self.assertTrue(check({'count': 2}))
+
+    def test_invalid(self):
+
+        self.assertRaises(AssertionError, predicate, ['state'])
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,70 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import unittest
+
+from toolset.commands.log import ANCHOR, _cursor, _fresh
+
+
+class TestCursor(unittest.TestCase):
+
+    def test_growing_log(self):
+
+        log = ['line %d' % n for n in range(40)]
+        cursor = _cursor(log)
+        self.assertEqual(_fresh(log + ['a', 'b'], cursor), ['a', 'b'])
+        self.assertEqual(_fresh(log, cursor), [])
+
+    def test_repeated_lines(self):
+
+        #
+        # - identical lines appended to a log ending with the same line are still new
+        #
+        log = ['ping'] * 5
+        cursor = _cursor(log)
+        self.assertEqual(_fresh(log + ['ping', 'ping'], cursor), ['ping', 'ping'])
+
+    def test_capped_log(self):
+
+        #
+        # - the pod log is capped : the head moved but our tail is still in there
+        #
+        log = ['line %d' % n for n in range(100)]
+        cursor = _cursor(log)
+        capped = log[20:] + ['line 100', 'line 101']
+        self.assertEqual(_fresh(capped, cursor), ['line 100', 'line 101'])
+
+    def test_rotated_log(self):
+
+        #
+        # - nothing we saw is left, everything is new
+        #
+        log = ['line %d' % n for n in range(100)]
+        cursor = _cursor(log)
+        rotated = ['fresh %d' % n for n in range(10)]
+        self.assertEqual(_fresh(rotated, cursor), rotated)
+
+    def test_anchor(self):
+
+        log = ['line %d' % n for n in range(3 * ANCHOR)]
+        seen, head, tail = _cursor(log)
+        self.assertEqual(seen, len(log))
+        self.assertEqual(head, log[:ANCHOR])
+        self.assertEqual(tail, log[-ANCHOR:])
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
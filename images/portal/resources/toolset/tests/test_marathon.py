@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+import unittest
+
+from requests.exceptions import ConnectionError, ReadTimeout
+from threading import Event, Thread
+from toolset import marathon
+from toolset.marathon import Marathon
+
+
+class _Reply():
+
+    def __init__(self, code, text=''):
+
+        self.status_code = code
+        self.text = text
+
+
+class _Session():
+    """
+    Fake requests session replaying a list of replies (or exceptions) and recording each request.
+    """
+
+    def __init__(self, replies):
+
+        self.replies = replies
+        self.requests = []
+
+    def request(self, verb, url, data=None, timeout=None):
+
+        self.requests += [(verb, url)]
+        out = self.replies.pop(0)
+        if isinstance(out, Exception):
+            raise out
+
+        return out
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+
+        self.backoff = marathon.BACKOFF
+        marathon.BACKOFF = 0.0
+
+    def tearDown(self):
+
+        marathon.BACKOFF = self.backoff
+
+    def _client(self, replies):
+
+        client = Marathon(['m1:8080', 'm2:8080'], leader='m1:8080')
+        client.session = _Session(replies)
+        return client
+
+    def test_get_fails_over_on_5xx(self):
+
+        client = self._client([_Reply(500), _Reply(200)])
+        self.assertEqual(client.get('/v2/apps').status_code, 200)
+        self.assertEqual([url for _, url in client.session.requests], ['http://m1:8080/v2/apps', 'http://m2:8080/v2/apps'])
+
+    def test_get_retries_connection_errors(self):
+
+        client = self._client([ConnectionError(), ReadTimeout(), _Reply(200)])
+        self.assertEqual(client.get('/v2/apps').status_code, 200)
+        self.assertEqual(len(client.session.requests), 3)
+
+    def test_get_gives_up(self):
+
+        client = self._client([ConnectionError()] * marathon.ATTEMPTS)
+        self.assertRaises(ConnectionError, client.get, '/v2/apps')
+        self.assertEqual(len(client.session.requests), marathon.ATTEMPTS)
+
+    def test_put_retries_on_5xx(self):
+
+        client = self._client([_Reply(502), _Reply(200)])
+        self.assertEqual(client.put('/v2/apps/foo', {}).status_code, 200)
+
+    def test_deployment_conflict(self):
+
+        client = self._client([_Reply(409, 'locked by one or more deployments'), _Reply(201)])
+        self.assertEqual(client.post('/v2/apps', {}).status_code, 201)
+
+    def test_other_conflicts_not_retried(self):
+
+        client = self._client([_Reply(409, 'already exists')])
+        self.assertEqual(client.post('/v2/apps', {}).status_code, 409)
+
+    def test_unsafe_not_replayed_on_5xx(self):
+
+        for verb in ['post', 'delete']:
+            client = self._client([_Reply(500), _Reply(200)])
+            self.assertEqual(getattr(client, verb)('/v2/apps/foo').status_code, 500)
+            self.assertEqual(len(client.session.requests), 1)
+
+    def test_unsafe_replayed_on_503(self):
+
+        client = self._client([_Reply(503), _Reply(201)])
+        self.assertEqual(client.post('/v2/apps', {}).status_code, 201)
+
+    def test_unsafe_replayed_when_never_sent(self):
+
+        client = self._client([ConnectionError(), _Reply(201)])
+        self.assertEqual(client.post('/v2/apps', {}).status_code, 201)
+
+    def test_unsafe_not_replayed_on_timeout(self):
+
+        client = self._client([ReadTimeout(), _Reply(201)])
+        self.assertRaises(ReadTimeout, client.post, '/v2/apps', {})
+        self.assertEqual(len(client.session.requests), 1)
+
+
+class TestCoalescing(unittest.TestCase):
+
+    def test_identical_gets(self):
+
+        #
+        # - the first GET blocks in the session until the second one is waiting on it
+        #
+        entered = Event()
+        release = Event()
+
+        class _Blocking(_Session):
+
+            def request(self, verb, url, data=None, timeout=None):
+                entered.set()
+                release.wait()
+                return _Session.request(self, verb, url, data, timeout)
+
+        client = Marathon(['m1:8080'], leader='m1:8080')
+        client.session = _Blocking([_Reply(200)])
+        replies = []
+        threads = [Thread(target=lambda: replies.append(client.get('/v2/apps'))) for _ in range(2)]
+        threads[0].start()
+        entered.wait(5.0)
+        threads[1].start()
+        time.sleep(0.25)
+        release.set()
+        for thread in threads:
+            thread.join(5.0)
+
+        self.assertEqual(len(client.session.requests), 1)
+        self.assertEqual(len(replies), 2)
+        self.assertTrue(replies[0] is replies[1])
+        self.assertEqual(client.inflight, {})
+
+    def test_shared_failure(self):
+
+        client = Marathon(['m1:8080'], leader='m1:8080')
+        client.inflight['/v2/apps'] = pending = {'done': Event(), 'error': ConnectionError()}
+        pending['done'].set()
+        self.assertRaises(ConnectionError, client.get, '/v2/apps')
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
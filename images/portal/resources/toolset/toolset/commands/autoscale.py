@@ -0,0 +1,258 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import datetime
+import logging
+import math
+import time
+import yaml
+
+from ochopod.core.fsm import diagnostic
+from ochopod.core.utils import merge
+from toolset.commands import scale
+from toolset.io import fire, run
+from toolset.tool import Automation, Template
+from yaml import YAMLError
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Defaults for each rule (see the tool help).
+DEFAULTS = \
+    {
+        'min': 1,
+        'max': 10,
+        'tolerance': 0.1,
+        'cooldown':
+            {
+                'up': 60,
+                'down': 300
+            },
+        'schedule': []
+    }
+
+
+def _floor(rule, now):
+
+    #
+    # - scheduled minimum capacities (e.g ahead of known traffic peaks)
+    # - each entry is active between its from/to local times (HH:MM) on the specified week days (0 is monday)
+    #
+    floor = rule['min']
+    hhmm = now.strftime('%H:%M')
+    for blk in rule['schedule']:
+        days = blk['days'] if 'days' in blk else range(7)
+        if now.weekday() in days and blk['from'] <= hhmm < blk['to']:
+            floor = max(floor, blk['min'])
+
+    return floor
+
+
+def _sample(hints, path):
+
+    #
+    # - walk down the metrics using the dotted path (e.g requests.rate)
+    #
+    value = hints['metrics'] if 'metrics' in hints else None
+    for token in path.split('.'):
+        if not isinstance(value, dict) or token not in value:
+            return None
+        value = value[token]
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def desired(rule, pods, samples, now):
+    """
+    Returns the # of pods the rule wants for the cluster given its current size and metric samples (one per pod).
+    This is plain target tracking (the average per pod should match the target) with a hysteresis band, clipped by
+    the min/max capacities and the scheduled minimums.
+    """
+
+    floor = _floor(rule, now)
+    target = pods
+    if samples:
+        avg = sum(samples) / len(samples)
+        ratio = avg / rule['target']
+        if abs(ratio - 1.0) > rule['tolerance']:
+            target = int(math.ceil(pods * ratio))
+
+    return min(max(target, floor), max(rule['max'], floor))
+
+
+class _Autoscaler(Automation):
+
+    def __init__(self, proxy, rules, period, timeout, once, dry, emit):
+        super(_Autoscaler, self).__init__('autoscale')
+
+        self.dry = dry
+        self.emit = emit
+        self.last = {}
+        self.once = once
+        self.period = period
+        self.proxy = proxy
+        self.rules = rules
+        self.timeout = timeout
+
+    def evaluate(self, rule):
+
+        #
+        # - sample the metric on every pod of the cluster (same info fan-out as poll)
+        #
+        cluster = rule['cluster']
+
+        def _query(zk):
+            replies = fire(zk, cluster, 'info')
+            return [_sample(hints, rule['metric']) for _, hints, code in replies.values() if code == 200]
+
+        js = run(self.proxy, _query)
+        pods = len(js)
+        samples = [value for value in js if value is not None]
+        if not pods:
+            return {'ok': False, 'pods': 0}
+
+        now = time.time()
+        target = desired(rule, pods, samples, datetime.datetime.now())
+        out = \
+            {
+                'ok': True,
+                'pods': pods,
+                'target': target,
+                'samples': len(samples),
+                'avg': sum(samples) / len(samples) if samples else None
+            }
+
+        if target == pods:
+            return out
+
+        #
+        # - honor the cooldowns (time since the last scaling action on that cluster)
+        #
+        lapse = now - self.last.get(cluster, 0)
+        cooldown = rule['cooldown']['up'] if target > pods else rule['cooldown']['down']
+        if lapse < cooldown:
+            out['cooldown'] = int(cooldown - lapse)
+            return out
+
+        #
+        # - scale using the regular scale workflow (in-process)
+        #
+        if not self.dry:
+            self.checkpoint()
+            automation = scale._Automation(self.proxy, cluster, '@%d' % target, False, None, self.timeout)
+            out['ok'] = self.inline(automation)['ok']
+            self.last[cluster] = time.time()
+
+        logger.info('%s : %d -> %d pods (%s)' % (cluster, pods, target, 'dry run' if self.dry else 'ok' if out['ok'] else 'failed'))
+        return out
+
+    def workflow(self):
+
+        while True:
+
+            ts = time.time()
+            for rule in self.rules:
+                try:
+
+                    self.emit(rule['cluster'], self.evaluate(rule))
+
+                except AssertionError as failure:
+
+                    logger.debug('%s : failed to autoscale -> %s' % (rule['cluster'], failure))
+
+                except Exception as failure:
+
+                    logger.debug('%s : failed to autoscale -> %s' % (rule['cluster'], diagnostic(failure)))
+
+            self.out['ok'] = True
+            if self.once:
+                return
+
+            time.sleep(max(0, self.period - (time.time() - ts)))
+
+
+def go():
+
+    class _Tool(Template):
+
+        help = \
+            '''
+                Long-running autoscaling loop driven by the metrics the pods publish during their sanity checks (e.g
+                what poll returns). The rules are defined in a YAML file, for instance:
+
+                    period: 30
+                    rules:
+                      - cluster: marathon.web
+                        metric: requests.rate
+                        target: 100
+                        min: 2
+                        max: 20
+                        tolerance: 0.1
+                        cooldown: {up: 60, down: 300}
+                        schedule:
+                          - {days: [0, 1, 2, 3, 4], from: '08:00', to: '10:00', min: 10}
+
+                Every period the metric is averaged across the cluster's pods and the cluster is scaled so that the
+                average per pod matches the target (nothing happens within the tolerance band). The capacity is
+                clipped by min/max and by any active scheduled minimum. Cooldowns (in seconds) are enforced between
+                two scaling actions on the same cluster. Each cluster must map to one single marathon application.
+
+                Use --once to run one single pass and --dry to only report what would be done. The portal will run
+                this tool in the background if $AUTOSCALE_RULES is set to the path of a rules file.
+            '''
+
+        tag = 'autoscale'
+
+        def customize(self, parser):
+
+            parser.add_argument('rules', type=str, help='YAML rules file')
+            parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='scaling timeout in seconds')
+            parser.add_argument('--once', action='store_true', dest='once', help='runs one single pass')
+            parser.add_argument('--dry', action='store_true', dest='dry', help='reports without scaling')
+
+        def body(self, args, _, proxy):
+
+            try:
+                with open(args.rules, 'r') as f:
+                    cfg = yaml.load(f)
+
+            except YAMLError as failure:
+
+                mark = failure.problem_mark if hasattr(failure, 'problem_mark') else None
+                assert 0, '%s is invalid%s' % (args.rules, ' (line %s, column %s)' % (mark.line+1, mark.column+1) if mark else '')
+
+            assert cfg and 'rules' in cfg, 'no rules defined in %s (user error ?)' % args.rules
+            rules = []
+            for blk in cfg['rules']:
+                rule = merge(DEFAULTS, blk)
+                assert 'cluster' in rule and 'metric' in rule and 'target' in rule, 'each rule needs a cluster, a metric and a target'
+                assert rule['target'] > 0, '%s : the target must be positive' % rule['cluster']
+                assert 1 <= rule['min'] <= rule['max'], '%s : invalid min/max' % rule['cluster']
+                rules += [rule]
+
+            #
+            # - run the loop on its own automation (it will block forever unless --once is used)
+            #
+            automation = _Autoscaler(proxy, rules, cfg.get('period', 30), args.timeout, args.once, args.dry, self.emit)
+            automation.start()
+            out = automation.join()
+            self.summarize(rules=len(rules))
+            return 0 if out['ok'] else 1
+
+    return _Tool()
\ No newline at end of file
@@ -14,136 +14,295 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import copy
+import datetime
 import json
 import logging
-import os
+import re
+import time
 
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import merge, retry, shell
-from random import choice
-from requests import get, put, post
-from threading import Thread
-from toolset.io import fire, run
-from toolset.tool import Template
+from toolset.events import events
+from toolset.health import gate, predicate
+from toolset.commands.scale import CLONED
+from toolset.io import drain, fire, run, WARM
+from toolset.marathon import client
+from toolset.prefetch import prefetch
+from toolset.spec import FINGERPRINT, fingerprint
+from toolset.state import state
+from toolset.tool import Automation, execute, PARALLEL, Template
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Timestamp suffix of the marathon application identifiers (see spec.render()).
+STAMP = re.compile(r'-\d{4}(-\d{2}){5}$')
 
-class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, strict, timeout, version):
-        super(_Automation, self).__init__()
+class _Automation(Automation):
+
+    def __init__(self, proxy, cluster, strict, timeout, version, pull, ready, window, native=False):
+        super(_Automation, self).__init__(cluster)
 
         self.cluster = cluster
+        self.native = native
         self.out = \
             {
                 'ok': False,
                 'up': []
             }
         self.proxy = proxy
+        self.pull = pull
+        self.ready = predicate(ready) if ready else None
         self.strict = strict
         self.timeout = timeout
         self.version = version
+        self.window = window
+
+    def fold(self, marathon, cache, app, promoted, image):
+
+        #
+        # - if the application has a warm pool (scale --warm) the pods switched on out of it are folded back into
+        #   the application (their tasks are deleted, the application capacity accounting for them)
+        # - the pool then gets the new image as well (its idle pods are re-started)
+        #
+        pool = '%s%s' % (app, WARM)
+        live = cache.app(pool)
+        if not live:
+            return
+
+        if promoted:
+            reply = marathon.post('/v2/tasks/delete?scale=true', {'ids': promoted})
+            code = reply.status_code
+            assert code == 200 or code == 201, 'warm pool task deletion failed (HTTP %d)' % code
+
+        spec = copy.deepcopy(live['container'])
+        spec['docker']['image'] = image
+        reply = marathon.put('/v2/apps/%s' % pool, {'container': spec})
+        code = reply.status_code
+        assert code == 200 or code == 201, 'warm pool update failed (HTTP %d)' % code
+        cache.invalidate(pool)
+
+    def rollback(self, marathon, cache, app, clone, instances):
+
+        #
+        # - the native rollout failed midway : delete the clone and scale the old application back up to make up for
+        #   the old pods we already drained
+        # - if this fails as well leave the clone identifier in our outcome so that an operator can finish or undo
+        #   the rollout
+        #
+        try:
+            reply = marathon.delete('/v2/apps/%s' % clone)
+            code = reply.status_code
+            assert code == 200 or code == 204, 'clone deletion failed (HTTP %d)' % code
+            if instances is not None:
+                reply = marathon.put('/v2/apps/%s' % app, {'instances': instances})
+                code = reply.status_code
+                assert code == 200 or code == 201, 'scale-up failed (HTTP %d)' % code
+                cache.invalidate(app)
 
-        self.start()
+            logger.debug('%s : rollout aborted, %s deleted' % (self.cluster, clone))
 
-    def run(self):
+        except Exception as failure:
+
+            self.out['clone'] = clone
+            logger.warning('%s : unable to roll back, %s must be cleaned up manually (%s)' % (self.cluster, clone, diagnostic(failure)))
+
+    def upgrade(self, marathon, cache, app, live, image, old, promoted):
+
+        #
+        # - clone the application under a new timestamped identifier, using the new image
+        # - marathon starts its tasks alongside the old ones and never kills any of them by itself (the old
+        #   application is left untouched), which lets us drain each old pod before deleting its task
+        #
+        stamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H-%M-%S')
+        clone = '%s-%s' % (STAMP.sub('', app), stamp)
+        js = copy.deepcopy({key: value for key, value in live.items() if key in CLONED})
+        js['id'] = '/%s' % clone
+        js['instances'] = live['instances'] + len(promoted)
+        js['container']['docker']['image'] = image
+        for mapping in js['container']['docker'].get('portMappings', None) or []:
+            mapping.pop('servicePort', None)
+
+        if FINGERPRINT in js.get('labels', {}):
+            js['labels'][FINGERPRINT] = fingerprint(js)
+
+        reply = marathon.post('/v2/apps', js)
+        code = reply.status_code
+        logger.debug(reply.text)
+        assert code == 200 or code == 201, 'submission failed (HTTP %d)' % code
+
+        #
+        # - track the new pods through their hints (e.g the pods of the cloned application)
+        # - as they become ready gracefully drain as many old pods (oldest first) and only then delete their tasks
+        # - if anything goes wrong (timeout, cancellation, marathon failure) roll back before bailing out
+        #
+        ts = time.time()
+        tasks = dict(old)
+        left = sorted(tasks.keys())
+        deleted = []
+        target = ['running'] if self.strict else ['stopped', 'running']
+        completed = False
         try:
+            while True:
+
+                self.checkpoint()
+
+                def _query(zk):
+                    replies = fire(zk, self.cluster, 'info')
+                    return [(seq, hints) for seq, hints, code in replies.values()
+                            if code == 200 and hints['application'] == clone and hints['process'] in target]
+
+                fresh = sorted(seq for seq, hints in run(self.proxy, _query) if not self.ready or self.ready(hints))
+                n = min(len(fresh), len(old)) - (len(old) - len(left))
+                if n > 0:
+                    _, pending = drain(self.proxy, self.cluster, left[:n], max(self.timeout - (time.time() - ts), 1))
+                    assert not pending, '%d old pod(s) still running' % len(pending)
+                    ids = [tasks[seq] for seq in left[:n]]
+                    reply = marathon.post('/v2/tasks/delete?scale=true', {'ids': ids})
+                    code = reply.status_code
+                    assert code == 200 or code == 201, 'delete failed (HTTP %d)' % code
+                    deleted += ids
+                    left = left[n:]
+                    logger.debug('%s : %d/%d old pods drained' % (self.cluster, len(old) - len(left), len(old)))
+
+                if len(fresh) >= len(old) and not left:
+                    break
+
+                assert time.time() - ts < self.timeout, '1+ pods still not up (%d/%d)' % (len(fresh), len(old))
+                time.sleep(1.0)
+
+            completed = True
+
+        finally:
 
             #
-            # - we need to pass the framework master IPs around (ugly)
+            # - the tasks deleted so far scaled either the old application or its warm pool down
+            # - scale the old application back up by whatever was taken out of the pool as well
             #
-            assert 'MARATHON_MASTER' in os.environ, '$MARATHON_MASTER not specified (check your portal pod)'
-            master = choice(os.environ['MARATHON_MASTER'].split(','))
-            headers = \
-                {
-                    'content-type': 'application/json',
-                    'accept': 'application/json'
-                }
+            if not completed:
+                instances = live['instances'] + sum(1 for task in deleted if task in promoted) if deleted else None
+                self.rollback(marathon, cache, app, clone, instances)
+
+        #
+        # - the old application (and its warm pool if any) is now empty, nuke it
+        #
+        for key in [app, '%s%s' % (app, WARM)]:
+            if cache.app(key):
+                reply = marathon.delete('/v2/apps/%s' % key)
+                code = reply.status_code
+                assert code == 200 or code == 204, 'application deletion failed (HTTP %d)' % code
+                cache.invalidate(key)
+
+        return fresh
+
+    def workflow(self):
+        try:
+
+            #
+            # - use the shared marathon client (leader routing, failover & retries)
+            #
+            marathon = client()
 
             #
-            # - first peek and see what pods we have
+            # - first peek and see what pods we have (the idle pods from the warm pool, if any, are skipped)
             # - they should all map to one single marathon application (abort if not)
+            # - the pods switched on out of the warm pool are accounted for as part of that application
             # - we'll use the application identifier to retrieve the configuration json later on
             #
             def _query(zk):
                 replies = fire(zk, self.cluster, 'info')
-                return [hints['application'] for (_, hints, _) in replies.values()]
+                return [(hints['application'], hints['node'], seq, hints['task']) for (seq, hints, _) in replies.values()]
 
             js = run(self.proxy, _query)
-            assert len(set(js)) == 1, '%s is mapping to 2+ marathon applications' % self.cluster
-            app = js[0]
+            nodes = [node for _, node, _, _ in js]
+            old = [(seq, task) for _, _, seq, task in js]
+            promoted = [task for key, _, _, task in js if key.endswith(WARM)]
+            js = set(key[:-len(WARM)] if key.endswith(WARM) else key for key, _, _, _ in js)
+            assert len(js) == 1, '%s is mapping to 2+ marathon applications' % self.cluster
+            app = js.pop()
 
             #
-            # - fetch the various versions for our app
-            # - we want to get hold of the most recent configuration
+            # - get hold of the most recent configuration from the shared state cache (e.g the current application
+            #   definition, no need to walk the versions)
+            # - keep the docker container configuration and the # of tasks around
             #
-            url = 'http://%s/v2/apps/%s/versions' % (master, app)
-            reply = get(url, headers=headers)
-            code = reply.status_code
-            logger.debug('-> %s (HTTP %d)' % (url, code))
-            assert code == 200 or code == 201, 'delete failed (HTTP %d)' % code
-            js = reply.json()
+            cache = state()
+            js = cache.app(app)
+            assert js, 'application %s not found' % app
+
+            spec = copy.deepcopy(js['container'])
+            tag = spec['docker']['image']
+            capacity = js['instances'] + len(promoted)
 
             #
-            # - retrieve the latest one
-            # - keep the docker container configuration and the # of tasks around
+            # - grab the docker image
+            # - just add a :<version> suffix (or replace it) but don't change the image  proper
             #
-            last = js['versions'][0]
-            url = 'http://%s/v2/apps/%s/versions/%s' % (master, app, last)
-            reply = get(url, headers=headers)
-            code = reply.status_code
-            logger.debug('-> %s (HTTP %d)' % (url, code))
-            assert code == 200 or code == 201, 'delete failed (HTTP %d)' % code
-            js = reply.json()
+            tokens = tag.split(':')
+            image = '%s:%s' % (tag, self.version) if len(tokens) < 2 else '%s:%s' % (tokens[0], self.version)
 
-            spec = js['container']
-            tag = spec['docker']['image']
-            capacity = js['instances']
+            #
+            # - if --prefetch is on pull the new image on our nodes first
+            # - this way the download does not happen while the pods are down
+            #
+            if self.pull:
+                prefetch(image, nodes, self.timeout, self.checkpoint)
+
+            #
+            # - if --native is on roll the new pods out alongside the old ones
+            # - the old pods are drained as the new ones become ready (no downtime)
+            #
+            self.checkpoint()
+            if self.native:
+                up = self.upgrade(marathon, cache, app, js, image, old, promoted)
+                self.out['up'] = up
+                if self.ready:
+                    assert gate(self.proxy, self.cluster, up, self.ready, self.timeout, self.window, self.checkpoint), \
+                        '1+ pods not ready'
+
+                self.out['ok'] = True
+                logger.debug('%s : %d pods upgraded to version "%s"' % (self.cluster, len(up), self.version))
+                return
 
             #
             # - kill all the pods using a POST /control/kill
             # - wait for them to be dead
             #
-            @retry(timeout=self.timeout, pause=0)
-            def _spin():
-                def _query(zk):
-                    replies = fire(zk, self.cluster, 'control/kill', timeout=self.timeout)
-                    return [(code, seq) for seq, _, code in replies.values()]
-
-                #
-                # - fire the request one or more pods
-                # - wait for every pod to report back a HTTP 410 (GONE)
-                # - this means the ochopod state-machine is now idling (e.g dead)
-                #
-                js = run(self.proxy, _query)
-                gone = sum(1 for code, _ in js if code == 410)
-                assert gone == len(js), 'at least one pod is still running'
-                return
 
-            _spin()
+            _, pending = drain(self.proxy, self.cluster, [seq for seq, _ in old], self.timeout)
+            assert not pending, '%d pod(s) still running' % len(pending)
+            self.fold(marathon, cache, app, promoted, image)
+            spec['docker']['image'] = image
 
             #
-            # - grab the docker image
-            # - just add a :<version> suffix (or replace it) but don't change the image  proper
-            # - update the image and PUT the new configuration back
+            # - PUT the new configuration back (with the updated image)
             # - marathon will then kill & re-start all the tasks
             #
-            tokens = tag.split(':')
-            spec['docker']['image'] = \
-                '%s:%s' % (tag, self.version) if len(tokens) < 2 else '%s:%s' % (tokens[0], self.version)
             js = \
                 {
-                    'container': spec
+                    'container': spec,
+                    'instances': capacity
                 }
 
-            url = 'http://%s/v2/apps/%s' % (master, app)
-            reply = put(url, data=json.dumps(js), headers=headers)
+            feed = events()
+            reply = marathon.put('/v2/apps/%s' % app, js)
             code = reply.status_code
-            logger.debug('-> %s (HTTP %d)' % (url, code))
             logger.debug(reply.text)
             assert code == 200 or code == 201, 'update failed (HTTP %d)' % code
+            cache.invalidate(app)
+
+            #
+            # - if we have the event stream block until marathon reports the deployment as completed
+            # - the new pods should then register shortly, poll them at a faster pace
+            #
+            ts = time.time()
+            pause = 3
+            deployment = reply.json().get('deploymentId')
+            if feed is not None and deployment and feed.wait(lambda: feed.deployed(deployment) is not None, self.timeout):
+                assert feed.deployed(deployment), 'marathon deployment failed'
+                pause = 0.5
 
             #
             # - the pods should now be starting
@@ -151,7 +310,7 @@ class _Automation(Thread):
             # - the sequence counters allocated to our new pods are returned as well
             #
             target = ['running'] if self.strict else ['stopped', 'running']
-            @retry(timeout=self.timeout, pause=3, default={})
+            @retry(timeout=max(self.timeout - (time.time() - ts), 1), pause=pause, default={})
             def _spin():
                 def _query(zk):
                     replies = fire(zk, self.cluster, 'info')
@@ -165,6 +324,14 @@ class _Automation(Thread):
             up = [seq for _, seq in js]
             assert len(up) == capacity, '1+ pods still not up (%d/%d)' % (len(up), capacity)
             self.out['up'] = up
+
+            #
+            # - if --ready is used wait for the new pods to satisfy the readiness predicate (and stay that way)
+            #
+            if self.ready:
+                assert gate(self.proxy, self.cluster, up, self.ready, self.timeout, self.window, self.checkpoint), \
+                    '1+ pods not ready'
+
             self.out['ok'] = True
 
             logger.debug('%s : %d pods updated to version "%s"' % (self.cluster, capacity, self.version))
@@ -177,11 +344,6 @@ class _Automation(Thread):
 
             logger.debug('%s : failed to bump -> %s' % (self.cluster, diagnostic(failure)))
 
-    def join(self, timeout=None):
-
-        Thread.join(self)
-        return self.out
-
 
 def go():
 
@@ -189,6 +351,13 @@ def go():
 
         help = \
             '''
+                Updates the docker image version used by the specified clusters. By default all the pods are first
+                gracefully killed, the new image is then submitted to marathon and the tool waits for the new pods to
+                be up. Use --native to instead roll the new pods out alongside the old ones : the application is
+                cloned (with the new image) and each old pod is drained and its task deleted as the new pods become
+                ready. Marathon never kills an old task by itself and the application upgrade strategy is left alone.
+                If the rollout fails midway the clone is deleted and the old application scaled back up (should this
+                fail too the clone identifier is reported in the json output).
             '''
 
         tag = 'bump'
@@ -198,31 +367,43 @@ def go():
             parser.add_argument('clusters', type=str, nargs='+', help='clusters (can be a glob pattern, e.g foo*)')
             parser.add_argument('-j', action='store_true', dest='json', help='json output')
             parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='timeout in seconds')
+            parser.add_argument('--deadline', action='store', dest='deadline', type=int, help='overall deadline in seconds')
+            parser.add_argument('--parallel', action='store', dest='parallel', type=int, default=PARALLEL, help='max # of automations at once')
             parser.add_argument('-v', action='store', dest='version', type=str, default='latest', help='docker image version')
             parser.add_argument('--strict', action='store_true', dest='strict', help='waits until all pods are running')
+            parser.add_argument('--prefetch', action='store_true', dest='prefetch', help='pulls the new image before killing the pods')
+            parser.add_argument('--ready', action='store', dest='ready', type=str, nargs='+', help='readiness expression(s), e.g state=leader|follower')
+            parser.add_argument('-w', action='store', dest='window', type=int, default=5, help='stabilization window in seconds (with --ready)')
+            parser.add_argument('--native', action='store_true', dest='native', help='rolls the new pods out alongside the old ones')
 
         def body(self, args, unknown, proxy):
 
             assert len(args.clusters), 'at least one cluster is required'
 
             #
-            # - run the workflow proper (one thread per container definition)
+            # - run the workflow proper (one automation per container definition, --parallel at once)
             #
-            threads = {cluster: _Automation(
+            automations = [_Automation(
                 proxy,
                 cluster,
                 args.strict,
                 args.timeout,
-                args.version) for cluster in args.clusters}
+                args.version,
+                args.prefetch,
+                args.ready,
+                args.window,
+                args.native) for cluster in args.clusters]
 
             #
-            # - wait for all our threads to join
+            # - wait for all our automations to complete (or for the deadline)
             #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+            n = len(automations)
+            outcome = execute(automations, args.parallel, args.deadline, self.progress)
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
             up = sum(len(js['up']) for _, js in outcome.items())
-            logger.info(json.dumps(outcome) if args.json else '%d%% success (%d pods)' % (pct, up))
+            self.summarize(success=pct, up=up)
+            if not self.streaming:
+                logger.info(json.dumps(outcome) if args.json else '%d%% success (%d pods)' % (pct, up))
             return 0 if pct == 100 else 1
 
     return _Tool()
\ No newline at end of file
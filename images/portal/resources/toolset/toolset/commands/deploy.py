@@ -17,27 +17,65 @@
 import datetime
 import json
 import logging
-import os
 import time
 import yaml
 
 from ochopod.core.fsm import diagnostic
-from ochopod.core.utils import merge, retry, shell
-from random import choice
-from requests import delete, post
-from threading import Thread
-from toolset.io import fire, run
-from toolset.tool import Template
+from toolset.io import fire, lookup, run, Watch
+from toolset.marathon import client
+from toolset.prefetch import nodes, prefetch
+from toolset.spec import FINGERPRINT, render
+from toolset.state import state
+from toolset.tool import Automation, execute, PARALLEL, Template
 from yaml import YAMLError
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
 
-class _Automation(Thread):
+def _settle(proxy, watch, qualified, application, pods, timeout, strict):
 
-    def __init__(self, proxy, template, overrides, namespace, pods, release, suffix, timeout, strict):
-        super(_Automation, self).__init__()
+    #
+    # - wait for all the pods to be in the 'running' mode
+    # - only probe the pods which registered since we started watching (and are not yet settled)
+    # - block on the watch in between (e.g no polling while the image is being pulled)
+    # - the 'application' hint is set by design to the marathon application identifier
+    # - the states & sequence counters allocated to our new pods are returned (or nothing upon timeout)
+    #
+    ts = time.time()
+    pending = set()
+    settled = {}
+    target = ['dead', 'running'] if strict else ['dead', 'stopped', 'running']
+    while len(settled) < pods:
+
+        left = timeout - (time.time() - ts)
+        if left <= 0:
+            break
+
+        pending |= watch.fresh(min(left, 1.0) if pending else left)
+        if not pending:
+            continue
+
+        def _query(zk):
+            registered = lookup(zk, qualified, kids=pending)
+            replies = fire(zk, qualified, 'info', pods=registered)
+            return [(registered[key]['id'], hints['application'], hints['process'], seq)
+                    for key, (seq, hints, _) in replies.items() if key in registered]
+
+        for kid, key, status, seq in run(proxy, _query):
+            if key != application:
+                pending.discard(kid)
+            elif status in target:
+                pending.discard(kid)
+                settled[kid] = (status, seq)
+
+    return settled.values() if len(settled) == pods else []
+
+
+class _Automation(Automation):
+
+    def __init__(self, proxy, template, overrides, namespace, pods, release, suffix, timeout, strict, unchanged, pull):
+        super(_Automation, self).__init__(template)
 
         self.namespace = namespace
         self.out = \
@@ -48,269 +86,210 @@ class _Automation(Thread):
         self.overrides = overrides
         self.pods = pods
         self.proxy = proxy
+        self.pull = pull
         self.release = release
         self.suffix = suffix
         self.strict = strict
         self.template = template
         self.timeout = max(timeout, 5)
+        self.unchanged = unchanged
 
-        self.start()
-
-    def run(self):
+    def workflow(self):
         try:
 
             #
-            # - we need to pass the framework master IPs around (ugly)
+            # - use the shared marathon client (leader routing, failover & retries)
             #
-            assert 'MARATHON_MASTER' in os.environ, '$MARATHON_MASTER not specified (check your portal pod)'
-            master = choice(os.environ['MARATHON_MASTER'].split(','))
-            headers = \
-                {
-                    'content-type': 'application/json',
-                    'accept': 'application/json'
-                }
+            marathon = client()
+
+            #
+            # - if we still have no target default it to 1 single pod
+            # - render the marathon application (e.g merge, overrides, ports & verbatim)
+            #
+            if not self.pods:
+                self.pods = 1
 
-            with open(self.template, 'r') as f:
+            qualified, application, spec = \
+                render(self.template, self.overrides, self.namespace, self.pods, self.release, self.suffix)
 
-                #
-                # - parse the template yaml file (e.g container definition)
-                #
-                raw = yaml.load(f)
-                assert raw, 'empty YAML input (user error ?)'
+            #
+            # - if --skip-unchanged is on look for a live application with the same fingerprint
+            # - if we find one there is nothing to do
+            #
+            live = state().labelled(FINGERPRINT, spec['labels'][FINGERPRINT]) if self.unchanged else []
+            if live:
+                self.out['ok'] = True
+                self.out['skipped'] = True
+                logger.debug('%s : unchanged (matches %s), skipping' % (self.template, live[0]))
+                return
 
-                #
-                # - merge with our defaults
-                # - we want at least the cluster & image settings
-                # - TCP 8080 is added by default to the port list
-                #
-                defaults = \
-                    {
-                        'start': True,
-                        'debug': False,
-                        'settings': {},
-                        'ports': [8080],
-                        'verbatim': {}
-                    }
-
-                cfg = merge(defaults, raw)
-                assert 'cluster' in cfg, 'cluster identifier undefined (user error ?)'
-                assert 'image' in cfg, 'docker image undefined (user error ?)'
+            #
+            # - if --prefetch is on pull the image first on the nodes running the cluster's pods (if any)
+            #
+            if self.pull:
+                prefetch(spec['container']['docker']['image'], nodes(self.proxy, qualified), self.timeout, self.checkpoint)
 
-                #
-                # - if a suffix is specified append it to the cluster identifier
-                #
-                if self.suffix:
-                    cfg['cluster'] = '%s-%s' % (cfg['cluster'], self.suffix)
+            #
+            # - watch the cluster's pods znode first (the pods already registered are ignored)
+            # - fire the POST /v2/apps to create our application
+            # - this will indirectly spawn our pods
+            #
+            self.checkpoint()
+            watch = Watch(self.proxy, qualified)
+            reply = marathon.post('/v2/apps', spec)
+            code = reply.status_code
+            assert code == 200 or code == 201, 'submission failed (HTTP %d)' % code
+
+            js = _settle(self.proxy, watch, qualified, application, self.pods, self.timeout, self.strict)
+            running = sum(1 for state, _ in js if state is not 'dead')
+            up = [seq for _, seq in js]
+            self.out['up'] = up
+            self.out['ok'] = self.pods == running
+            logger.debug('%s : %d/%d pods are running ' % (self.template, running, self.pods))
+
+            if not up:
 
                 #
-                # - timestamp the application (we really want a new uniquely identified application)
-                # - lookup the optional overrides and merge with our pod settings if specified
-                # - this is what happens when the -o option is used
+                # - nothing is running (typically because the image has an issue and is not
+                #   not booting the ochopod script for instance, which happens often)
+                # - in that case fire a HTTP DELETE against the marathon application to clean it up
                 #
-                stamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H-%M-%S')
-                qualified = '%s.%s' % (self.namespace, cfg['cluster'])
-                application = 'ochopod.%s-%s' % (qualified, stamp)
-                if qualified in self.overrides:
+                reply = marathon.delete('/v2/apps/%s' % application)
+                code = reply.status_code
+                assert code == 200 or code == 204, 'application deletion failed (HTTP %d)' % code
 
-                    blk = self.overrides[qualified]
-                    logger.debug('%s : overriding %d settings (%s)' % (self.template, len(blk), qualified))
-                    cfg['settings'] = merge(cfg['settings'], blk)
+        except AssertionError as failure:
 
-                def _nullcheck(cfg, prefix):
+            logger.debug('%s : failed to deploy -> %s' % (self.template, failure))
 
-                    #
-                    # - walk through the settings and flag any null value
-                    #
-                    missing = []
-                    if cfg is not None:
-                        for key, value in cfg.items():
-                            if value is None:
-                                missing += ['%s.%s' % ('.'.join(prefix), key)]
-                            elif isinstance(value, dict):
-                                missing += _nullcheck(value, prefix + [key])
+        except YAMLError as failure:
 
-                    return missing
+            if hasattr(failure, 'problem_mark'):
+                mark = failure.problem_mark
+                logger.debug('%s : invalid deploy.yml (line %s, column %s)' % (self.template, mark.line+1, mark.column+1))
 
-                missing = _nullcheck(cfg['settings'], ['pod'])
-                assert not missing, '%d setting(s) missing ->\n\t - %s' % (len(missing), '\n\t - '.join(missing))
+        except Exception as failure:
 
-                #
-                # - if we still have no target default it to 1 single pod
-                #
-                if not self.pods:
-                    self.pods = 1
+            logger.debug('%s : failed to deploy -> %s' % (self.template, diagnostic(failure)))
 
-                #
-                # - setup our port list
-                # - the port binding is specified either by an integer (container port -> dynamic mesos port), by
-                #   two integers (container port -> host port) or by an integer followed by a * (container port ->
-                #   same port on the host)
-                # - on top of that, all those options allow to specify whether the protocol is TCP or UDP by adding
-                #   the desired protocol after the binding (e.g. '8080 tcp' or '8125 * udp'. TCP is the default if no
-                #   protocol is specified.
-                # - the marathon pods must by design map /etc/mesos
-                #
-                def _parse_port(token):
-                    
-                    #
-                    # - tries to return an int if possible, a string otherwise
-                    #
-                    def get_token_no_protocol(token):
-                        # - remove the protocol piece
-                        t = token[:-4].strip()
-                        try:
-                            return int(t)
-                        except ValueError:
-                            return t
-                    
-                    if isinstance(token, str) and token.lower().endswith(' udp'):
-                        protocol = 'udp'
-                        token_no_protocol = get_token_no_protocol(token)
-                        
-                    elif isinstance(token, str) and token.lower().endswith(' tcp'):
-                        protocol = 'tcp'
-                        token_no_protocol = get_token_no_protocol(token)
-                    else:
-                        # - TCP is the default
-                        protocol = 'tcp'
-                        token_no_protocol = token    
-                    
-                    if isinstance(token_no_protocol, int):
-                        return {'containerPort': token_no_protocol, 'protocol': protocol}
-                    elif isinstance(token_no_protocol, str) and token_no_protocol.endswith(' *'):
-                        port = int(token_no_protocol[:-2])
-                        return {'containerPort': port, 'hostPort': port, 'protocol': protocol}
-                    elif isinstance(token_no_protocol, str):
-                        ports = token_no_protocol.split(' ')
-                        assert len(ports) == 2, 'invalid port syntax (must be two integers separated by 1+ spaces optionally followed by the protocol (tcp or udp, defaults to tcp))'
-                        return {'containerPort': int(ports[0]), 'hostPort': int(ports[1]), 'protocol': protocol}
-                    else:
-                        assert 0, 'invalid port syntax ("%s")' % token
 
-                #
-                # - craft the docker image specifier
-                # - if -r is used make sure to add (or override) the :<label> suffix
-                #
-                image = cfg['image']
-                tokens = image.split(':')
-                image = '%s:%s' % (tokens[0], self.release) if self.release else image
+class _Group(Automation):
 
-                #
-                # - note the marathon-ec2 ochopod bindings will set the application hint automatically
-                #   via environment variable (e.g no need to specify it here)
-                # - make sure to mount /etc/mesos and /opt/mesosphere to account for various mesos installs
-                #
-                ports = [_parse_port(token) for token in cfg['ports']] if 'ports' in cfg else []
-                spec = \
-                    {
-                        'id': application,
-                        'instances': self.pods,
-                        'env':
-                            {
-                                'ochopod_cluster': cfg['cluster'],
-                                'ochopod_debug': str(cfg['debug']).lower(),
-                                'ochopod_start': str(cfg['start']).lower(),
-                                'ochopod_namespace': self.namespace,
-                                'pod': json.dumps(cfg['settings'])
-                            },
-                        'container':
-                            {
-                                'type': 'DOCKER',
-                                'docker':
-                                    {
-                                        'forcePullImage': True,
-                                        'image': image,
-                                        'network': 'BRIDGE',
-                                        'portMappings': ports
-                                    },
-                                'volumes':
-                                    [
-                                        {
-                                            'containerPath': '/etc/mesos',
-                                            'hostPath': '/etc/mesos',
-                                            'mode': 'RO'
-                                        },
-                                        {
-                                            'containerPath': '/opt/mesosphere',
-                                            'hostPath': '/opt/mesosphere',
-                                            'mode': 'RO'
-                                        }
-                                    ]
-                            }
-                    }
+    def __init__(self, proxy, group, templates, overrides, namespace, pods, release, suffix, timeout, strict, unchanged, pull):
+        super(_Group, self).__init__(group)
 
-                #
-                # - if we have a 'verbatim' block in our image definition yaml, merge it now
-                #
-                if 'verbatim' in cfg:
-                    spec = merge(cfg['verbatim'], spec)
+        self.group = group
+        self.namespace = namespace
+        self.out = \
+            {
+                'ok': False,
+                'up': [],
+                'apps': {template: {'ok': False, 'up': []} for template in templates}
+            }
+        self.overrides = overrides
+        self.pods = pods if pods else 1
+        self.proxy = proxy
+        self.pull = pull
+        self.release = release
+        self.suffix = suffix
+        self.strict = strict
+        self.templates = templates
+        self.timeout = max(timeout, 5)
+        self.unchanged = unchanged
 
-                #
-                # - pick a marathon master at random
-                # - fire the POST /v2/apps to create our application
-                # - this will indirectly spawn our pods
-                #
-                url = 'http://%s/v2/apps' % master
-                reply = post(url, data=json.dumps(spec), headers=headers)
-                code = reply.status_code
-                logger.debug('-> %s (HTTP %d)' % (url, code))
-                assert code == 200 or code == 201, 'submission failed (HTTP %d)' % code
+    def workflow(self):
+        try:
+
+            #
+            # - use the shared marathon client (leader routing, failover & retries)
+            #
+            marathon = client()
+
+            #
+            # - render all our applications the usual way (using the same timestamp)
+            # - nest them under a uniquely identified group
+            # - the 'application' hint will then be <group>/<application>
+            #
+            stamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H-%M-%S')
+            group = 'ochopod.%s.%s-%s' % (self.namespace, self.group, stamp)
+            members = {}
+            for template in self.templates:
+                qualified, application, spec = \
+                    render(template, self.overrides, self.namespace, self.pods, self.release, self.suffix, stamp)
 
                 #
-                # - wait for all the pods to be in the 'running' mode
-                # - the 'application' hint is set by design to the marathon application identifier
-                # - the sequence counters allocated to our new pods are returned as well
+                # - if --skip-unchanged is on leave out whatever matches a live application
                 #
-                target = ['dead', 'running'] if self.strict else ['dead', 'stopped', 'running']
-                @retry(timeout=self.timeout, pause=3, default={})
-                def _spin():
-                    def _query(zk):
-                        replies = fire(zk, qualified, 'info')
-                        return [(hints['process'], seq) for seq, hints, _ in replies.values()
-                                if hints['application'] == application and hints['process'] in target]
-
-                    js = run(self.proxy, _query)
-                    assert len(js) == self.pods, 'not all pods running yet'
-                    return js
-
-                js = _spin()
+                if self.unchanged and state().labelled(FINGERPRINT, spec['labels'][FINGERPRINT]):
+                    self.out['apps'][template] = {'ok': True, 'up': [], 'skipped': True}
+                    logger.debug('%s : unchanged, skipping' % template)
+                    continue
+
+                spec['id'] = '/%s/%s' % (group, application)
+                members[template] = (qualified, '%s/%s' % (group, application), spec)
+
+            if not members:
+                self.out['ok'] = True
+                return
+
+            #
+            # - if --prefetch is on pull each image first on the nodes running the corresponding pods (if any)
+            #
+            if self.pull:
+                for qualified, _, spec in members.values():
+                    prefetch(spec['container']['docker']['image'], nodes(self.proxy, qualified), self.timeout, self.checkpoint)
+
+            #
+            # - watch each cluster's pods znode first
+            # - fire one single POST /v2/groups to create all our applications at once
+            #
+            self.checkpoint()
+            watches = {template: Watch(self.proxy, qualified) for template, (qualified, _, _) in members.items()}
+            js = \
+                {
+                    'id': '/%s' % group,
+                    'apps': [spec for _, _, spec in members.values()]
+                }
+
+            reply = marathon.post('/v2/groups', js)
+            code = reply.status_code
+            assert code == 200 or code == 201, 'group submission failed (HTTP %d)' % code
+
+            #
+            # - track the readiness of all our members against the same deadline
+            # - any application with nothing running is deleted
+            #
+            ts = time.time()
+            for template, (qualified, application, _) in members.items():
+
+                left = max(self.timeout - (time.time() - ts), 1)
+                js = _settle(self.proxy, watches[template], qualified, application, self.pods, left, self.strict)
                 running = sum(1 for state, _ in js if state is not 'dead')
                 up = [seq for _, seq in js]
-                self.out['up'] = up
-                self.out['ok'] = self.pods == running
-                logger.debug('%s : %d/%d pods are running ' % (self.template, running, self.pods))
+                self.out['apps'][template] = {'ok': self.pods == running, 'up': up}
+                self.out['up'] += up
+                logger.debug('%s : %d/%d pods are running ' % (template, running, self.pods))
 
                 if not up:
-
-                    #
-                    # - nothing is running (typically because the image has an issue and is not
-                    #   not booting the ochopod script for instance, which happens often)
-                    # - in that case fire a HTTP DELETE against the marathon application to clean it up
-                    #
-                    url = 'http://%s/v2/apps/%s' % (master, application)
-                    reply = delete(url, headers=headers)
+                    reply = marathon.delete('/v2/apps/%s' % application)
                     code = reply.status_code
-                    logger.debug('-> %s (HTTP %d)' % (url, code))
                     assert code == 200 or code == 204, 'application deletion failed (HTTP %d)' % code
 
+            self.out['ok'] = all(js['ok'] for js in self.out['apps'].values())
+
         except AssertionError as failure:
 
-            logger.debug('%s : failed to deploy -> %s' % (self.template, failure))
+            logger.debug('%s : failed to deploy -> %s' % (self.group, failure))
 
         except YAMLError as failure:
 
             if hasattr(failure, 'problem_mark'):
                 mark = failure.problem_mark
-                logger.debug('%s : invalid deploy.yml (line %s, column %s)' % (self.template, mark.line+1, mark.column+1))
+                logger.debug('%s : invalid deploy.yml (line %s, column %s)' % (self.group, mark.line+1, mark.column+1))
 
         except Exception as failure:
 
-            logger.debug('%s : failed to deploy -> %s' % (self.template, diagnostic(failure)))
-
-    def join(self, timeout=None):
-
-        Thread.join(self)
-        return self.out
+            logger.debug('%s : failed to deploy -> %s' % (self.group, diagnostic(failure)))
 
 
 def go():
@@ -327,6 +306,17 @@ def go():
                 deleted.It is possible to add a suffix to the cluster identifier defined in the yaml configuration
                 by using the -s option (typically to run the same functionality in different contexts).
 
+                Multiple container definitions can be submitted at once as one single marathon group using --group
+                (the group identifier is derived from its value). This is faster and avoids concurrent deployments
+                when bringing up a whole environment.
+
+                Each marathon application is labelled with the fingerprint of its specification. Using --skip-unchanged
+                will skip any container definition matching an application that is already running.
+
+                Using --prefetch will first pull the images on the nodes currently running the corresponding clusters
+                (this cuts the time it takes for the new containers to start). The deployment fails if the pull fails
+                or does not complete within the timeout on any of those nodes.
+
                 This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
 
                 Please note we force a docker image pull when instantiating the new application.
@@ -344,7 +334,12 @@ def go():
             parser.add_argument('-r', action='store', dest='release', type=str, help='docker image release tag')
             parser.add_argument('-s', action='store', dest='suffix', type=str, help='optional cluster suffix')
             parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='timeout in seconds')
+            parser.add_argument('--deadline', action='store', dest='deadline', type=int, help='overall deadline in seconds')
+            parser.add_argument('--parallel', action='store', dest='parallel', type=int, default=PARALLEL, help='max # of automations at once')
             parser.add_argument('--strict', action='store_true', dest='strict', help='waits until all pods are running')
+            parser.add_argument('--group', action='store', dest='group', type=str, help='submits everything as one marathon group')
+            parser.add_argument('--skip-unchanged', action='store_true', dest='unchanged', help='skips what is already running')
+            parser.add_argument('--prefetch', action='store_true', dest='prefetch', help='pulls the images on the nodes first')
 
         def body(self, args, _, proxy):
 
@@ -373,9 +368,38 @@ def go():
                         assert 0, '%s is invalid (line %s, column %s)' % (args.overrides, mark.line+1, mark.column+1)
 
             #
-            # - run the workflow proper (one thread per container definition)
+            # - if --group is specified submit everything at once (one single automation)
+            # - report per container definition as usual
+            #
+            if args.group:
+                automation = _Group(
+                    proxy,
+                    args.group,
+                    args.containers,
+                    overrides,
+                    args.namespace,
+                    args.pods,
+                    args.release,
+                    args.suffix,
+                    args.timeout,
+                    args.strict,
+                    args.unchanged,
+                    args.prefetch)
+
+                outcome = execute([automation], 1, args.deadline, self.progress)
+                outcome = automation.out['apps']
+                n = len(outcome)
+                pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
+                up = sum(len(js['up']) for _, js in outcome.items())
+                self.summarize(success=pct, up=up)
+                if not self.streaming:
+                    logger.info(json.dumps(outcome) if args.json else '%d%% success (+%d pods)' % (pct, up))
+                return 0 if pct == 100 else 1
+
+            #
+            # - run the workflow proper (one automation per container definition, --parallel at once)
             #
-            threads = {template: _Automation(
+            automations = [_Automation(
                 proxy,
                 template,
                 overrides,
@@ -384,16 +408,20 @@ def go():
                 args.release,
                 args.suffix,
                 args.timeout,
-                args.strict) for template in args.containers}
+                args.strict,
+                args.unchanged,
+                args.prefetch) for template in args.containers]
 
             #
-            # - wait for all our threads to join
+            # - wait for all our automations to complete (or for the deadline)
             #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+            n = len(automations)
+            outcome = execute(automations, args.parallel, args.deadline, self.progress)
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
             up = sum(len(js['up']) for _, js in outcome.items())
-            logger.info(json.dumps(outcome) if args.json else '%d%% success (+%d pods)' % (pct, up))
+            self.summarize(success=pct, up=up)
+            if not self.streaming:
+                logger.info(json.dumps(outcome) if args.json else '%d%% success (+%d pods)' % (pct, up))
             return 0 if pct == 100 else 1
 
     return _Tool()
\ No newline at end of file
@@ -75,6 +75,24 @@ def go():
                     with open(token, 'rb') as f:
                         files[token] = f.read()
 
+            if self.streaming:
+
+                #
+                # - stream each pod output as soon as it comes back
+                #
+                def _emit(key, _, js, code):
+                    if code == 200:
+                        self.emit(key, js)
+
+                def _query(zk):
+                    replies = fire(zk, args.clusters[0], 'exec', subset=args.indices, headers=headers, files=files, timeout=args.timeout, callback=_emit)
+                    return len(replies), sum(1 for (_, _, code) in replies.values() if code == 200)
+
+                total, ok = run(proxy, _query)
+                pct = ((ok * 100) / total) if total else 0
+                self.summarize(total=total, replies=ok)
+                return 0 if pct == 100 else 1
+
             def _query(zk):
                 replies = fire(zk, args.clusters[0], 'exec', subset=args.indices, headers=headers, files=files, timeout=args.timeout)
                 return len(replies), {key: js for key, (_, js, code) in replies.items() if code == 200}
@@ -36,6 +36,8 @@ def go():
 
         tag = 'grep'
 
+        readonly = True
+
         def customize(self, parser):
 
             parser.add_argument('clusters', type=str, nargs='?', default='*', help='cluster(s) (can be a glob pattern, e.g foo*)')
@@ -43,6 +45,23 @@ def go():
 
         def body(self, args, _, proxy):
 
+            if self.streaming:
+
+                #
+                # - stream each pod as soon as it replies
+                #
+                def _emit(key, _, hints, code):
+                    if code == 200:
+                        self.emit(key, {'ip': hints['ip'], 'node': hints['node'], 'process': hints['process'], 'state': hints['state']})
+
+                def _query(zk):
+                    replies = fire(zk, args.clusters, 'info', callback=_emit)
+                    return len(replies), sum(1 for (_, _, code) in replies.values() if code == 200)
+
+                total, ok = run(proxy, _query)
+                self.summarize(total=total, replies=ok)
+                return 0
+
             def _query(zk):
                 replies = fire(zk, args.clusters, 'info')
                 return len(replies), [[key, '|', hints['ip'], '|', hints['node'], '|', hints['process'], '|', hints['state']]
@@ -16,74 +16,68 @@
 #
 import json
 import logging
-import os
 
 from ochopod.core.fsm import diagnostic
-from ochopod.core.utils import retry
-from random import choice
-from requests import get, delete, post
-from threading import Thread
-from toolset.io import fire, run
-from toolset.tool import Template
+from toolset.io import drain, fire, run, WARM
+from toolset.marathon import client
+from toolset.pick import victims
+from toolset.state import state
+from toolset.tool import Automation, execute, PARALLEL, Template
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
 
-class _Automation(Thread):
+class _Automation(Automation):
 
-    def __init__(self, proxy, cluster, indices, timeout):
-        super(_Automation, self).__init__()
+    def __init__(self, proxy, cluster, indices, timeout, count=None, pick='lifo'):
+        super(_Automation, self).__init__(cluster)
 
         self.cluster = cluster
+        self.count = count
         self.out = \
             {
                 'ok': False,
                 'down': []
             }
+        self.pick = pick
         self.proxy = proxy
         self.indices = indices
         self.timeout = max(timeout, 5)
 
-        self.start()
-
-    def run(self):
+    def workflow(self):
         try:
 
             #
-            # - we need to pass the framework master IPs around (ugly)
+            # - use the shared marathon client (leader routing, failover & retries)
+            # - application & task lookups are answered by the shared state cache (one bulk read for all apps)
+            #
+            cache = state()
+            marathon = client()
+
+            #
+            # - if -k is used pick that many victims (amongst the -i indices if specified)
             #
-            assert 'MARATHON_MASTER' in os.environ, '$MARATHON_MASTER not specified (check your portal pod)'
-            master = choice(os.environ['MARATHON_MASTER'].split(','))
-            headers = \
-                {
-                    'content-type': 'application/json',
-                    'accept': 'application/json'
-                }
+            if self.count is not None:
+                self.indices = victims(self.proxy, self.cluster, self.indices, self.count, self.pick)
+                assert self.indices, 'no pod to kill'
 
             #
             # - kill all (or part of) the pods using a POST /control/kill
             # - wait for them to be dead
             # - warning, /control/kill will block (hence the 5 seconds timeout)
             #
-            @retry(timeout=self.timeout, pause=0)
-            def _spin():
-                def _query(zk):
-                    replies = fire(zk, self.cluster, 'control/kill', subset=self.indices, timeout=self.timeout)
-                    return [(code, seq) for seq, _, code in replies.values()]
-
-                #
-                # - fire the request one or more pods
-                # - wait for every pod to report back a HTTP 410 (GONE)
-                # - this means the ochopod state-machine is now idling (e.g dead)
-                #
-                js = run(self.proxy, _query)
-                gone = sum(1 for code, _ in js if code == 410)
-                assert gone == len(js), 'at least one pod is still running'
-                return [seq for _, seq in js]
-
-            down = _spin()
+            self.checkpoint()
+
+            #
+            # - fire the request one or more pods
+            # - wait for every pod to report back a HTTP 410 (GONE)
+            # - this means the ochopod state-machine is now idling (e.g dead)
+            # - only the pods which did not report back yet are retried (with backoff)
+            #
+            down, pending = drain(self.proxy, self.cluster, self.indices, self.timeout)
             self.out['down'] = down
+            assert not pending, '%d pod(s) still running' % len(pending)
             assert down, 'the cluster is either invalid or empty'
             logger.debug('%s : %d dead pods -> %s' % (self.cluster, len(down), ', '.join(['#%d' % seq for seq in down])))
 
@@ -102,30 +96,32 @@ class _Automation(Thread):
 
             #
             # - go through each application
-            # - query the it and check how many tasks it currently has
+            # - check how many tasks it currently has (from the cache)
             # - the goal is to check if we should nuke the whole application or not
             #
             for app, tasks in rollup.items():
 
-                url = 'http://%s/v2/apps/%s/tasks' % (master, app)
-                reply = get(url, headers=headers)
-                code = reply.status_code
-                logger.debug('%s : -> %s (HTTP %d)' % (self.cluster, url, code))
-                assert code == 200, 'task lookup failed (HTTP %d)' % code
-                js = reply.json()
-
-                if len(tasks) == len(js['tasks']):
+                self.checkpoint()
+                if len(tasks) == len(cache.tasks(app)):
 
                     #
                     # - all the containers running for that application were reported as dead
                     # - issue a DELETE /v2/apps to nuke the whole thing
                     #
-                    url = 'http://%s/v2/apps/%s' % (master, app)
-                    reply = delete(url, headers=headers)
+                    reply = marathon.delete('/v2/apps/%s' % app)
                     code = reply.status_code
-                    logger.debug('%s : -> %s (HTTP %d)' % (self.cluster, url, code))
                     assert code == 200 or code == 204, 'application deletion failed (HTTP %d)' % code
 
+                    #
+                    # - if the application had a warm pool (scale --warm) nuke it as well
+                    #
+                    pool = '%s%s' % (app, WARM)
+                    if not app.endswith(WARM) and pool not in rollup and cache.app(pool):
+                        reply = marathon.delete('/v2/apps/%s' % pool)
+                        code = reply.status_code
+                        assert code == 200 or code == 204, 'warm pool deletion failed (HTTP %d)' % code
+                        cache.invalidate(pool)
+
                 else:
 
                     #
@@ -137,12 +133,12 @@ class _Automation(Thread):
                             'ids': tasks
                         }
 
-                    url = 'http://%s/v2/tasks/delete?scale=true' % master
-                    reply = post(url, data=json.dumps(js), headers=headers)
+                    reply = marathon.post('/v2/tasks/delete?scale=true', js)
                     code = reply.status_code
-                    logger.debug('-> %s (HTTP %d)' % (url, code))
                     assert code == 200 or code == 201, 'delete failed (HTTP %d)' % code
 
+                cache.invalidate(app)
+
             self.out['ok'] = True
 
         except AssertionError as failure:
@@ -153,11 +149,6 @@ class _Automation(Thread):
 
             logger.debug('%s : failed to kill -> %s' % (self.cluster, diagnostic(failure)))
 
-    def join(self, timeout=None):
-
-        Thread.join(self)
-        return self.out
-
 
 def go():
 
@@ -169,7 +160,8 @@ def go():
                 also be cherry-picked by specifying their sequence index and using -i. Any marathon application whose
                 containers are *all* dead will automatically get deleted. Please note you must by default use -i and
                 specify what containers to kill. If you want to kill multiple containers at once you must specify
-                --force.
+                --force. Alternatively -k can be used to kill a given number of containers, picked using --pick
+                (lifo by default, or fifo, load[:<metric>], crowded or slow).
 
                 This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
             '''
@@ -182,29 +174,37 @@ def go():
             parser.add_argument('-i', action='store', dest='indices', type=int, nargs='+', help='1+ indices')
             parser.add_argument('-j', action='store_true', dest='json', help='json output')
             parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='timeout in seconds')
+            parser.add_argument('--deadline', action='store', dest='deadline', type=int, help='overall deadline in seconds')
+            parser.add_argument('--parallel', action='store', dest='parallel', type=int, default=PARALLEL, help='max # of automations at once')
             parser.add_argument('--force', action='store_true', dest='force', help='enables wildcards')
+            parser.add_argument('-k', action='store', dest='count', type=int, help='# of pods to kill')
+            parser.add_argument('--pick', action='store', dest='pick', type=str, default='lifo', help='victim strategy with -k, e.g crowded')
 
         def body(self, args, _, proxy):
 
-            assert args.force or args.indices, 'you must specify --force if -i is not set'
+            assert args.force or args.indices or args.count, 'you must specify --force if -i or -k is not set'
 
             #
-            # - run the workflow proper (one thread per cluster identifier)
+            # - run the workflow proper (one automation per cluster identifier, --parallel at once)
             #
-            threads = {cluster: _Automation(
+            automations = [_Automation(
                 proxy,
                 cluster,
                 args.indices,
-                args.timeout) for cluster in args.clusters}
+                args.timeout,
+                args.count,
+                args.pick) for cluster in args.clusters]
 
             #
-            # - wait for all our threads to join
+            # - wait for all our automations to complete (or for the deadline)
             #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+            n = len(automations)
+            outcome = execute(automations, args.parallel, args.deadline, self.progress)
             dead = sum(len(js['down']) for _, js in outcome.items())
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
-            logger.info(json.dumps(outcome) if args.json else '%d%% success (-%d pods)' % (pct, dead))
+            self.summarize(success=pct, down=dead)
+            if not self.streaming:
+                logger.info(json.dumps(outcome) if args.json else '%d%% success (-%d pods)' % (pct, dead))
             return 0 if pct == 100 else 1
 
     return _Tool()
\ No newline at end of file
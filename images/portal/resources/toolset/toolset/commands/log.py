@@ -15,6 +15,7 @@
 # limitations under the License.
 #
 import logging
+import time
 
 from toolset.io import fire, run
 from toolset.tool import Template
@@ -22,6 +23,34 @@ from toolset.tool import Template
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: # of lines at the head & tail of each log used to anchor the follow cursors.
+ANCHOR = 16
+
+
+def _cursor(log):
+
+    return len(log), log[:ANCHOR], log[-ANCHOR:]
+
+
+def _fresh(log, cursor):
+
+    #
+    # - the cursor is the # of lines we already saw plus the first & last ANCHOR ones
+    # - if the head did not change the log only grew, whatever is past the count is new (even identical lines)
+    # - otherwise (e.g the pod log is capped or rotated) look the tail up again, starting from where we left
+    #   and walking back, if not found the whole log is new
+    #
+    seen, head, tail = cursor
+    if len(log) >= seen and log[:len(head)] == head:
+        return log[seen:]
+
+    n = len(tail)
+    for start in range(min(len(log), seen) - n, -1, -1):
+        if log[start:start + n] == tail:
+            return log[start + n:]
+
+    return log
+
 
 def go():
 
@@ -31,18 +60,77 @@ def go():
             '''
                 Dumps the internal ochopod log for the specified cluster(s). Individual containers can also be
                 cherry-picked by specifying their sequence index and using -i.
+
+                Use -f to follow the logs for -t seconds, in which case only the lines added since the previous poll
+                are displayed (prefixed by their pod). Any pod showing up while following is picked up as well.
             '''
 
         tag = 'log'
 
+        readonly = True
+
         def customize(self, parser):
 
             parser.add_argument('clusters', type=str, nargs='?', default='*', help='cluster(s) (can be a glob pattern, e.g foo*)')
             parser.add_argument('-l', action='store_true', dest='long', help='display the entire log')
             parser.add_argument('-i', '--indices', action='store', dest='indices', type=int, nargs='+', help='1+ indices')
+            parser.add_argument('-f', action='store_true', dest='follow', help='follows the logs')
+            parser.add_argument('-p', action='store', dest='period', type=float, default=2.0, help='polling period in seconds (with -f)')
+            parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='how long to follow the logs in seconds (with -f)')
 
         def body(self, args, _, proxy):
 
+            if args.follow:
+
+                #
+                # - poll each pod and only display what was added since the last poll (per-pod cursor)
+                # - the first poll is trimmed to the last 16 lines unless -l is set
+                # - stop after -t seconds (the portal runs us as a sub-process of a blocking /shell request)
+                #
+                ts = time.time()
+                cursors = {}
+                try:
+                    while time.time() - ts < args.timeout:
+
+                        def _query(zk):
+                            replies = fire(zk, args.clusters, 'log', subset=args.indices)
+                            return {key: log for key, (_, log, code) in replies.items() if code == 200}
+
+                        for key, log in sorted(run(proxy, _query).items()):
+                            lines = _fresh(log, cursors[key]) if key in cursors else (log if args.long else log[-16:])
+                            cursors[key] = _cursor(log)
+                            if not lines:
+                                continue
+
+                            if self.streaming:
+                                self.emit(key, lines)
+                            else:
+                                logger.info('\n'.join('%s | %s' % (key, line.rstrip('\n')) for line in lines))
+
+                        time.sleep(max(0, min(args.period, args.timeout - (time.time() - ts))))
+
+                except KeyboardInterrupt:
+                    pass
+
+                return 0
+
+            if self.streaming:
+
+                #
+                # - stream each pod log as soon as it comes back
+                #
+                def _emit(key, _, log, code):
+                    if code == 200:
+                        self.emit(key, log if args.long else log[-16:])
+
+                def _query(zk):
+                    replies = fire(zk, args.clusters, 'log', subset=args.indices, callback=_emit)
+                    return len(replies), sum(1 for (_, _, code) in replies.values() if code == 200)
+
+                total, ok = run(proxy, _query)
+                self.summarize(total=total, replies=ok)
+                return 0
+
             def _query(zk):
                 replies = fire(zk, args.clusters, 'log', subset=args.indices)
                 return len(replies), {key: log for key, (_, log, code) in replies.items() if code == 200}
@@ -17,6 +17,7 @@
 import json
 import logging
 
+from threading import Lock
 from toolset.io import fire, run
 from toolset.tool import Template
 
@@ -38,12 +39,43 @@ def go():
 
         tag = 'ls'
 
+        readonly = True
+
         def customize(self, parser):
 
             parser.add_argument('-j', action='store_true', dest='json', help='json output')
 
         def body(self, args, _, proxy):
 
+            if self.streaming:
+
+                #
+                # - tally the pods per cluster as they reply (without buffering their hints)
+                # - then stream one record per cluster
+                #
+                lock = Lock()
+                clusters = {}
+
+                def _tally(key, _, hints, code):
+                    if code == 200:
+                        with lock:
+                            item = clusters.setdefault(key.split(' ')[0], {'total': 0, 'running': 0, 'status': ''})
+                            item['total'] += 1
+                            item['running'] += hints['process'] == 'running'
+                            if 'status' in hints and hints['status']:
+                                item['status'] = hints['status']
+
+                def _query(zk):
+                    replies = fire(zk, '*', 'info', callback=_tally)
+                    return len(replies), sum(1 for (_, _, code) in replies.values() if code == 200)
+
+                total, ok = run(proxy, _query)
+                for key, item in sorted(clusters.items()):
+                    self.emit(key, item)
+
+                self.summarize(total=total, replies=ok)
+                return 0
+
             def _query(zk):
                 replies = fire(zk, '*', 'info')
                 return len(replies), {key: hints for key, (_, hints, code) in replies.items() if code == 200}
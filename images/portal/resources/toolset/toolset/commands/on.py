@@ -20,18 +20,17 @@ import os
 
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import retry
-from threading import Thread
 from toolset.io import fire, run
-from toolset.tool import Template
+from toolset.tool import Automation, execute, PARALLEL, Template
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
 
-class _Automation(Thread):
+class _Automation(Automation):
 
     def __init__(self, proxy, cluster, indices, timeout):
-        super(_Automation, self).__init__()
+        super(_Automation, self).__init__(cluster)
 
         self.cluster = cluster
         self.out = \
@@ -43,9 +42,7 @@ class _Automation(Thread):
         self.indices = indices
         self.timeout = max(timeout, 5)
 
-        self.start()
-
-    def run(self):
+    def workflow(self):
         try:
 
             def _query(zk):
@@ -66,11 +63,6 @@ class _Automation(Thread):
 
             logger.debug('%s : failed to switch on -> %s' % (self.cluster, diagnostic(failure)))
 
-    def join(self, timeout=None):
-
-        Thread.join(self)
-        return self.out
-
 def go():
 
     class _Tool(Template):
@@ -92,6 +84,8 @@ def go():
             parser.add_argument('-i', '--indices', action='store', dest='indices', type=int, nargs='+', help='1+ indices')
             parser.add_argument('-j', action='store_true', dest='json', help='json output')
             parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='timeout in seconds')
+            parser.add_argument('--deadline', action='store', dest='deadline', type=int, help='overall deadline in seconds')
+            parser.add_argument('--parallel', action='store', dest='parallel', type=int, default=PARALLEL, help='max # of automations at once')
             parser.add_argument('--force', action='store_true', dest='force', help='enables wildcards')
 
         def body(self, args, unknown, proxy):
@@ -99,22 +93,24 @@ def go():
             assert args.force or args.indices, 'you must specify --force if -i is not set'
 
             #
-            # - run the workflow proper (one thread per cluster identifier)
+            # - run the workflow proper (one automation per cluster identifier, --parallel at once)
             #
-            threads = {cluster: _Automation(
+            automations = [_Automation(
                 proxy,
                 cluster,
                 args.indices,
-                args.timeout) for cluster in args.clusters}
+                args.timeout) for cluster in args.clusters]
 
             #
-            # - wait for all our threads to join
+            # - wait for all our automations to complete (or for the deadline)
             #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+            n = len(automations)
+            outcome = execute(automations, args.parallel, args.deadline, self.progress)
             dead = sum(len(js['on']) for _, js in outcome.items())
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
-            logger.info(json.dumps(outcome) if args.json else '%d%% success (%d pods on)' % (pct, dead))
+            self.summarize(success=pct, on=dead)
+            if not self.streaming:
+                logger.info(json.dumps(outcome) if args.json else '%d%% success (%d pods on)' % (pct, dead))
             return 0 if pct == 100 else 1
 
     return _Tool()
\ No newline at end of file
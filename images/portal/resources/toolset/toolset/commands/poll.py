@@ -35,6 +35,8 @@ def go():
 
         tag = 'poll'
 
+        readonly = True
+
         def customize(self, parser):
 
             parser.add_argument('clusters', type=str, nargs='?', default='*', help='cluster(s) (can be a glob pattern, e.g foo*)')
@@ -42,6 +44,23 @@ def go():
 
         def body(self, args, _, proxy):
 
+            if self.streaming:
+
+                #
+                # - stream each pod as soon as it replies
+                #
+                def _emit(key, _, hints, code):
+                    if code == 200 and 'metrics' in hints:
+                        self.emit(key, hints['metrics'])
+
+                def _query(zk):
+                    replies = fire(zk, args.clusters, 'info', callback=_emit)
+                    return len(replies), sum(1 for (_, _, code) in replies.values() if code == 200)
+
+                total, ok = run(proxy, _query)
+                self.summarize(total=total, replies=ok)
+                return 0
+
             def _query(zk):
                 replies = fire(zk, args.clusters, 'info')
                 return len(replies), {key: hints['metrics'] for key, (index, hints, code) in replies.items() if code == 200 and 'metrics' in hints}
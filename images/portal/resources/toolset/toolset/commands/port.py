@@ -37,6 +37,8 @@ def go():
 
         tag = 'port'
 
+        readonly = True
+
         def customize(self, parser):
 
             parser.add_argument('port', type=int, nargs=1, help='port to lookup')
@@ -46,6 +48,22 @@ def go():
         def body(self, args, unknown, proxy):
 
             port = str(args.port[0])
+            if self.streaming:
+
+                #
+                # - stream each pod as soon as it replies
+                #
+                def _emit(key, _, hints, code):
+                    if code == 200 and port in hints['ports']:
+                        self.emit(key, {'ip': hints['ip'], 'public': hints['public'], 'ports': str(hints['ports'][port])})
+
+                def _query(zk):
+                    replies = fire(zk, args.clusters, 'info', callback=_emit)
+                    return len(replies), sum(1 for (_, _, code) in replies.values() if code == 200)
+
+                total, ok = run(proxy, _query)
+                self.summarize(total=total, replies=ok)
+                return 0
 
             def _query(zk):
                 replies = fire(zk, args.clusters, 'info')
@@ -16,24 +16,42 @@
 #
 import json
 import logging
-import os
+import time
 
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import retry
-from random import choice
-from requests import post, put
-from threading import Thread
-from toolset.io import fire, run
-from toolset.tool import Template
+from toolset.events import events
+from toolset.io import drain, fire, run, WARM
+from toolset.marathon import client
+from toolset.pick import victims
+from toolset.spec import FINGERPRINT
+from toolset.state import state
+from toolset.tool import Automation, execute, PARALLEL, Template
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Marathon application settings carried over when creating a warm pool.
+CLONED = ['cmd', 'args', 'cpus', 'mem', 'disk', 'env', 'container', 'constraints', 'labels', 'uris', 'backoffSeconds']
 
-class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, factor, fifo, group, timeout):
-        super(_Automation, self).__init__()
+def _split(js):
+
+    #
+    # - set the idle pods from the warm pools aside
+    # - any pod switched on out of a warm pool is accounted for as part of the main application
+    #
+    idle = [(seq, key[:-len(WARM)], task) for (seq, key, task, process) in js if key.endswith(WARM) and process == 'stopped']
+    live = [(seq, key[:-len(WARM)] if key.endswith(WARM) else key, task)
+            for (seq, key, task, process) in js if not (key.endswith(WARM) and process == 'stopped')]
+
+    return live, idle
+
+
+class _Automation(Automation):
+
+    def __init__(self, proxy, cluster, factor, fifo, group, timeout, warm=None, pick=None):
+        super(_Automation, self).__init__(cluster)
 
         self.cluster = cluster
         self.factor = factor
@@ -41,39 +59,76 @@ class _Automation(Thread):
         self.group = group
         self.out = \
             {
-                'ok': False
+                'ok': False,
+                'delta': 0
             }
+        self.pick = pick
         self.proxy = proxy
         self.timeout = max(timeout, 5)
-
-        self.start()
-
-    def run(self):
+        self.warm = warm
+
+    def refill(self, marathon, app, idle, promoted):
+
+        #
+        # - the warm pool is a clone of the application with ochopod_start set to false (e.g its pods are idle)
+        # - size it so that it holds --warm idle pods (or as many as before if not specified) on top of whatever
+        #   pods were switched on out of it
+        # - don't wait for the new pods, they'll show up in the background
+        #
+        pool = '%s%s' % (app, WARM)
+        cache = state()
+        live = cache.app(pool)
+        wanted = self.warm if self.warm is not None else idle
+        if live:
+            instances = live['instances'] - idle + promoted + wanted
+            if instances == live['instances']:
+                return
+
+            reply = marathon.put('/v2/apps/%s' % pool, {'instances': instances})
+
+        elif wanted:
+            spec = cache.app(app)
+            assert spec, 'application %s not found' % app
+            js = {key: value for key, value in spec.items() if key in CLONED}
+            js['id'] = pool
+            js['instances'] = wanted
+            js['env'] = dict(js.get('env', {}), ochopod_start='false')
+            js['labels'] = {key: value for key, value in js.get('labels', {}).items() if key != FINGERPRINT}
+            for mapping in js.get('container', {}).get('docker', {}).get('portMappings', None) or []:
+                mapping.pop('servicePort', None)
+
+            reply = marathon.post('/v2/apps', js)
+
+        else:
+            return
+
+        code = reply.status_code
+        assert code == 200 or code == 201, 'warm pool update failed (HTTP %d)' % code
+        cache.invalidate(pool)
+        logger.debug('%s : warm pool refilled (%d idle pods)' % (self.cluster, wanted))
+
+    def workflow(self):
         try:
 
             #
-            # - we need to pass the framework master IPs around (ugly)
+            # - use the shared marathon client (leader routing, failover & retries)
             #
-            assert 'MARATHON_MASTER' in os.environ, '$MARATHON_MASTER not specified (check your portal pod)'
-            master = choice(os.environ['MARATHON_MASTER'].split(','))
-            headers = \
-                {
-                    'content-type': 'application/json',
-                    'accept': 'application/json'
-                }
+            marathon = client()
 
             #
             # - first peek and see what pods we have
             #
             def _query(zk):
-                replies = fire(zk, self.cluster, 'info')
-                return [(seq, hints['application'], hints['task']) for (seq, hints, _) in replies.values()]
+                replies = fire(zk, self.cluster, 'info', warm=True)
+                return [(seq, hints['application'], hints['task'], hints['process']) for (seq, hints, _) in replies.values()]
 
             #
             # - remap a bit differently and get an ordered list of task identifiers
             # - we'll use that to kill the newest pods
+            # - the idle pods from the warm pool (if any) are set aside
             #
-            js = run(self.proxy, _query)
+            raw = run(self.proxy, _query)
+            js, idle = _split(raw)
             total = len(js)
             if self.group is not None:
 
@@ -110,32 +165,60 @@ class _Automation(Thread):
             #
             target = max(1, int(target))
             self.out['delta'] = target - total
-            if target > total:
+            self.checkpoint()
+            base = sum(1 for (_, key, _, _) in raw if key == app)
+            flip = [seq for (seq, key, _) in sorted(idle) if key == app]
+            promoted = []
+            if target > total and flip:
 
                 #
-                # - scale the application capacity up
+                # - first switch idle pods from the warm pool on using a POST /control/on (near instant)
+                #
+                def _on(zk):
+                    replies = fire(zk, self.cluster, 'control/on', subset=flip[:target - total], timeout=self.timeout)
+                    return [seq for seq, _, code in replies.values() if code == 200]
+
+                promoted = run(self.proxy, _on)
+                self.out['warm'] = len(promoted)
+                logger.debug('%s : %d pods switched on from the warm pool' % (self.cluster, len(promoted)))
+
+            if target > total + len(promoted):
+
+                #
+                # - scale the application capacity up (for whatever the warm pool could not cover)
                 #
                 js = \
                     {
-                        'instances': target
+                        'instances': base + target - total - len(promoted)
                     }
 
-                url = 'http://%s/v2/apps/%s' % (master, app)
-                reply = put(url, data=json.dumps(js), headers=headers)
+                feed = events()
+                reply = marathon.put('/v2/apps/%s' % app, js)
                 code = reply.status_code
-                logger.debug('-> %s (HTTP %d)' % (url, code))
                 assert code == 200 or code == 201, 'update failed (HTTP %d)' % code
+                state().invalidate(app)
+
+                #
+                # - if we have the event stream block until marathon reports the deployment as completed
+                # - the new pods should then register shortly, poll them at a faster pace
+                #
+                ts = time.time()
+                pause = 3
+                deployment = reply.json().get('deploymentId')
+                if feed is not None and deployment and feed.wait(lambda: feed.deployed(deployment) is not None, self.timeout):
+                    assert feed.deployed(deployment), 'marathon deployment failed'
+                    pause = 0.5
 
                 #
                 # - wait for all our new pods to be there
                 #
-                @retry(timeout=self.timeout, pause=3, default={})
+                @retry(timeout=max(self.timeout - (time.time() - ts), 1), pause=pause, default={})
                 def _spin():
                     def _query(zk):
-                        replies = fire(zk, self.cluster, 'info')
-                        return [(seq, hints['application'], hints['task']) for (seq, hints, _) in replies.values()]
+                        replies = fire(zk, self.cluster, 'info', warm=True)
+                        return [(seq, hints['application'], hints['task'], hints['process']) for (seq, hints, _) in replies.values()]
 
-                    js = run(self.proxy, _query)
+                    js, _ = _split(run(self.proxy, _query))
                     if self.group is not None:
                         nb_pods = sum(1 for (_, key, _) in js if key == app)
                     else:
@@ -149,31 +232,26 @@ class _Automation(Thread):
 
                 #
                 # - if the fifo switch is on make sure to pick the oldest pods for deletion
+                # - --pick overrides it and lets us phase out the least loaded pods (or the slowest ones, or the
+                #   ones on the most crowded nodes)
                 #
-                tasks = tasks[:total - target] if self.fifo else tasks[target:]
+                if self.pick:
+                    picked = victims(self.proxy, self.cluster, [seq for (seq, _) in tasks], total - target, self.pick)
+                    tasks = [(seq, task) for (seq, task) in tasks if seq in picked]
+                else:
+                    tasks = tasks[:total - target] if self.fifo else tasks[target:]
 
                 #
                 # - kill all (or part of) the pods using a POST /control/kill
                 # - wait for them to be dead
                 #
-                @retry(timeout=self.timeout, pause=0)
-                def _spin():
-                    def _query(zk):
-                        indices = [seq for (seq, _) in tasks]
-                        replies = fire(zk, self.cluster, 'control/kill', subset=indices, timeout=self.timeout)
-                        return [(code, seq) for seq, _, code in replies.values()]
-
-                    #
-                    # - fire the request one or more pods
-                    # - wait for every pod to report back a HTTP 410 (GONE)
-                    # - this means the ochopod state-machine is now idling (e.g dead)
-                    #
-                    js = run(self.proxy, _query)
-                    gone = sum(1 for code, _ in js if code == 410)
-                    assert gone == len(js), 'at least one pod is still running'
-                    return
-
-                _spin()
+                #
+                # - fire the request one or more pods
+                # - wait for every pod to report back a HTTP 410 (GONE)
+                # - this means the ochopod state-machine is now idling (e.g dead)
+                #
+                _, pending = drain(self.proxy, self.cluster, [seq for (seq, _) in tasks], self.timeout)
+                assert not pending, '%d pod(s) still running' % len(pending)
 
                 #
                 # - delete all the underlying tasks at once using POST v2/tasks/delete
@@ -183,11 +261,16 @@ class _Automation(Thread):
                         'ids': [task for (_, task) in tasks]
                     }
 
-                url = 'http://%s/v2/tasks/delete?scale=true' % master
-                reply = post(url, data=json.dumps(js), headers=headers)
+                reply = marathon.post('/v2/tasks/delete?scale=true', js)
                 code = reply.status_code
-                logger.debug('-> %s (HTTP %d)' % (url, code))
                 assert code == 200 or code == 201, 'delete failed (HTTP %d)' % code
+                state().invalidate(app)
+
+            #
+            # - top the warm pool up if we drew from it or if --warm is specified
+            #
+            if promoted or self.warm is not None:
+                self.refill(marathon, app, len(flip), len(promoted))
 
             self.out['ok'] = True
 
@@ -199,11 +282,6 @@ class _Automation(Thread):
 
             logger.debug('%s : failed to scale -> %s' % (self.cluster, diagnostic(failure)))
 
-    def join(self, timeout=None):
-
-        Thread.join(self)
-        return self.out
-
 
 def go():
 
@@ -217,7 +295,13 @@ def go():
                 specifies a pod index we'll use to pick the right application).
 
                 When scaling down (and phasing pods out) the --fifo can be used to kill the oldest pods first. The
-                default is to kill the most recent pods (LIFO).
+                default is to kill the most recent pods (LIFO). Victims can also be chosen using --pick, either the
+                least loaded pods (load or load:<metric>), the pods on the most crowded nodes (crowded) or the pods
+                slowest to answer (slow).
+
+                A warm pool of idle pods (e.g a clone of the application with ochopod_start set to false) can be kept
+                around using --warm. Scaling up will then first switch idle pods on (which is near instant) and refill
+                the pool in the background.
 
                 This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
             '''
@@ -231,29 +315,37 @@ def go():
             parser.add_argument('-g', action='store', type=int, dest='group', help='pod index')
             parser.add_argument('-j', action='store_true', dest='json', help='json output')
             parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='timeout in seconds')
+            parser.add_argument('--deadline', action='store', dest='deadline', type=int, help='overall deadline in seconds')
+            parser.add_argument('--parallel', action='store', dest='parallel', type=int, default=PARALLEL, help='max # of automations at once')
             parser.add_argument('--fifo', action='store_true', dest='fifo', help='fifo mode (scale down only)')
+            parser.add_argument('--warm', action='store', dest='warm', type=int, help='# of idle pods to keep in the warm pool')
+            parser.add_argument('--pick', action='store', dest='pick', type=str, help='victim strategy (scale down only), e.g load:cpu')
 
         def body(self, args, unknown, proxy):
 
             #
-            # - run the workflow proper (one thread per cluster)
+            # - run the workflow proper (one automation per cluster, --parallel at once)
             #
-            threads = {cluster: _Automation(
+            automations = [_Automation(
                 proxy,
                 cluster,
                 args.factor,
                 args.fifo,
                 args.group,
-                args.timeout) for cluster in args.clusters}
+                args.timeout,
+                args.warm,
+                args.pick) for cluster in args.clusters]
 
             #
-            # - wait for all our threads to join
+            # - wait for all our automations to complete (or for the deadline)
             #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+            n = len(automations)
+            outcome = execute(automations, args.parallel, args.deadline, self.progress)
             delta = sum(js['delta'] for _, js in outcome.items())
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
-            logger.info(json.dumps(outcome) if args.json else '%d%% success (%+d pods)' % (pct, delta))
+            self.summarize(success=pct, delta=delta)
+            if not self.streaming:
+                logger.info(json.dumps(outcome) if args.json else '%d%% success (%+d pods)' % (pct, delta))
             return 0 if pct == 100 else 1
 
     return _Tool()
\ No newline at end of file
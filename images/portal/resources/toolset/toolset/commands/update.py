@@ -16,30 +16,29 @@
 #
 import json
 import logging
-import os
-import shutil
-import tempfile
 import time
 import yaml
 
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import merge
 from ochopod.core.utils import retry
-from random import choice
-from subprocess import Popen, PIPE
-from threading import Thread
+from toolset.commands import deploy, kill, scale
+from toolset.health import gate, predicate, WINDOW
 from toolset.io import fire, run
-from toolset.tool import Template
+from toolset.prefetch import prefetch
+from toolset.spec import FINGERPRINT, render
+from toolset.state import state
+from toolset.tool import Automation, execute, PARALLEL, Template
 from yaml import YAMLError
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
 
-class _Automation(Thread):
+class _Automation(Automation):
 
-    def __init__(self, proxy, template, overrides, namespace, release, suffix, timeout, strict, kill_first, rolling, wait):
-        super(_Automation, self).__init__()
+    def __init__(self, proxy, template, overrides, namespace, release, suffix, timeout, strict, kill_first, rolling, wait, unchanged, pull, surge, unavailable, ready, force):
+        super(_Automation, self).__init__(template)
 
         self.namespace = namespace
         self.out = \
@@ -50,31 +49,24 @@ class _Automation(Thread):
             }
         self.overrides = overrides
         self.proxy = proxy
+        self.pull = pull
         self.release = release
         self.suffix = suffix
         self.strict = strict
+        self.surge = max(surge, 1)
         self.kill_first = kill_first
         self.template = template
         self.timeout = max(timeout, 5)
+        self.force = force
+        self.ready = predicate(ready) if ready else None
         self.rolling = rolling
+        self.unavailable = max(unavailable, 1)
+        self.unchanged = unchanged
         self.wait = max(wait, 0)
 
-        self.start()
-
-    def run(self):
+    def workflow(self):
         try:
 
-            #
-            # - we need to pass the framework master IPs around (ugly)
-            #
-            assert 'MARATHON_MASTER' in os.environ, '$MARATHON_MASTER not specified (check your portal pod)'
-            master = choice(os.environ['MARATHON_MASTER'].split(','))
-            headers = \
-                {
-                    'content-type': 'application/json',
-                    'accept': 'application/json'
-                }
-
             with open(self.template, 'r') as f:
 
                 #
@@ -109,13 +101,65 @@ class _Automation(Thread):
 
                 qualified = '%s.%s' % (self.namespace, cfg['cluster'])
 
-                # grep existing pods
+                #
+                # - grep the existing pods (one single fan-out, we keep their marathon application & node around)
+                #
                 def _query_existing(zk):
                     replies = fire(zk, qualified, 'info')
-                    return len(replies), [[key, seq]
-                                          for key, (seq, _, code) in sorted(replies.items()) if code == 200]
+                    return len(replies), [[key, seq, hints['application'], hints['node']]
+                                          for key, (seq, hints, code) in sorted(replies.items()) if code == 200]
 
-                total, js = run(self.proxy, _query_existing)
+                total, pods = run(self.proxy, _query_existing)
+                js = [[key, seq] for key, seq, _, _ in pods]
+                existing = [seq for _, seq in js]
+                hosts = {seq: node for _, seq, _, node in pods}
+
+                #
+                # - fingerprint what we would deploy and compare with the marathon application backing each pod
+                # - pods whose application carries the same fingerprint (or, for applications deployed before
+                #   fingerprinting, the same image & settings) did not drift
+                # - if --skip-unchanged is on and nothing drifted there is nothing to do
+                # - unless --force is used only replace the pods that drifted (this lets an interrupted update resume
+                #   where it stopped)
+                #
+                if total:
+
+                    def _current(app):
+                        live = cache.app(app) if app else None
+                        if not live:
+                            return False
+                        if FINGERPRINT in live.get('labels', {}):
+                            return live['labels'][FINGERPRINT] == target['labels'][FINGERPRINT]
+                        try:
+                            same = live['container']['docker']['image'] == target['container']['docker']['image']
+                            return same and json.loads(live['env']['pod']) == json.loads(target['env']['pod'])
+                        except (KeyError, TypeError, ValueError):
+                            return False
+
+                    cache = state()
+                    _, _, target = render(self.template, self.overrides, self.namespace, 1, self.release, self.suffix)
+                    drifted = [[key, seq] for key, seq, app, _ in pods if not _current(app)]
+                    logger.debug('%s : %d/%d pods drifted' % (self.template, len(drifted), len(js)))
+                    if self.unchanged and not drifted:
+                        self.out['ok'] = True
+                        self.out['skipped'] = True
+                        logger.debug('%s : unchanged, skipping' % self.template)
+                        return
+
+                    if not self.force:
+                        if not drifted:
+                            self.out['ok'] = True
+                            logger.debug('%s : all pods up to date' % self.template)
+                            return
+
+                        js = drifted
+
+                    #
+                    # - if --prefetch is on pull the new image first on the nodes running the pods we will replace
+                    #
+                    if self.pull:
+                        replaced = sorted(set(hosts[seq] for _, seq in js))
+                        prefetch(target['container']['docker']['image'], replaced, self.timeout, self.checkpoint)
 
                 if total == 0:
                     self.out['up'] = []
@@ -123,49 +167,40 @@ class _Automation(Thread):
                     self.out['ok'] = False
                     logger.info('%s : no pod to update ' % self.template)
                 else:
-                    env = os.environ
-                    hints = json.loads(env['ochopod'])
-                    env['OCHOPOD_ZK'] = hints['zk']
-
-
-                    def _run_command(command, need_template = False):
-                        logger.debug("Running command: %s" % command)
-                        try:
-                            out = []
-                            tmp = tempfile.mkdtemp()
-                            if need_template:
-                                shutil.copy(self.template, tmp)
-                            pid = Popen('toolset %s -j' % command, shell=True, stdout=PIPE, stderr=None, env=env, cwd=tmp)
-
-                            while 1:
-                                code = pid.poll()
-                                line = pid.stdout.readline()
-                                if not line and code is not None:
-                                    break
-                                elif line:
-                                    out += [line.rstrip('\n')]
-
-                            logger.debug("Command output: %s" % ' '.join(out))
-                            ok = pid.returncode == 0
-                            return ok, json.loads(' '.join(out))
-                        finally:
-                            #
-                            # - make sure to cleanup our temporary directory
-                            #
-                            shutil.rmtree(tmp)
-
-
+                    #
+                    # - run the deploy/kill/scale workflows in-process (e.g same zookeeper session, same marathon
+                    #   client and no sub-process to spawn)
+                    # - each helper returns whether it succeeded plus its outcome keyed like the tool would
+                    #
                     def _deploy_command(nb_pods):
-                        return _run_command('deploy %s -n %s -t %d -p %d %s' % (self.template, self.namespace, self.timeout, nb_pods, "--strict" if self.strict else ""), True)
+                        out = self.inline(deploy._Automation(
+                            self.proxy,
+                            self.template,
+                            self.overrides,
+                            self.namespace,
+                            nb_pods,
+                            self.release,
+                            self.suffix,
+                            self.timeout,
+                            self.strict,
+                            False,
+                            False))
+                        return out['ok'], {self.template: out}
 
                     def _kill_command(seq):
-                        return _run_command('kill %s -t %d -i %s' % (qualified, self.timeout, ' '.join(str(x) for x in seq)))
+                        out = self.inline(kill._Automation(self.proxy, qualified, seq, self.timeout))
+                        return out['ok'], {qualified: out}
 
                     def _scale_command(seq, nb_pods):
-                        return _run_command('scale %s -g %d -f @%d -t %d' % (qualified, seq, nb_pods, self.timeout))
+                        out = self.inline(scale._Automation(self.proxy, qualified, '@%d' % nb_pods, False, seq, self.timeout))
+                        return out['ok'], {qualified: out}
 
                     def _grep_command():
-                        return _run_command('grep %s' % qualified)
+
+                        #
+                        # - go through fire() rather than lookup() to skip the idle pods from the warm pool (if any)
+                        #
+                        return True, run(self.proxy, lambda zk: fire(zk, qualified, 'info'))
 
                     def _diff(a, b):
                         b = set(b)
@@ -174,16 +209,17 @@ class _Automation(Thread):
 
 
                     def _kill_deploy(seq, counter = 0):
+                        self.checkpoint()
                         ok = False
                         pod_log = "%s #%s" % (qualified, ' #'.join(str(x) for x in seq))
                         nb_pods_log = "%d pod%s" % (len(seq), "" if len(seq) <= 1 else "s")
 
                         def _scale():
                             # Sale and then retrieve new pod index (it is not returned by the scale command).
-                            scale_result, _ = _scale_command(self.out['up'][0], counter + 1)
+                            scale_result, _ = _scale_command(self.out['up'][0], counter + len(seq))
                             #_, new_js = run(self.proxy, _query_existing)
-                            seq_orig = [i[1] for i in js]
-                            seq_added_already = self.out['up']
+                            seq_orig = existing
+                            seq_added_already = list(self.out['up'])
                             #seq_new = [i[1] for i in new_js]
                             
                             # It might take some time until ne new pod is available through grep command.
@@ -194,15 +230,15 @@ class _Automation(Thread):
                                 #seq_new = [i[1] for i in js_new]                   
                                 
                                 seq_diff = _diff(seq_new, seq_orig + seq_added_already)
-                                assert len(seq_diff) == 1, 'exactly one pod should have been added'
-                                return seq_diff[0]
+                                assert len(seq_diff) == len(seq), 'exactly %d pod(s) should have been added' % len(seq)
+                                return seq_diff
                                 
                                 
                             new_pod_seq = _get_new_pod_seq()
                             
-                            self.out['up'].append(new_pod_seq)
+                            self.out['up'].extend(new_pod_seq)
                             if scale_result:
-                                logger.debug("Replacement pod for %s successfully created (%s), new one(s): #%d" % (pod_log, nb_pods_log, new_pod_seq))
+                                logger.debug("Replacement pod for %s successfully created (%s), new one(s): #%s" % (pod_log, nb_pods_log, ' #'.join(str(x) for x in new_pod_seq)))
                                 return True
                             else:
                                 logger.info("Failed to scale up cluster to create replacement pod for %s" % pod_log)
@@ -243,13 +279,30 @@ class _Automation(Thread):
                             else:
                                 return _scale()
 
+                        def _healthy(before):
+
+                            #
+                            # - if --ready is used gate on the new pods satisfying the readiness predicate
+                            # - the -w value (if any) is used as the initial stabilization window
+                            #
+                            if not self.ready:
+                                return True
+
+                            fresh = self.out['up'][before:]
+                            window = self.wait if self.wait > 0 else WINDOW
+                            healthy = gate(self.proxy, qualified, fresh, self.ready, self.timeout, window, self.checkpoint)
+                            if not healthy:
+                                logger.info("New pod(s) #%s not ready, aborting" % ' #'.join(str(x) for x in fresh))
+                            return healthy
+
+                        before = len(self.out['up'])
                         if self.kill_first:
                             if _kill():
-                                ok = _deploy_or_scale()
+                                ok = _deploy_or_scale() and _healthy(before)
                             else:
                                 ok = False
                         else:
-                            if _deploy_or_scale():
+                            if _deploy_or_scale() and _healthy(before):
                                 ok = _kill()
                             else:
                                 ok = False
@@ -257,12 +310,27 @@ class _Automation(Thread):
                         return ok
 
                     if self.rolling:
-                        logger.debug("Rolling update: ON")
+
+                        #
+                        # - replace the pods in batches (--max-surge pods at once when deploying first, --max-unavailable
+                        #   when killing first)
+                        # - each batch starts as soon as the previous one is up
+                        #
+                        batch = self.unavailable if self.kill_first else self.surge
+                        batches = [js[n:n + batch] for n in range(0, len(js), batch)]
+                        logger.debug("Rolling update: ON (%d batch(es) of up to %d pod(s))" % (len(batches), batch))
                         ok_rolling = True
-                        for counter, (_, seq) in enumerate(js):
-                            status = _kill_deploy([seq], counter)
+                        for counter, chunk in enumerate(batches):
+                            status = _kill_deploy([i[1] for i in chunk], len(self.out['up']))
                             ok_rolling = ok_rolling and status
-                            if self.wait > 0 and counter < len(js) - 1:
+
+                            #
+                            # - if gating on readiness stop right there upon failure (don't touch the remaining pods)
+                            # - no need to sleep either (the stabilization window takes care of it)
+                            #
+                            if self.ready and not status:
+                                break
+                            if not self.ready and self.wait > 0 and counter < len(batches) - 1:
                                 logger.debug("Now waiting for %d seconds" % self.wait)
                                 time.sleep(self.wait)
                                 logger.debug("Done waiting")
@@ -288,11 +356,6 @@ class _Automation(Thread):
 
             logger.debug('%s : failed to update -> %s' % (self.template, diagnostic(failure)))
 
-    def join(self, timeout=None):
-
-        Thread.join(self)
-        return self.out
-
 
 def go():
 
@@ -300,15 +363,28 @@ def go():
 
         help = \
             '''
-                Updates a cluster by replacing all of the pods in that cluster with. The existing cluster is determined by the cluster name in the YAML definition together
-                with the specified namespace. If the cluster does not exist, no action is taken. If a cluster with the appropriate name exists, then all of its pods are killed
-                and replaced by new ones that are deployed using the provided YAML definition. I.e. the cluster size does not change after the update is completed.
+                Updates a cluster by replacing its pods with new ones deployed from the provided YAML definition. The existing cluster is determined by the cluster name in the
+                YAML definition together with the specified namespace. If the cluster does not exist, no action is taken. If a cluster with the appropriate name exists, then
+                its drifted pods are killed and replaced by new ones. I.e. the cluster size does not change after the update is completed.
+
+                Note that by default only the pods which drifted from the provided YAML definition are replaced (pods already up to date are left alone). Use --force to
+                replace all of the pods as update used to do.
 
                 Rolling updates (i.e. pods are replaced one by one) are supported via the --rolling switch. With rolling updates, it is also possible
-                to specify a wait time between pod updates (see the -w parameter).
+                to specify a wait time between pod updates (see the -w parameter). Pods can be replaced in batches using --max-surge (up to K new pods
+                deployed before the old ones are killed) or --max-unavailable when --kill_first is used (up to K pods killed before being replaced).
 
                 By default, new pods are deployed before old ones are killed. It is possible to kill old pods first vie the --kill_first switch.
 
+                The progression can be gated on the new pods being ready using --ready followed by 1+ expressions evaluated against their /info hints (e.g
+                state=leader|follower, status~^ok or metrics.errors<1). The new pods must stay ready for a stabilization window (-w, 5 seconds by default)
+                which widens upon regression. The update is aborted if they never stabilize.
+
+                A pod drifted when its marathon application was deployed from a different specification (e.g different fingerprint), which means a failed or
+                interrupted update can simply be re-run.
+
+                Using --skip-unchanged will leave alone any cluster whose pods already run the provided YAML definition (e.g same specification fingerprint).
+
                 This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
             '''
 
@@ -323,9 +399,17 @@ def go():
             parser.add_argument('-r', action='store', dest='release', type=str, help='docker image release tag')
             parser.add_argument('-s', action='store', dest='suffix', type=str, help='optional cluster suffix')
             parser.add_argument('-t', action='store', dest='timeout', type=int, default=60, help='timeout in seconds')
+            parser.add_argument('--deadline', action='store', dest='deadline', type=int, help='overall deadline in seconds')
+            parser.add_argument('--parallel', action='store', dest='parallel', type=int, default=PARALLEL, help='max # of automations at once')
             parser.add_argument('-w', action='store', dest='wait', type=int, default=0, help='when doing rolling updates, time in seconds to wait between updating pods (default to 0)')
             parser.add_argument('--kill_first', action='store_true', dest='kill_first', help='kills the pod before deploying the new one (default is to first deploy then kill the old pod)')
             parser.add_argument('--rolling', action='store_true', dest='rolling', help='updates pods one by one')
+            parser.add_argument('--force', action='store_true', dest='force', help='replaces all the pods, even those already up to date (default is to only replace the drifted ones)')
+            parser.add_argument('--ready', action='store', dest='ready', type=str, nargs='+', help='readiness expression(s) gating the progression, e.g state=leader|follower')
+            parser.add_argument('--max-surge', action='store', dest='surge', type=int, default=1, help='when doing rolling updates, max # of extra pods at once (default to 1)')
+            parser.add_argument('--max-unavailable', action='store', dest='unavailable', type=int, default=1, help='when doing rolling updates with --kill_first, max # of pods down at once (default to 1)')
+            parser.add_argument('--skip-unchanged', action='store_true', dest='unchanged', help='skips clusters already running this definition')
+            parser.add_argument('--prefetch', action='store_true', dest='prefetch', help='pulls the new image on the nodes first')
             parser.add_argument('--strict', action='store_true', dest='strict', help='waits until all pods are running')
 
         def body(self, args, _, proxy):
@@ -355,9 +439,9 @@ def go():
                         assert 0, '%s is invalid (line %s, column %s)' % (args.overrides, mark.line+1, mark.column+1)
 
             #
-            # - run the workflow proper (one thread per container definition)
+            # - run the workflow proper (one automation per container definition, --parallel at once)
             #
-            threads = {template: _Automation(
+            automations = [_Automation(
                 proxy,
                 template,
                 overrides,
@@ -368,17 +452,25 @@ def go():
                 args.strict,
                 args.kill_first,
                 args.rolling,
-                args.wait) for template in args.containers}
+                args.wait,
+                args.unchanged,
+                args.prefetch,
+                args.surge,
+                args.unavailable,
+                args.ready,
+                args.force) for template in args.containers]
 
             #
-            # - wait for all our threads to join
+            # - wait for all our automations to complete (or for the deadline)
             #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+            n = len(automations)
+            outcome = execute(automations, args.parallel, args.deadline, self.progress)
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
             up = sum(len(js['up']) for _, js in outcome.items())
             down = sum(len(js['down']) for _, js in outcome.items())
-            logger.info(json.dumps(outcome) if args.json else '%d%% success (+%d pods, -%d pods)' % (pct, up, down))
+            self.summarize(success=pct, up=up, down=down)
+            if not self.streaming:
+                logger.info(json.dumps(outcome) if args.json else '%d%% success (+%d pods, -%d pods)' % (pct, up, down))
             return 0 if pct == 100 else 1
 
     return _Tool()
@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import requests
+import time
+
+from ochopod.core.fsm import diagnostic
+from requests.exceptions import RequestException
+from threading import Condition, Event, Lock, RLock, Thread
+from toolset.marathon import client
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Time in seconds we wait for the event stream to be established before giving up (and falling back on polling).
+CONNECT = 3.0
+
+#: Terminal mesos task states (the task is removed from our tables when reaching any of those).
+TERMINAL = ['TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLED', 'TASK_LOST', 'TASK_ERROR']
+
+
+class Events(Thread):
+    """
+    Subscriber to the marathon /v2/events server-sent event stream. Task states (per application) and deployment
+    outcomes are tracked in memory which lets the automations block until something happens (e.g N tasks of app X
+    are running or deployment Y completed) instead of polling the pods.
+
+    Please note only the tasks we got an event for since subscribing are tracked.
+    """
+
+    def __init__(self, master):
+        super(Events, self).__init__()
+
+        self.cond = Condition(RLock())
+        self.connected = Event()
+        self.daemon = True
+        self.deployments = {}
+        self.master = master
+        self.tasks = {}
+
+        self.start()
+
+    def run(self):
+
+        while True:
+            try:
+
+                #
+                # - open the event stream (no read timeout, we'll block until the next event)
+                # - re-connect if it drops
+                #
+                url = 'http://%s/v2/events' % self.master
+                reply = requests.get(url, stream=True, headers={'accept': 'text/event-stream'}, timeout=(CONNECT, None))
+                assert reply.status_code == 200, 'event subscription failed (HTTP %d)' % reply.status_code
+                logger.debug('-> %s (subscribed)' % url)
+                self.connected.set()
+
+                kind = None
+                for line in reply.iter_lines(chunk_size=1):
+                    if line.startswith('event:'):
+                        kind = line[6:].strip()
+                    elif line.startswith('data:'):
+                        self._process(kind, json.loads(line[5:]))
+                    elif not line:
+                        kind = None
+
+            except (AssertionError, RequestException, ValueError) as failure:
+
+                logger.debug('event stream @ %s dropped (%s)' % (self.master, failure))
+
+            except Exception as failure:
+
+                #
+                # - anything else (e.g an unexpected event payload) must not kill the subscriber
+                # - drop the stream and re-connect
+                #
+                logger.debug('event stream @ %s dropped (%s)' % (self.master, diagnostic(failure)))
+
+            self.connected.clear()
+            time.sleep(1.0)
+
+    def _process(self, kind, js):
+
+        kind = js['eventType'] if 'eventType' in js else kind
+        with self.cond:
+            if kind == 'status_update_event':
+
+                #
+                # - track the task state per application
+                # - marathon application ids are absolute while our pod hints are not (e.g no leading /)
+                #
+                app = js['appId'].lstrip('/')
+                tasks = self.tasks.setdefault(app, {})
+                if js['taskStatus'] in TERMINAL:
+                    tasks.pop(js['taskId'], None)
+                else:
+                    tasks[js['taskId']] = (js['taskStatus'], js.get('version'))
+
+            elif kind == 'deployment_success' or kind == 'deployment_failed':
+
+                self.deployments[js['id']] = kind == 'deployment_success'
+
+            else:
+                return
+
+            self.cond.notify_all()
+
+    def running(self, app, version=None):
+        """
+        Returns the number of tasks for the specified application we know to be running (optionally for a given
+        application version only).
+        """
+
+        with self.cond:
+            tasks = self.tasks[app].values() if app in self.tasks else []
+            return sum(1 for state, tag in tasks if state == 'TASK_RUNNING' and (version is None or tag == version))
+
+    def deployed(self, deployment):
+        """
+        Returns True/False if the deployment succeeded/failed and None if it is still in progress.
+        """
+
+        with self.cond:
+            return self.deployments[deployment] if deployment in self.deployments else None
+
+    def wait(self, predicate, timeout):
+        """
+        Blocks until the predicate (invoked with no arguments) returns something true or the timeout expires. The
+        predicate outcome is returned.
+        """
+
+        ts = time.time()
+        with self.cond:
+            while True:
+                out = predicate()
+                left = timeout - (time.time() - ts)
+                if out or left <= 0:
+                    return out
+
+                #
+                # - the condition uses a re-entrant lock (running() and deployed() grab it as well)
+                #
+                self.cond.wait(min(left, 1.0))
+
+
+#: Our shared subscriber (lazily created).
+_feed = {}
+
+#: Lock guarding the subscriber creation.
+_lock = Lock()
+
+
+def events():
+    """
+    Returns the event subscriber shared by all the automations (subscribing on the first call) or None if the event
+    stream could not be established, in which case the caller should fall back on polling.
+    """
+
+    with _lock:
+        if 'feed' not in _feed:
+
+            #
+            # - only wait for the subscription once (no need to slow every automation down if the stream is
+            #   unavailable)
+            #
+            _feed['feed'] = Events(client().best())
+            _feed['feed'].connected.wait(CONNECT)
+
+        feed = _feed['feed']
+
+    return feed if feed.connected.is_set() else None
@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import re
+import time
+
+from toolset.io import fire, run
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Default stabilization window in seconds (the pods must stay ready that long).
+WINDOW = 5.0
+
+#: Pause in seconds between two probes.
+PAUSE = 1.0
+
+#: Maximum # of regressions (e.g ready pods going unready) tolerated before aborting.
+FLAPS = 3
+
+#: Supported operators (the one found first in the expression wins, the longest one in case of a tie).
+OPERATORS = ['!=', '<=', '>=', '=', '~', '<', '>']
+
+
+def predicate(expressions):
+    """
+    Compiles a list of readiness expressions into a predicate taking the pod hints (as returned by /info) and
+    returning True if they all hold. Each expression is <key><operator><value> where the key is a dotted path into the
+    hints (e.g metrics.errors) and the operator one of:
+
+     - = or != : the value is (or is not) one of the | separated alternatives (e.g state=leader|follower)
+     - ~ : the value matches the regular expression (e.g status~^ok)
+     - <, <=, > or >= : numerical comparison (e.g metrics.latency<250)
+
+    Please note a missing key will evaluate to False.
+    """
+
+    checks = []
+    for expression in expressions:
+        #
+        # - split on the leftmost operator (e.g status~a<b is a regex), favoring <= over < and so on
+        #
+        ops = [(expression.index(op), -len(op), op) for op in OPERATORS if op in expression]
+        assert ops, 'invalid readiness expression "%s"' % expression
+        _, _, op = min(ops)
+        key, value = [token.strip() for token in expression.split(op, 1)]
+        checks += [(key.split('.'), op, value)]
+
+    def _lookup(hints, path):
+        for token in path:
+            if not isinstance(hints, dict) or token not in hints:
+                return None
+            hints = hints[token]
+        return hints
+
+    def _check(hints):
+        for path, op, value in checks:
+            found = _lookup(hints, path)
+            if found is None:
+                return False
+            if op == '=' and str(found) not in value.split('|'):
+                return False
+            elif op == '!=' and str(found) in value.split('|'):
+                return False
+            elif op == '~' and not re.search(value, str(found)):
+                return False
+            elif op in ['<', '<=', '>', '>=']:
+                try:
+                    lhs, rhs = float(found), float(value)
+                except (TypeError, ValueError):
+                    return False
+                if not {'<': lhs < rhs, '<=': lhs <= rhs, '>': lhs > rhs, '>=': lhs >= rhs}[op]:
+                    return False
+        return True
+
+    return _check
+
+
+def gate(proxy, cluster, subset, check, timeout, window=WINDOW, checkpoint=None):
+    """
+    Blocks until all the specified pods satisfy the readiness predicate for a whole stabilization window. The window
+    adapts : each regression (ready pods going unready) doubles it while too many regressions abort. Returns True if
+    the pods are deemed healthy, False upon timeout or abort.
+    """
+
+    ts = time.time()
+    flaps = 0
+    since = None
+    window = max(window, PAUSE)
+    while time.time() - ts < timeout:
+
+        if checkpoint:
+            checkpoint()
+
+        def _query(zk):
+            replies = fire(zk, cluster, 'info', subset=subset)
+            return [check(hints) for _, hints, code in replies.values() if code == 200]
+
+        js = run(proxy, _query)
+        ready = len(js) == len(subset) and all(js)
+        now = time.time()
+        if ready:
+
+            #
+            # - all ready, wait for the window to elapse before declaring victory
+            #
+            since = since if since is not None else now
+            if now - since >= window:
+                logger.debug('%s : %d pods ready for %d seconds' % (cluster, len(subset), int(window)))
+                return True
+
+        elif since is not None:
+
+            #
+            # - regression while stabilizing, widen the window (or give up if this keeps on happening)
+            #
+            flaps += 1
+            since = None
+            window *= 2
+            logger.debug('%s : readiness regression #%d (window now %d seconds)' % (cluster, flaps, int(window)))
+            if flaps > FLAPS:
+                return False
+
+        time.sleep(PAUSE)
+
+    logger.debug('%s : pods still not ready after %d seconds' % (cluster, int(timeout)))
+    return False
\ No newline at end of file
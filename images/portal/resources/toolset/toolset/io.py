@@ -17,7 +17,9 @@
 import fnmatch
 import json
 import logging
+import os
 import pykka
+import random
 import requests
 import time
 
@@ -26,29 +28,180 @@ from kazoo.client import KazooClient, KazooState
 from kazoo.exceptions import NoNodeError
 from ochopod.core.core import ROOT
 from ochopod.core.fsm import diagnostic, shutdown, spin_lock, Aborted, FSM
+from os.path import dirname
 from pykka import Timeout
 from requests.exceptions import Timeout as HTTPTimeout
-from threading import Event, Thread
+from Queue import Queue, Empty
+from tempfile import gettempdir, mkstemp
+from threading import BoundedSemaphore, Event, Thread
 
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Maximum number of concurrent HTTP requests to the pods (e.g worker threads per fire() invocation).
+FANOUT = int(os.environ['TOOLSET_FANOUT']) if 'TOOLSET_FANOUT' in os.environ else 64
 
-def lookup(zk, regex, subset=None):
+#: Bounds the concurrent HTTP requests across all the fire() invocations as well.
+_slots = BoundedSemaphore(FANOUT)
+
+#: Initial backoff in seconds before re-firing at a pod (doubled on each attempt and jittered).
+BACKOFF = 0.5
+
+#: Maximum backoff in seconds between two attempts on the same pod.
+CEILING = 8.0
+
+#: Suffix of the marathon applications holding warm pools (idle pods registered in the cluster, see scale --warm).
+WARM = '-warm'
+
+#: Registry snapshot written upon live lookups (read-only tools fall back on it when zookeeper is degraded).
+SNAPSHOT = os.environ['OCHOPOD_SNAPSHOT'] if 'OCHOPOD_SNAPSHOT' in os.environ else '%s/ochopod-registry.json' % gettempdir()
+
+#: Minimum time in seconds between two snapshot writes (per ensemble).
+PERSIST = 5.0
+
+#: Last time we wrote the snapshot of each ensemble.
+_persisted = {}
+
+#: Age in seconds of the oldest registry snapshot we had to serve so far (None as long as zookeeper is healthy).
+degraded = {'age': None}
+
+#: Time at which the first zookeeper query was answered (None until then, used by --profile).
+answered = {'ts': None}
+
+
+def _snapshot(site):
+
+    #
+    # - each named ensemble gets its own snapshot file
+    #
+    return SNAPSHOT if site is None else '%s-%s.json' % (SNAPSHOT[:-5] if SNAPSHOT.endswith('.json') else SNAPSHOT, site)
+
+
+class Snapshot():
+    """
+    Read-only stand-in for the kazoo client answering get_children() and get() from the last known registry state
+    (e.g whatever lookup() persisted when zookeeper was still reachable). The available flag is off if there is
+    no (readable) snapshot to serve from.
+    """
+
+    def __init__(self, site=None):
+
+        self.available = False
+        self.clusters = {}
+        self.oldest = None
+        self.site = site
+        try:
+            with open(_snapshot(site), 'r') as f:
+                self.clusters = json.loads(f.read())
+                self.available = True
+
+        except (IOError, ValueError):
+            pass
+
+    @property
+    def age(self):
+        return time.time() - self.oldest if self.oldest else 0
+
+    def get_children(self, path):
+
+        if path == ROOT:
+            return self.clusters.keys()
+
+        return self._pods(path).keys()
+
+    def get(self, path):
+
+        kid = path.split('/')[-1]
+        pods = self._pods(dirname(path))
+        if kid not in pods:
+            raise NoNodeError
+
+        return pods[kid], None
+
+    def _pods(self, path):
+
+        #
+        # - the path is always <ROOT>/<cluster>/pods
+        # - keep track of the oldest cluster we read from (this is what we report as the staleness)
+        #
+        cluster = path[len(ROOT) + 1:].split('/')[0]
+        if cluster not in self.clusters:
+            raise NoNodeError
+
+        ts = self.clusters[cluster]['ts']
+        self.oldest = min(self.oldest, ts) if self.oldest else ts
+        return self.clusters[cluster]['pods']
+
+
+def _persist(site, clusters, seen):
+
+    #
+    # - rate-limit the writes (tools polling the registry would otherwise rewrite the file on each lookup)
+    #
+    now = time.time()
+    if now - _persisted.get(site, 0) < PERSIST:
+        return
+
+    _persisted[site] = now
+    try:
+
+        #
+        # - merge what we just read with the previous snapshot
+        # - drop any cluster that is not registered anymore
+        # - write to a temporary file first and rename (other toolset processes may be reading it)
+        #
+        path = _snapshot(site)
+        registry = {cluster: blk for cluster, blk in Snapshot(site).clusters.items() if cluster in clusters}
+        registry.update(seen)
+        fd, tmp = mkstemp(dir=dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(registry))
+
+        os.rename(tmp, path)
+
+    except (IOError, OSError) as failure:
+
+        logger.debug('unable to persist the registry snapshot (%s)' % failure)
+
+
+def lookup(zk, regex, subset=None, kids=None):
 
     pods = {}
+    seen = {}
+    only = kids
     ts = time.time()
     try:
+
+        #
+        # - if the client is bound to a named ensemble (federated lookups) prefix the keys with the site
+        # - a site qualified regex (e.g east:foo*) will only match its own ensemble(s)
+        #
+        site = getattr(zk, 'site', None)
+        if site is not None and ':' in regex:
+            where, regex = regex.split(':', 1)
+            if not fnmatch.fnmatch(site, where):
+                return {}
+
         #
         # - use a glob style regex to match the cluster (handy to retrieve multiple
         #   clusters at once)
         #
-        clusters = [cluster for cluster in zk.get_children(ROOT) if fnmatch.fnmatch(cluster, regex)]
+        everything = zk.get_children(ROOT)
+        clusters = [cluster for cluster in everything if fnmatch.fnmatch(cluster, regex)]
         for cluster in clusters:
             kids = zk.get_children('%s/%s/pods' % (ROOT, cluster))
+            seen[cluster] = {'ts': ts, 'pods': {}}
             for kid in kids:
+
+                #
+                # - if a set of pod znodes is specified skip the others (no need to read them)
+                #
+                if only is not None and kid not in only:
+                    continue
+
                 js, _ = zk.get('%s/%s/pods/%s' % (ROOT, cluster, kid))
+                seen[cluster]['pods'][kid] = js
                 hints = \
                     {
                         'id': kid,
@@ -62,7 +215,15 @@ def lookup(zk, regex, subset=None):
                 hints.update(json.loads(js))
                 seq = hints['seq']
                 if not subset or seq in subset:
-                    pods['%s #%d' % (cluster, seq)] = hints
+                    pods['%s%s #%d' % ('%s:' % site if site else '', cluster, seq)] = hints
+
+        #
+        # - if we are talking to the live ensemble update the snapshot with what we just read
+        # - only do so for the read-only tools (they are the only ones falling back on it)
+        # - skip partial reads (e.g restricted to a set of pod znodes)
+        #
+        if getattr(zk, 'persist', False) and only is None:
+            _persist(site, everything, seen)
 
     except NoNodeError:
         pass
@@ -72,37 +233,75 @@ def lookup(zk, regex, subset=None):
     return pods
 
 
-def fire(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None):
+def idle(hints):
+    """
+    Returns True if the /info hints are those of an idle pod from a warm pool (e.g not switched on yet). Those pods
+    are registered in the cluster but should not be accounted for as members.
+    """
+
+    return isinstance(hints, dict) and hints.get('application', '').endswith(WARM) and hints.get('process') == 'stopped'
+
+
+def fire(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, callback=None, kids=None,
+         pods=None, warm=False):
 
     class _Post(Thread):
         """
-        We optimize a bit the HTTP queries to the pods by running them on separate threads (this can be a
-        tad slow otherwise for more than 10 queries in a row)
+        We optimize a bit the HTTP queries to the pods by running them on a fixed pool of worker threads (this can be
+        a tad slow otherwise for more than 10 queries in a row). Each worker pulls pods from the queue until it is
+        empty.
         """
 
-        def __init__(self, key, hints):
+        def __init__(self, queue):
             super(_Post, self).__init__()
 
-            self.key = key
-            self.hints = hints
-            self.body = None
-            self.code = None
+            self.out = []
+            self.queue = queue
 
             self.start()
 
         def run(self):
 
+            while True:
+                try:
+                    key, hints = self.queue.get_nowait()
+
+                except Empty:
+                    return
+
+                body, code = self._post(key, hints)
+                self.out += [(key, hints['seq'], body, code)]
+
+        def _post(self, key, hints):
+
             url = 'N/A'
             try:
                 ts = time.time()
-                port = self.hints['port']
-                assert port in self.hints['ports'], 'ochopod control port not exposed @ %s (user error ?)' % self.key
-                url = 'http://%s:%d/%s' % (self.hints['ip'], self.hints['ports'][port], command)
-                reply = requests.post(url, timeout=timeout, data=js, headers=headers, files=files)
-                self.body = reply.json()
-                self.code = reply.status_code
+                port = hints['port']
+                assert port in hints['ports'], 'ochopod control port not exposed @ %s (user error ?)' % key
+                url = 'http://%s:%d/%s' % (hints['ip'], hints['ports'][port], command)
+                with _slots:
+                    reply = requests.post(url, timeout=timeout, data=js, headers=headers, files=files)
+                body = reply.json()
+                code = reply.status_code
                 ms = 1000 * (time.time() - ts)
-                logger.debug('-> %s (HTTP %d, %s ms)' % (url, reply.status_code, int(ms)))
+                logger.debug('-> %s (HTTP %d, %s ms)' % (url, code, int(ms)))
+
+                #
+                # - skip the idle pods from the warm pools unless asked not to (only scale cares about them)
+                #
+                if not warm and idle(body):
+                    return None, None
+
+                #
+                # - if we have a callback pass it the reply as soon as it arrives
+                # - drop the body afterwards (streaming tools do not want to buffer anything)
+                #
+                if callback is not None:
+                    callback(key, hints['seq'], body, code)
+                    body = None
+
+                return body, code
 
             except HTTPTimeout:
                 logger.debug('-> %s (timeout)' % url)
@@ -110,54 +309,231 @@ def fire(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None,
             except Exception as failure:
                 logger.debug('-> %s (i/o error, %s)' % (url, failure))
 
-        def join(self, timeout=None):
-
-            Thread.join(self)
-            return self.key, self.hints['seq'], self.body, self.code
+            return None, None
 
     #
-    # - lookup our pods based on the cluster(s) we want
-    # - fire a thread for each
+    # - lookup our pods based on the cluster(s) we want (unless the caller already did)
+    # - queue them up and start at most FANOUT workers
     #
-    pods = lookup(zk, cluster, subset=subset)
-    threads = [_Post(pod, hints) for pod, hints in pods.items()]
-    out = [thread.join() for thread in threads]
+    if pods is None:
+        pods = lookup(zk, cluster, subset=subset, kids=kids)
+
+    queue = Queue()
+    for pod, hints in pods.items():
+        queue.put((pod, hints))
+
+    threads = [_Post(queue) for _ in range(min(FANOUT, len(pods)))]
+    for thread in threads:
+        thread.join()
+
+    out = sum((thread.out for thread in threads), [])
     return {key: (seq, body, code) for (key, seq, body, code) in out if code}
 
 
+class Watch():
+    """
+    Child watch on the pods znode of a given cluster, used to wait for new pods to register instead of polling the
+    whole cluster. The watch is (re-)armed on the zookeeper proxy actor each time it is checked. The pods registered
+    when the watch is created are ignored.
+    """
+
+    def __init__(self, proxy, cluster):
+
+        self.changed = Event()
+        self.path = '%s/%s/pods' % (ROOT, cluster)
+        self.proxy = proxy
+        self.seen = run(proxy, self._arm)
+
+    def _trigger(self, _):
+        self.changed.set()
+
+    def _arm(self, zk):
+
+        #
+        # - always pass the same (bound) watcher, kazoo keeps one copy per path (no pile-up when re-arming)
+        # - the znode will not exist until the first pod registers
+        # - if so watch for its creation instead
+        #
+        try:
+            return set(zk.get_children(self.path, watch=self._trigger))
+
+        except NoNodeError:
+            zk.exists(self.path, watch=self._trigger)
+            return set()
+
+    def fresh(self, timeout):
+        """
+        Blocks until the pods znode changes (or the timeout expires) and returns the set of pod znodes which appeared
+        since the last call.
+        """
+
+        self.changed.wait(timeout)
+        self.changed.clear()
+        kids = run(self.proxy, self._arm)
+        fresh = kids - self.seen
+        self.seen |= kids
+        return fresh
+
+
+def _merge(outs):
+
+    #
+    # - recursively merge what each ensemble returned (the closures are the same so the shapes match)
+    # - tuples are merged element-wise, dicts are updated (keys are site prefixed), lists concatenated and
+    #   numbers summed up
+    #
+    first = outs[0]
+    if isinstance(first, tuple):
+        return tuple(_merge(list(blk)) for blk in zip(*outs))
+    elif isinstance(first, dict):
+        merged = {}
+        for out in outs:
+            merged.update(out)
+        return merged
+    elif isinstance(first, list):
+        return sum(outs, [])
+    elif isinstance(first, (int, long, float)) and not isinstance(first, bool):
+        return sum(outs)
+
+    return first
+
+
 def run(proxy, func, timeout=None):
     """
     Helper asking the zookeeper proxy actor to run the specified closure and blocking until either the timeout is
-    reached or a response is received.
+    reached or a response is received. If a dict of proxies (one per site) is specified the closure is run against
+    each ensemble in parallel and the outputs merged together.
     """
 
     try:
-        latch = pykka.ThreadingFuture()
-        proxy.tell(
-            {
-                'request': 'execute',
-                'latch': latch,
-                'function': func
-            })
-        Event()
-        out = latch.get(timeout=timeout)
-        if isinstance(out, Exception):
-            raise out
+        sites = proxy if isinstance(proxy, dict) else {None: proxy}
+        msgs = {}
+        for site, actor in sites.items():
+            msgs[site] = \
+                {
+                    'request': 'execute',
+                    'latch': pykka.ThreadingFuture(),
+                    'function': func
+                }
+
+            actor.tell(msgs[site])
+
+        #
+        # - all the actors are now busy running the closure
+        # - we therefore only wait as long as the slowest one takes
+        #
+        outs = []
+        ts = time.time()
+        for site, msg in sorted(msgs.items()):
+            try:
+                left = None if timeout is None else max(0, timeout - (time.time() - ts))
+                out = msg['latch'].get(timeout=left)
+
+            except Timeout as failure:
+                out = failure
+
+            if isinstance(out, Exception):
+                if len(sites) == 1:
+                    raise out
+
+                logger.debug('%s : lookup failed, skipping (%s)' % (site, diagnostic(out)))
+                continue
+
+            #
+            # - the actor will tag the message with the snapshot age if it could not use the live ensemble
+            #
+            if 'age' in msg:
+                degraded['age'] = max(degraded['age'], msg['age'])
+
+            outs += [out]
+
+        assert outs, 'no ensemble replied'
+        if answered['ts'] is None:
+            answered['ts'] = time.time()
 
-        return out
+        return outs[0] if len(outs) == 1 else _merge(outs)
 
     except Timeout:
 
         assert 0, 'request timeout'
 
 
+def drain(proxy, cluster, subset=None, timeout=60.0, command='control/kill', codes=(410,)):
+    """
+    Fires a command (control/kill by default) at the pods until each of them replies with one of the expected codes
+    (HTTP 410 by default, e.g the pod is now idling). Each pod keeps its own retry state : only the pods which did not
+    acknowledge yet are re-fired at, with a jittered exponential backoff, until the deadline. Pods which disappear
+    from zookeeper meanwhile are considered gone. The sorted sequence indices of the pods which acknowledged and of
+    those which did not are returned.
+    """
+
+    ts = time.time()
+    done = []
+    state = None
+    while True:
+
+        #
+        # - fire at whatever pods are due (all of them on the first pass)
+        # - the per-request timeout is clipped by what is left (/control/kill blocks until the pod is dead)
+        #
+        now = time.time()
+        left = timeout - (now - ts)
+        first = state is None
+        if first:
+            due = subset
+        else:
+            due = [blk['seq'] for blk in state.values() if blk['next'] <= now]
+            if not due:
+                due = [min(state.values(), key=lambda blk: blk['next'])['seq']]
+
+        def _query(zk):
+            registered = lookup(zk, cluster, subset=due)
+            replies = fire(zk, cluster, command, subset=due, timeout=max(left, 1.0))
+            return {key: hints['seq'] for key, hints in registered.items()}, \
+                   {key: code for key, (_, _, code) in replies.items()}
+
+        registered, replies = run(proxy, _query)
+        if first:
+            state = {key: {'seq': seq, 'attempts': 0, 'next': 0} for key, seq in registered.items()}
+
+        for key in [key for key, blk in state.items() if first or blk['seq'] in due]:
+            blk = state[key]
+            if key not in registered or replies.get(key) in codes:
+                done += [blk['seq']]
+                del state[key]
+            else:
+                blk['attempts'] += 1
+                backoff = min(CEILING, BACKOFF * (2 ** (blk['attempts'] - 1)))
+                blk['next'] = time.time() + backoff * random.uniform(0.5, 1.5)
+
+        #
+        # - we're done once every pod acknowledged (or upon reaching the deadline)
+        # - otherwise sleep until the next pod is due
+        #
+        left = timeout - (time.time() - ts)
+        if not state or left <= 0:
+            break
+
+        logger.debug('%s : %d pods acknowledged, %d pending' % (cluster, len(done), len(state)))
+        time.sleep(max(0, min(left, min(blk['next'] for blk in state.values()) - time.time())))
+
+    return sorted(done), sorted(blk['seq'] for blk in state.values())
+
+
 class ZK(FSM):
     """
     Small actor maintaining a read-only zookeeper client and able to run closures (to run arbitrary lookup
     queries). This is used by all our tools to retrieve information about the pods.
+
+    If stale is set the closures will be run against the last known registry snapshot whenever the session is
+    not connected (for instance during a leader election) instead of blocking. If site is set the pod keys returned
+    by lookup() will be prefixed by it (this is used when federating several ensembles).
     """
 
-    def __init__(self, brokers, data={}):
+    #: Time in seconds we allow a fresh session to connect before falling back on the snapshot.
+    grace = 2.0
+
+    def __init__(self, brokers, data={}, stale=False, site=None):
         super(ZK, self).__init__()
 
         self.connected = 0
@@ -165,6 +541,11 @@ class ZK(FSM):
         self.data = data
         self.pending = deque()
         self.path = 'zookeeper proxy'
+        self.since = time.time()
+        self.site = site
+        self.snapshot = None
+        self.stale = stale
+        self.state = None
 
     def feedback(self, state):
 
@@ -199,7 +580,14 @@ class ZK(FSM):
         cnx_string = ','.join(self.brokers)
         data.zk = KazooClient(hosts=cnx_string, timeout=30.0, read_only=1, randomize_hosts=1)
         data.zk.add_listener(self.feedback)
-        data.zk.start()
+        data.zk.site = self.site
+        data.zk.persist = self.stale
+
+        #
+        # - connect asynchronously so that we can keep on serving from the snapshot in the meantime
+        #
+        self.since = time.time()
+        data.zk.start_async()
 
         return 'wait_for_cnx', data, 0
 
@@ -209,8 +597,29 @@ class ZK(FSM):
             raise Aborted('terminating')
 
         if not self.connected:
-            return 'wait_for_cnx', data, 1.0
 
+            #
+            # - the session is either suspended, lost or still not up after our grace period
+            # - if allowed run whatever is pending against the last known registry state
+            # - the snapshot is loaded once (and kept until we reconnect)
+            # - if there is none fail the pending requests (an empty registry would look like an empty cluster)
+            #
+            lapse = time.time() - self.since
+            if self.stale and (self.state in [KazooState.SUSPENDED, KazooState.LOST] or lapse > self.grace):
+                if self.snapshot is None:
+                    self.snapshot = Snapshot(self.site)
+
+                if self.snapshot.available:
+                    self._drain(self.snapshot, tag=1)
+
+                else:
+                    while len(self.pending) > 0:
+                        msg = self.pending.popleft()
+                        msg['latch'].set(AssertionError('zookeeper unreachable and no registry snapshot available'))
+
+            return 'wait_for_cnx', data, 0.25
+
+        self.snapshot = None
         return 'spin', data, 0
 
     def spin(self, data):
@@ -218,6 +627,19 @@ class ZK(FSM):
         if self.terminate:
             raise Aborted('terminating')
 
+        if not self.connected:
+
+            #
+            # - we lost our session, go back to waiting (and maybe serve from the snapshot)
+            #
+            self.since = time.time()
+            return 'wait_for_cnx', data, 0
+
+        self._drain(data.zk)
+        return 'spin', data, 0.25
+
+    def _drain(self, zk, tag=0):
+
         while len(self.pending) > 0:
 
             out = None
@@ -228,7 +650,7 @@ class ZK(FSM):
                 # - run the specified closure
                 # - assign the latch to whatever is returned
                 #
-                out = msg['function'](data.zk)
+                out = msg['function'](zk)
 
             except Exception as failure:
 
@@ -238,9 +660,11 @@ class ZK(FSM):
                 #
                 out = failure
 
-            msg['latch'].set(out)
+            if tag:
+                msg['age'] = zk.age
+                zk.oldest = None
 
-        return 'spin', data, 0.25
+            msg['latch'].set(out)
 
     def specialized(self, msg):
 
@@ -253,6 +677,7 @@ class ZK(FSM):
             # - when ok is off the scheduling will be interrupted
             #
             state = msg['state']
+            self.state = state
             self.connected = state == KazooState.CONNECTED
 
         elif req == 'execute':
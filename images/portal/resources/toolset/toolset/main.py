@@ -15,18 +15,94 @@
 # limitations under the License.
 #
 import imp
+import json
 import logging
+import os
 import sys
 
 from argparse import ArgumentParser
 from os import listdir
-from os.path import dirname, isfile, join
+from os.path import dirname, getmtime, isfile, join
 from ochopod.core.fsm import diagnostic
-from toolset.tool import Template
+from tempfile import gettempdir, mkstemp
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Cached tag -> command module manifest (rebuilt whenever a module under /commands is added, removed or modified).
+MANIFEST = os.environ['TOOLSET_MANIFEST'] if 'TOOLSET_MANIFEST' in os.environ else '%s/toolset-manifest.json' % gettempdir()
+
+
+def _load(where, script):
+
+    #
+    # - import the module and instantiate the tool
+    # - each .py module must have a go() callable returning a Template
+    #
+    from toolset.tool import Template
+    module = imp.load_source(script[:-3], join(where, script))
+    assert hasattr(module, 'go') and callable(module.go), 'no go() callable (invalid tool code ?)'
+    tool = module.go()
+    assert isinstance(tool, Template), 'wrong sub-class (invalid tool code ?)'
+    assert tool.tag, 'tag left undefined (invalid tool code ?)'
+    return tool
+
+
+def manifest(where):
+    """
+    Returns the tag -> script mapping for all the tools found under the specified directory. This manifest is cached
+    on disk and only rebuilt (e.g by importing each and every tool) when the modules modification times change.
+    """
+
+    try:
+        scripts = {f: getmtime(join(where, f)) for f in listdir(where) if isfile(join(where, f)) and f.endswith('.py')}
+
+    except OSError:
+        return {}
+
+    try:
+        with open(MANIFEST, 'r') as f:
+            js = json.loads(f.read())
+            if js['where'] == where and js['scripts'] == scripts:
+                return js['tools']
+
+    except (IOError, ValueError, KeyError):
+        pass
+
+    tools = {}
+    for script in sorted(scripts.keys()):
+        try:
+            tool = _load(where, script)
+            tools[tool.tag] = script
+
+        except Exception as failure:
+
+            logger.warning('failed to import %s (%s)' % (script, diagnostic(failure)))
+
+    try:
+
+        #
+        # - write to a temporary file first and rename (other toolset processes may be reading it)
+        #
+        js = \
+            {
+                'where': where,
+                'scripts': scripts,
+                'tools': tools
+            }
+
+        fd, tmp = mkstemp(dir=dirname(MANIFEST))
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(js))
+
+        os.rename(tmp, MANIFEST)
+
+    except (IOError, OSError) as failure:
+
+        logger.debug('unable to persist the command manifest (%s)' % failure)
+
+    return tools
+
 
 def go():
     """
@@ -42,33 +118,14 @@ def go():
 
     try:
 
-        def _import(where, funcs):
-            try:
-                for script in [f for f in listdir(where) if isfile(join(where, f)) and f.endswith('.py')]:
-                    try:
-                        module = imp.load_source(script[:-3], join(where, script))
-                        if hasattr(module, 'go') and callable(module.go):
-                            tool = module.go()
-                            assert isinstance(tool, Template), 'wrong sub-class (invalid tool code ?)'
-                            assert tool.tag, 'tag left undefined (invalid tool code ?)'
-                            funcs[tool.tag] = tool
-
-                    except Exception as failure:
-
-                        logger.warning('failed to import %s (%s)' % (script, diagnostic(failure)))
-
-            except OSError:
-                pass
-
         #
         # - disable .pyc generation
-        # - scan for tools to import
-        # - each .py module must have a go() callable as well as a COMMAND attribute
-        # - the COMMAND attribute tells us what the command-line invocation looks like
+        # - retrieve the tag -> module manifest (this will only import the tools if something changed)
+        # - the tag tells us what the command-line invocation looks like
         #
-        tools = {}
         sys.dont_write_bytecode = True
-        _import('%s/commands' % dirname(__file__), tools)
+        where = '%s/commands' % dirname(__file__)
+        tools = manifest(where)
 
         def _usage():
             return 'available commands -> %s' % ', '.join(sorted(tools.keys()))
@@ -96,14 +153,14 @@ def go():
         else:
 
             #
-            # - simply invoke the tool
+            # - only import the module we need and invoke the tool
             # - remove the command tokens first and pass the rest as arguments
             # - each tool will parse its own commandline
             # - if the tool does not define an exit code default to 0 (success)
             #
             picked = matched[0]
             tokens = len(picked.split(' ')) - 1
-            code = tools[picked].run(args.extra[tokens:])
+            code = _load(where, tools[picked]).run(args.extra[tokens:])
             exit(0 if code is None else code)
 
     except AssertionError as failure:
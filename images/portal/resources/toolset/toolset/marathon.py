@@ -0,0 +1,404 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import os
+import random
+import requests
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException
+from collections import deque
+from threading import Condition, Event, Lock
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Timeout in seconds for each individual HTTP request to marathon (overridable via $MARATHON_TIMEOUT).
+TIMEOUT = float(os.environ.get('MARATHON_TIMEOUT', 10))
+
+#: Maximum number of attempts per call (conflicts, 5xx and i/o errors are retried).
+ATTEMPTS = 4
+
+#: Verbs which are not idempotent (only retried when the request was never sent, upon a deployment conflict or 503).
+UNSAFE = ['POST', 'DELETE']
+
+#: Base backoff in seconds between attempts (doubled on each attempt and jittered).
+BACKOFF = 0.25
+
+#: Sustained # of requests per second we allow against marathon (overridable via $MARATHON_RATE).
+RATE = float(os.environ.get('MARATHON_RATE', 20))
+
+#: Maximum burst of requests allowed above the sustained rate.
+BURST = 10
+
+#: Maximum # of mutations (POST/PUT/DELETE) in flight at once (overridable via $MARATHON_MUTATIONS).
+MUTATIONS = int(os.environ.get('MARATHON_MUTATIONS', 4))
+
+#: Age in seconds past which the ranking published by the portal is ignored.
+STALE = 300.0
+
+
+class _Bucket():
+    """
+    Token bucket shared by all the threads, blocking until a token is available.
+    """
+
+    def __init__(self, rate, burst):
+
+        self.burst = burst
+        self.lock = Lock()
+        self.rate = rate
+        self.tokens = float(burst)
+        self.ts = time.time()
+
+    def take(self):
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+
+                lapse = (1.0 - self.tokens) / self.rate
+
+            time.sleep(lapse)
+
+
+class _Fifo():
+    """
+    Counting semaphore granting its slots in arrival order (a regular semaphore makes no fairness guarantee, which
+    would let a busy automation starve the others).
+    """
+
+    def __init__(self, slots):
+
+        self.cond = Condition(Lock())
+        self.queue = deque()
+        self.slots = max(1, slots)
+
+    def acquire(self):
+
+        ticket = object()
+        with self.cond:
+            self.queue.append(ticket)
+            while self.queue[0] is not ticket or not self.slots:
+                self.cond.wait()
+
+            self.queue.popleft()
+            self.slots -= 1
+            self.cond.notify_all()
+
+    def release(self):
+
+        with self.cond:
+            self.slots += 1
+            self.cond.notify_all()
+
+
+class Marathon():
+    """
+    Thread-safe marathon API client shared by all the automations within a toolset process. It pools keep-alive
+    connections, routes calls to the current leader first, fails over across the other masters (ranked by health &
+    latency) and retries with jittered exponential backoff on deployment conflicts (HTTP 409) and 5xx responses. The
+    latency of each call is tracked as well. POST and DELETE calls are only retried upon connection errors, deployment
+    conflicts and HTTP 503 (e.g when we know for sure marathon did not process them).
+
+    Traffic is throttled by a token bucket, mutations are granted in arrival order (at most MUTATIONS at once) and
+    identical GETs in flight are coalesced (the first caller runs the request, the others share its reply).
+    """
+
+    def __init__(self, masters, timeout=TIMEOUT, attempts=ATTEMPTS, leader=None, latency=None):
+
+        self.attempts = max(1, attempts)
+        self.bucket = _Bucket(RATE, BURST)
+        self.failures = {master: 0 for master in masters}
+        self.fifo = _Fifo(MUTATIONS)
+        self.inflight = {}
+        self.latency = {master: latency.get(master, 0.0) if latency else 0.0 for master in masters}
+        self.leader = leader
+        self.lock = Lock()
+        self.masters = masters
+        self.metrics = {}
+        self.timeout = timeout
+
+        #
+        # - one session shared across threads (e.g keep-alive connection pooling)
+        #
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=len(masters) + 1, pool_maxsize=32))
+        self.session.headers.update(
+            {
+                'content-type': 'application/json',
+                'accept': 'application/json'
+            })
+
+        #
+        # - no need to elect if the leader is already known (e.g from the portal ranking)
+        #
+        if leader is None:
+            self._elect()
+
+    def _elect(self):
+
+        #
+        # - ask any master who the leader is (GET /v2/leader)
+        # - this is used to avoid the extra proxying hop when hitting a non-leader
+        #
+        for master in random.sample(self.masters, len(self.masters)):
+            try:
+                reply = self.session.get('http://%s/v2/leader' % master, timeout=self.timeout)
+                if reply.status_code == 200:
+                    leader = reply.json()['leader']
+                    with self.lock:
+                        self.leader = leader
+                        self.failures.setdefault(leader, 0)
+                        self.latency.setdefault(leader, 0.0)
+
+                    logger.debug('marathon leader -> %s' % leader)
+                    return
+
+            except (RequestException, ValueError, KeyError):
+                pass
+
+    def _ranked(self):
+
+        #
+        # - the leader goes first unless it failed recently
+        # - then order by # of consecutive failures and average latency
+        #
+        with self.lock:
+            def _score(master):
+                return 0 if master == self.leader else 1, self.failures[master], self.latency[master]
+
+            return sorted(self.failures.keys(), key=_score)
+
+    def _account(self, master, verb, path, ms, failed):
+
+        with self.lock:
+            self.failures[master] = self.failures[master] + 1 if failed else 0
+            self.latency[master] = ms if not self.latency[master] else 0.8 * self.latency[master] + 0.2 * ms
+            stats = self.metrics.setdefault('%s %s' % (verb, path.split('?')[0]), {'calls': 0, 'ms': 0.0, 'max': 0.0})
+            stats['calls'] += 1
+            stats['ms'] += ms
+            stats['max'] = max(stats['max'], ms)
+
+            #
+            # - if the leader failed force a new election on the next call
+            #
+            if failed and master == self.leader:
+                self.leader = None
+
+    def best(self):
+        """
+        Returns the master we would currently pick (e.g the leader unless it is failing).
+        """
+
+        if self.leader is None:
+            self._elect()
+
+        return self._ranked()[0]
+
+    def call(self, verb, path, js=None):
+        """
+        Runs the specified marathon API call and returns the reply (or raises the last i/o error if every attempt
+        failed). The body, if any, is serialized to json.
+        """
+
+        if self.leader is None:
+            self._elect()
+
+        reply = None
+        error = None
+        unsafe = verb in UNSAFE
+        data = json.dumps(js) if js is not None else None
+        for attempt in range(self.attempts):
+
+            #
+            # - pick the best master for each attempt (failover)
+            # - back off with jitter before retrying
+            #
+            if attempt:
+                time.sleep(BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+            ranked = self._ranked()
+            master = ranked[0]
+            url = 'http://%s%s' % (master, path)
+
+            #
+            # - wait for a token (rate limiting)
+            # - mutations also wait for their turn (fifo)
+            #
+            mutation = verb != 'GET'
+            self.bucket.take()
+            if mutation:
+                self.fifo.acquire()
+
+            ts = time.time()
+            try:
+                reply = self.session.request(verb, url, data=data, timeout=self.timeout)
+                code = reply.status_code
+                ms = 1000 * (time.time() - ts)
+                self._account(master, verb, path, ms, code >= 500)
+                logger.debug('-> %s %s (HTTP %d, %d ms)' % (verb, url, code, int(ms)))
+
+                #
+                # - 5xx : the master is in trouble, fail over (503 only for POST/DELETE, anything else may have
+                #   been processed)
+                # - 409 : the application is locked by a deployment, wait and retry
+                # - anything else is returned as is
+                #
+                if code == 409 and 'deployment' in reply.text:
+                    continue
+
+                if code < 500 or (unsafe and code != 503):
+                    return reply
+
+            except RequestException as failure:
+
+                ms = 1000 * (time.time() - ts)
+                self._account(master, verb, path, ms, True)
+                logger.debug('-> %s %s (i/o error, %s)' % (verb, url, failure))
+                error = failure
+
+                #
+                # - a POST/DELETE that timed out (or dropped mid-way) may have gone through, do not replay it
+                #
+                if unsafe and not isinstance(failure, ConnectionError):
+                    raise
+
+            finally:
+                if mutation:
+                    self.fifo.release()
+
+        if reply is None:
+            raise error
+
+        return reply
+
+    def get(self, path):
+
+        #
+        # - coalesce identical GETs in flight
+        # - the first caller runs the request while the others block and share its outcome
+        #
+        with self.lock:
+            first = path not in self.inflight
+            if first:
+                self.inflight[path] = {'done': Event()}
+
+            pending = self.inflight[path]
+
+        if not first:
+            pending['done'].wait()
+            logger.debug('-> GET %s (coalesced)' % path)
+            if 'error' in pending:
+                raise pending['error']
+
+            return pending['reply']
+
+        try:
+            pending['reply'] = self.call('GET', path)
+            return pending['reply']
+
+        except Exception as failure:
+
+            pending['error'] = failure
+            raise
+
+        finally:
+            with self.lock:
+                del self.inflight[path]
+
+            pending['done'].set()
+
+    def post(self, path, js=None):
+        return self.call('POST', path, js)
+
+    def put(self, path, js=None):
+        return self.call('PUT', path, js)
+
+    def delete(self, path):
+        return self.call('DELETE', path)
+
+    def report(self):
+
+        #
+        # - dump the per-call latencies (debug only)
+        #
+        with self.lock:
+            for call, stats in sorted(self.metrics.items()):
+                avg = stats['ms'] / stats['calls']
+                logger.debug('%s : %d calls, %d ms avg, %d ms max' % (call, stats['calls'], int(avg), int(stats['max'])))
+
+
+#: Our shared client (lazily created).
+_client = {}
+
+#: Lock guarding the client creation.
+_lock = Lock()
+
+
+def _ranking():
+
+    #
+    # - the portal pod probes the masters in the background and publishes them ranked (leader first)
+    # - ignore the file if missing, corrupted or stale
+    #
+    try:
+        with open(os.environ['MARATHON_RANKING'], 'r') as f:
+            js = json.loads(f.read())
+
+        if js['masters'] and time.time() - js['ts'] < STALE:
+            return js
+
+    except (IOError, KeyError, ValueError):
+        pass
+
+    return None
+
+
+def client():
+    """
+    Returns the marathon client shared by all the automations, creating it on the first call. The masters (and the
+    current leader) are read from the ranking file published by the portal ($MARATHON_RANKING) or, if unavailable,
+    from $MARATHON_MASTER.
+    """
+
+    with _lock:
+        if 'client' not in _client:
+            js = _ranking()
+            if js:
+                _client['client'] = Marathon(js['masters'], leader=js['leader'], latency=js['latency'])
+            else:
+                assert 'MARATHON_MASTER' in os.environ, '$MARATHON_MASTER not specified (check your portal pod)'
+                _client['client'] = Marathon(os.environ['MARATHON_MASTER'].split(','))
+
+        return _client['client']
+
+
+def report():
+    """
+    Logs the latency metrics for all the calls made so far (if the client was ever used).
+    """
+
+    if 'client' in _client:
+        _client['client'].report()
@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import time
+
+from toolset.io import fire, run
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Supported victim selection strategies (load can be suffixed by the metric to use, e.g load:requests.rate).
+STRATEGIES = ['lifo', 'fifo', 'load', 'crowded', 'slow']
+
+
+def _metric(hints, path):
+
+    value = hints['metrics'] if 'metrics' in hints else None
+    for token in path.split('.'):
+        if not isinstance(value, dict) or token not in value:
+            return None
+        value = value[token]
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def victims(proxy, cluster, indices, count, strategy='lifo'):
+    """
+    Returns the sequence indices of the <count> pods (amongst the specified indices or the whole cluster if None) to
+    phase out first, using one of the following strategies:
+
+     - lifo/fifo : the most recent (or oldest) pods first
+     - load[:<metric>] : the least loaded pods first, based on the specified sanity-check metric (load by default),
+       pods not reporting it going last
+     - crowded : the pods sitting on the most crowded nodes first (the remaining pods end up spread more evenly)
+     - slow : the pods slowest to answer /info first
+    """
+
+    strategy, _, path = strategy.partition(':')
+    assert strategy in STRATEGIES, 'invalid strategy "%s" (must be one of %s)' % (strategy, ', '.join(STRATEGIES))
+    if count <= 0:
+        return []
+
+    #
+    # - query the whole cluster (we need all the pods to figure out how crowded each node is)
+    # - time each /info reply as it arrives
+    #
+    ts = time.time()
+    pods = {}
+
+    def _reply(key, seq, hints, code):
+        if code == 200:
+            pods[seq] = \
+                {
+                    'hints': hints,
+                    'ms': 1000 * (time.time() - ts)
+                }
+
+    run(proxy, lambda zk: fire(zk, cluster, 'info', callback=_reply))
+    candidates = [seq for seq in sorted(pods.keys()) if indices is None or seq in indices]
+    if strategy == 'fifo':
+        ranked = candidates
+
+    elif strategy == 'lifo':
+        ranked = candidates[::-1]
+
+    elif strategy == 'load':
+        def _load(seq):
+            value = _metric(pods[seq]['hints'], path if path else 'load')
+            return (1, 0) if value is None else (0, value)
+
+        ranked = sorted(candidates[::-1], key=_load)
+
+    elif strategy == 'slow':
+        ranked = sorted(candidates, key=lambda seq: -pods[seq]['ms'])
+
+    else:
+
+        #
+        # - pick one pod at a time from the node hosting the most pods (newest first in case of a tie)
+        # - update the node count as we go
+        #
+        ranked = []
+        nodes = {}
+        for seq, blk in pods.items():
+            node = blk['hints'].get('node')
+            nodes[node] = nodes.get(node, 0) + 1
+
+        left = candidates[::-1]
+        while left and len(ranked) < count:
+            seq = max(left, key=lambda seq: nodes[pods[seq]['hints'].get('node')])
+            nodes[pods[seq]['hints'].get('node')] -= 1
+            left.remove(seq)
+            ranked += [seq]
+
+    picked = ranked[:count]
+    logger.debug('%s : picked %s (%s)' % (cluster, ', '.join('#%d' % seq for seq in picked), strategy))
+    return picked
\ No newline at end of file
@@ -0,0 +1,161 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import datetime
+import logging
+import re
+import time
+import uuid
+
+from toolset.io import fire, run
+from toolset.marathon import client
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: CPU share allocated to each pre-pull task (kept minimal, the task only sleeps).
+CPUS = 0.01
+
+#: Memory in MB allocated to each pre-pull task.
+MEM = 16
+
+#: Pattern matching the task failure messages caused by the image pull itself (bad tag, registry auth, etc.).
+PULL = re.compile(r'pull|manifest|not found|unauthorized|denied|registry|no such image', re.IGNORECASE)
+
+
+def nodes(proxy, cluster):
+    """
+    Returns the nodes currently running the pods of the specified cluster(s).
+    """
+
+    def _query(zk):
+        replies = fire(zk, cluster, 'info')
+        return [hints['node'] for _, hints, _ in replies.values()]
+
+    return sorted(set(run(proxy, _query)))
+
+
+def prefetch(image, nodes, timeout, checkpoint=None):
+    """
+    Pre-pulls the specified docker image on a set of nodes (typically the ones currently running the pods we are about
+    to replace). One short-lived marathon application pinned to each node (hostname constraint) is submitted as one
+    group and we block until each has either a running task or a failure. The group is deleted afterwards. Returns
+    the list of nodes the image was pulled on. An assertion is raised listing the nodes where the pull itself failed
+    (e.g bad tag or missing registry credentials) or did not complete within the timeout, in which case the rollout
+    should not proceed.
+    """
+
+    nodes = sorted(set(nodes))
+    if not nodes:
+        return []
+
+    marathon = client()
+    stamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H-%M-%S')
+    group = 'ochopod.prefetch-%s-%s' % (stamp, uuid.uuid4().hex[:6])
+    apps = {}
+    for n, node in enumerate(nodes):
+        apps['/%s/node-%d' % (group, n)] = \
+            {
+                'id': '/%s/node-%d' % (group, n),
+                'instances': 1,
+                'cpus': CPUS,
+                'mem': MEM,
+                'cmd': 'sleep %d' % max(int(timeout), 60),
+                'constraints': [['hostname', 'CLUSTER', node]],
+                'container':
+                    {
+                        'type': 'DOCKER',
+                        'docker':
+                            {
+                                'forcePullImage': True,
+                                'image': image,
+                                'network': 'BRIDGE'
+                            }
+                    }
+            }
+
+    try:
+
+        #
+        # - submit everything at once
+        #
+        if checkpoint:
+            checkpoint()
+
+        js = \
+            {
+                'id': '/%s' % group,
+                'apps': apps.values()
+            }
+
+        reply = marathon.post('/v2/groups', js)
+        code = reply.status_code
+        assert code == 200 or code == 201, 'prefetch submission failed (HTTP %d)' % code
+
+        #
+        # - wait for each application to either run its task or report a failure
+        # - a running task means the image got pulled on that node
+        # - a failure caused by the pull (as reported by mesos) means it did not, anything else happened after
+        #   the pull (e.g the container could not start)
+        #
+        ts = time.time()
+        done = {}
+        failed = {}
+        while len(done) + len(failed) < len(apps) and time.time() - ts < timeout:
+
+            if checkpoint:
+                checkpoint()
+
+            reply = marathon.get('/v2/apps?id=/%s&embed=apps.lastTaskFailure' % group)
+            if reply.status_code == 200:
+                for app in reply.json()['apps']:
+                    if app['id'] not in apps or app['id'] in done or app['id'] in failed:
+                        continue
+
+                    node = apps[app['id']]['constraints'][0][2]
+                    if app['tasksRunning']:
+                        done[app['id']] = node
+                    elif 'lastTaskFailure' in app:
+                        failure = app['lastTaskFailure']
+                        if PULL.search(failure.get('message', '')):
+                            failed[app['id']] = node
+                            logger.debug('%s : pull failed on %s (%s, %s)' % (image, node, failure.get('state'), failure.get('message')))
+                        else:
+                            done[app['id']] = node
+
+            if len(done) + len(failed) < len(apps):
+                time.sleep(1.0)
+
+        assert not failed, 'unable to pull %s on %s' % (image, ', '.join(sorted(failed.values())))
+        pending = sorted(blk['constraints'][0][2] for key, blk in apps.items() if key not in done)
+        assert not pending, 'timed out pulling %s on %s' % (image, ', '.join(pending))
+        pulled = sorted(done.values())
+        logger.debug('%s : pulled on %d/%d nodes' % (image, len(pulled), len(nodes)))
+        return pulled
+
+    finally:
+
+        #
+        # - always clean our group up
+        # - don't let a failure here hide whatever happened before
+        #
+        try:
+            reply = marathon.delete('/v2/groups/%s?force=true' % group)
+            if reply.status_code not in [200, 202, 204]:
+                logger.warning('unable to delete %s (HTTP %d)' % (group, reply.status_code))
+
+        except Exception as failure:
+            logger.warning('unable to delete %s (%s)' % (group, failure))
\ No newline at end of file
@@ -0,0 +1,229 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import datetime
+import hashlib
+import json
+import logging
+import time
+import yaml
+
+from ochopod.core.utils import merge
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Marathon label holding the spec fingerprint.
+FINGERPRINT = 'ochopod_fingerprint'
+
+
+def fingerprint(spec):
+    """
+    Returns the SHA1 digest of the canonical (sorted keys) json serialization of the specified marathon application,
+    minus what does not affect the pods (e.g its identifier, the # of instances and the fingerprint label itself).
+    """
+
+    js = {key: value for key, value in spec.items() if key not in ['id', 'instances']}
+    if 'labels' in js:
+        js['labels'] = {key: value for key, value in js['labels'].items() if key != FINGERPRINT}
+
+    return hashlib.sha1(json.dumps(js, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def render(template, overrides, namespace, pods, release=None, suffix=None, stamp=None):
+    """
+    Renders the marathon application specification for the specified YAML template (merged with our defaults, the
+    overrides and its optional verbatim block). The qualified cluster identifier, the marathon application identifier
+    and the specification are returned. The application identifier is timestamped (all the applications rendered with
+    the same stamp will therefore share the same suffix). The specification fingerprint is stored as a label.
+
+    Please note any invalid input will trigger an AssertionError (or YAMLError).
+    """
+
+    with open(template, 'r') as f:
+
+        #
+        # - parse the template yaml file (e.g container definition)
+        #
+        raw = yaml.load(f)
+        assert raw, 'empty YAML input (user error ?)'
+
+        #
+        # - merge with our defaults
+        # - we want at least the cluster & image settings
+        # - TCP 8080 is added by default to the port list
+        #
+        defaults = \
+            {
+                'start': True,
+                'debug': False,
+                'settings': {},
+                'ports': [8080],
+                'verbatim': {}
+            }
+
+        cfg = merge(defaults, raw)
+        assert 'cluster' in cfg, 'cluster identifier undefined (user error ?)'
+        assert 'image' in cfg, 'docker image undefined (user error ?)'
+
+        #
+        # - if a suffix is specified append it to the cluster identifier
+        #
+        if suffix:
+            cfg['cluster'] = '%s-%s' % (cfg['cluster'], suffix)
+
+        #
+        # - timestamp the application (we really want a new uniquely identified application)
+        # - lookup the optional overrides and merge with our pod settings if specified
+        # - this is what happens when the -o option is used
+        #
+        stamp = stamp if stamp else datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H-%M-%S')
+        qualified = '%s.%s' % (namespace, cfg['cluster'])
+        application = 'ochopod.%s-%s' % (qualified, stamp)
+        if qualified in overrides:
+
+            blk = overrides[qualified]
+            logger.debug('%s : overriding %d settings (%s)' % (template, len(blk), qualified))
+            cfg['settings'] = merge(cfg['settings'], blk)
+
+        def _nullcheck(cfg, prefix):
+
+            #
+            # - walk through the settings and flag any null value
+            #
+            missing = []
+            if cfg is not None:
+                for key, value in cfg.items():
+                    if value is None:
+                        missing += ['%s.%s' % ('.'.join(prefix), key)]
+                    elif isinstance(value, dict):
+                        missing += _nullcheck(value, prefix + [key])
+
+            return missing
+
+        missing = _nullcheck(cfg['settings'], ['pod'])
+        assert not missing, '%d setting(s) missing ->\n\t - %s' % (len(missing), '\n\t - '.join(missing))
+
+        #
+        # - setup our port list
+        # - the port binding is specified either by an integer (container port -> dynamic mesos port), by
+        #   two integers (container port -> host port) or by an integer followed by a * (container port ->
+        #   same port on the host)
+        # - on top of that, all those options allow to specify whether the protocol is TCP or UDP by adding
+        #   the desired protocol after the binding (e.g. '8080 tcp' or '8125 * udp'. TCP is the default if no
+        #   protocol is specified.
+        # - the marathon pods must by design map /etc/mesos
+        #
+        def _parse_port(token):
+            
+            #
+            # - tries to return an int if possible, a string otherwise
+            #
+            def get_token_no_protocol(token):
+                # - remove the protocol piece
+                t = token[:-4].strip()
+                try:
+                    return int(t)
+                except ValueError:
+                    return t
+            
+            if isinstance(token, str) and token.lower().endswith(' udp'):
+                protocol = 'udp'
+                token_no_protocol = get_token_no_protocol(token)
+                
+            elif isinstance(token, str) and token.lower().endswith(' tcp'):
+                protocol = 'tcp'
+                token_no_protocol = get_token_no_protocol(token)
+            else:
+                # - TCP is the default
+                protocol = 'tcp'
+                token_no_protocol = token    
+            
+            if isinstance(token_no_protocol, int):
+                return {'containerPort': token_no_protocol, 'protocol': protocol}
+            elif isinstance(token_no_protocol, str) and token_no_protocol.endswith(' *'):
+                port = int(token_no_protocol[:-2])
+                return {'containerPort': port, 'hostPort': port, 'protocol': protocol}
+            elif isinstance(token_no_protocol, str):
+                ports = token_no_protocol.split(' ')
+                assert len(ports) == 2, 'invalid port syntax (must be two integers separated by 1+ spaces optionally followed by the protocol (tcp or udp, defaults to tcp))'
+                return {'containerPort': int(ports[0]), 'hostPort': int(ports[1]), 'protocol': protocol}
+            else:
+                assert 0, 'invalid port syntax ("%s")' % token
+
+        #
+        # - craft the docker image specifier
+        # - if -r is used make sure to add (or override) the :<label> suffix
+        #
+        image = cfg['image']
+        tokens = image.split(':')
+        image = '%s:%s' % (tokens[0], release) if release else image
+
+        #
+        # - note the marathon-ec2 ochopod bindings will set the application hint automatically
+        #   via environment variable (e.g no need to specify it here)
+        # - make sure to mount /etc/mesos and /opt/mesosphere to account for various mesos installs
+        #
+        ports = [_parse_port(token) for token in cfg['ports']] if 'ports' in cfg else []
+        spec = \
+            {
+                'id': application,
+                'instances': pods,
+                'env':
+                    {
+                        'ochopod_cluster': cfg['cluster'],
+                        'ochopod_debug': str(cfg['debug']).lower(),
+                        'ochopod_start': str(cfg['start']).lower(),
+                        'ochopod_namespace': namespace,
+                        'pod': json.dumps(cfg['settings'])
+                    },
+                'container':
+                    {
+                        'type': 'DOCKER',
+                        'docker':
+                            {
+                                'forcePullImage': True,
+                                'image': image,
+                                'network': 'BRIDGE',
+                                'portMappings': ports
+                            },
+                        'volumes':
+                            [
+                                {
+                                    'containerPath': '/etc/mesos',
+                                    'hostPath': '/etc/mesos',
+                                    'mode': 'RO'
+                                },
+                                {
+                                    'containerPath': '/opt/mesosphere',
+                                    'hostPath': '/opt/mesosphere',
+                                    'mode': 'RO'
+                                }
+                            ]
+                    }
+            }
+
+        #
+        # - if we have a 'verbatim' block in our image definition yaml, merge it now
+        #
+        if 'verbatim' in cfg:
+            spec = merge(cfg['verbatim'], spec)
+
+        #
+        # - fingerprint the final specification
+        #
+        spec.setdefault('labels', {})[FINGERPRINT] = fingerprint(spec)
+        return qualified, application, spec
\ No newline at end of file
@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import time
+
+from threading import Lock
+from toolset.marathon import client
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Time in seconds after which the whole cache is re-loaded.
+TTL = 5.0
+
+
+class State():
+    """
+    In-memory cache of the marathon applications (with their tasks embedded) shared by all the automations within a
+    toolset process. Everything is loaded at once using a single GET /v2/apps?embed=apps.tasks and re-loaded once
+    stale. Applications modified by an automation are invalidated and re-fetched individually on the next lookup.
+
+    Please note the application identifiers are stripped from their leading / to match the pod hints.
+    """
+
+    def __init__(self, marathon, ttl=TTL):
+
+        self.apps = {}
+        self.dirty = set()
+        self.lock = Lock()
+        self.marathon = marathon
+        self.ts = 0
+        self.ttl = ttl
+
+    def _load(self):
+
+        reply = self.marathon.get('/v2/apps?embed=apps.tasks')
+        code = reply.status_code
+        assert code == 200, 'application listing failed (HTTP %d)' % code
+        self.apps = {js['id'].lstrip('/'): js for js in reply.json()['apps']}
+        self.dirty = set()
+        self.ts = time.time()
+        logger.debug('marathon state loaded (%d applications)' % len(self.apps))
+
+    def _refresh(self, app):
+
+        #
+        # - incremental refresh, only re-fetch this application
+        # - a 404 means it is gone
+        #
+        reply = self.marathon.get('/v2/apps/%s?embed=app.tasks' % app)
+        code = reply.status_code
+        assert code == 200 or code == 404, 'application lookup failed (HTTP %d)' % code
+        if code == 404:
+            self.apps.pop(app, None)
+        else:
+            self.apps[app] = reply.json()['app']
+
+        self.dirty.discard(app)
+
+    def app(self, app):
+        """
+        Returns the marathon definition for the specified application (including its tasks) or None if it does not
+        exist.
+        """
+
+        with self.lock:
+            if time.time() - self.ts > self.ttl:
+                self._load()
+            elif app in self.dirty:
+                self._refresh(app)
+
+            return self.apps.get(app)
+
+    def tasks(self, app):
+        """
+        Returns the list of marathon task identifiers for the specified application.
+        """
+
+        js = self.app(app)
+        return [task['id'] for task in js['tasks']] if js else []
+
+    def labelled(self, key, value):
+        """
+        Returns the identifiers of the applications whose label <key> is set to <value>.
+        """
+
+        with self.lock:
+            if time.time() - self.ts > self.ttl:
+                self._load()
+
+            for app in list(self.dirty):
+                self._refresh(app)
+
+            return [app for app, js in self.apps.items() if 'labels' in js and js['labels'].get(key) == value]
+
+    def invalidate(self, app):
+        """
+        Flags the specified application as modified, forcing it to be re-fetched on the next lookup.
+        """
+
+        with self.lock:
+            self.dirty.add(app)
+
+
+#: Our shared cache (lazily created).
+_state = {}
+
+#: Lock guarding the cache creation.
+_lock = Lock()
+
+
+def state():
+    """
+    Returns the marathon state cache shared by all the automations, creating it on the first call.
+    """
+
+    with _lock:
+        if 'state' not in _state:
+            _state['state'] = State(client())
+
+        return _state['state']
\ No newline at end of file
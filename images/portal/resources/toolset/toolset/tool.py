@@ -14,18 +14,173 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
 import os
+import sys
+import time
 
 from argparse import ArgumentParser
+from collections import deque
 from logging import DEBUG
 from ochopod.core.core import ROOT
 from ochopod.core.fsm import diagnostic, shutdown
-from toolset.io import ZK
+from Queue import Queue, Empty
+from threading import Event, Thread
+from toolset.io import answered, degraded, ZK
+from toolset.marathon import report
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Default maximum number of automations running at once.
+PARALLEL = 8
+
+#: Time at which the toolset was loaded (used by --profile).
+STARTED = time.time()
+
+
+def ensembles(cnx):
+    """
+    Parses the $OCHOPOD_ZK connection string, which is either a plain comma separated list of zookeeper nodes or
+    1+ named ensembles separated by semi-colons (e.g east=10.0.0.1:2181,10.0.0.2:2181;west=10.1.0.1:2181). The first
+    ensemble is the local one.
+    """
+
+    out = []
+    for blk in cnx.split(';'):
+        site, hosts = blk.split('=', 1) if '=' in blk else (None, blk)
+        out += [(site, [node for node in hosts.split(',')])]
+
+    return out
+
+
+class Automation(Thread):
+    """
+    Base class for the per-cluster (or per-YAML definition) workflows run by the mutating tools. Sub-classes implement
+    workflow() and store their outcome in self.out. The thread is not started upon creation : execute() will take care
+    of that while bounding how many automations run at once.
+    """
+
+    def __init__(self, key):
+        super(Automation, self).__init__()
+
+        self.cancelled = Event()
+        self.daemon = True
+        self.done = None
+        self.key = key
+        self.out = \
+            {
+                'ok': False
+            }
+
+    def checkpoint(self):
+        """
+        Aborts the workflow if it got cancelled (e.g the overall deadline is exceeded). This must be invoked before
+        any step altering the pods or marathon.
+        """
+
+        assert not self.cancelled.is_set(), 'cancelled (deadline exceeded)'
+
+    def run(self):
+        try:
+
+            self.workflow()
+
+        finally:
+
+            #
+            # - notify execute() that we are done
+            #
+            if self.done is not None:
+                self.done.put(self)
+
+    def inline(self, automation):
+        """
+        Runs another automation synchronously on our own thread (sharing our cancellation flag) and returns its
+        outcome. This is how a tool re-uses the workflow of another one in-process.
+        """
+
+        automation.cancelled = self.cancelled
+        automation.workflow()
+        return automation.out
+
+    def workflow(self):
+        """
+        Actual automation logic, which must be overridden by sub-classes. It runs on the automation's own thread,
+        must invoke checkpoint() before altering anything and stores its outcome in self.out (whose 'ok' flag is left
+        to False if anything throws).
+        """
+
+        assert 0, '%s must implement workflow()' % self.__class__.__name__
+
+    def join(self, timeout=None):
+
+        Thread.join(self, timeout)
+        return self.out
+
+
+def execute(automations, limit=PARALLEL, deadline=None, progress=None):
+    """
+    Runs the specified automations, at most limit at once, and returns their outcomes keyed by automation. The optional
+    progress callback is invoked with the key, outcome, number of completed automations and total every time one of
+    them completes. Whatever is still pending or running once the deadline (in seconds) is reached gets cancelled and
+    reported as failed.
+    """
+
+    def _progress(key, out, completed, total):
+        logger.debug('%s : %s (%d/%d completed)' % (key, 'ok' if out['ok'] else 'failed', completed, total))
+
+    done = Queue()
+    pending = deque(automations)
+    running = set()
+    outcome = {}
+    total = len(pending)
+    ts = time.time()
+    while pending or running:
+
+        #
+        # - start as many automations as we can
+        #
+        while pending and len(running) < max(1, limit):
+            automation = pending.popleft()
+            automation.done = done
+            automation.start()
+            running.add(automation)
+
+        #
+        # - wait for the next one to complete (or for the deadline if one was specified)
+        # - always specify a timeout to remain interruptible, polling in slices of at most 1 second
+        # - without a deadline we keep on waiting for as long as it takes
+        #
+        if deadline is not None and time.time() - ts >= deadline:
+            break
+
+        try:
+            left = 1.0 if deadline is None else min(1.0, deadline - (time.time() - ts))
+            automation = done.get(timeout=max(0.0, left))
+
+        except Empty:
+            continue
+
+        running.discard(automation)
+        outcome[automation.key] = automation.out
+        (progress or _progress)(automation.key, automation.out, len(outcome), total)
+
+    #
+    # - we ran past our deadline
+    # - flag whatever is left as cancelled (the running workflows will abort on their next checkpoint)
+    #
+    for automation in list(running) + list(pending):
+        automation.cancelled.set()
+        out = dict(automation.out)
+        out['ok'] = False
+        out['cancelled'] = True
+        outcome[automation.key] = out
+        (progress or _progress)(automation.key, out, len(outcome), total)
+
+    return outcome
+
 
 class Template():
     """
@@ -42,6 +197,13 @@ class Template():
     #: If true the parser will not allow for unknown arguments
     strict = True
 
+    #: If true the tool does not alter anything and may be served from the last known registry state when zookeeper
+    #: is degraded (an explicit staleness warning is then emitted).
+    readonly = False
+
+    #: Set when --ndjson is used, in which case the tool streams one json record per pod or cluster.
+    streaming = False
+
     def run(self, cmdline):
 
         class _Parser(ArgumentParser):
@@ -54,6 +216,8 @@ class Template():
         parser = _Parser(prog=self.tag, description=self.help)
         self.customize(parser)
         parser.add_argument('-d', '--debug', action='store_true', help='debug mode')
+        parser.add_argument('--ndjson', action='store_true', help='streaming json output (one record per line)')
+        parser.add_argument('--profile', action='store_true', help='reports the time to the first zookeeper query')
         if self.strict:
             args = parser.parse_args(cmdline)
         else:
@@ -62,17 +226,89 @@ class Template():
             for handler in logger.handlers:
                 handler.setLevel(DEBUG)
 
+        self.streaming = args.ndjson
+        self.totals = {}
+
         #
         # - the zookeeper nodes are passed down via $OCHOPOD_ZK from the portal process
+        # - read-only tools federate all the ensembles (one actor each, the pod keys being prefixed by site)
+        # - the other tools only operate against the local ensemble
         #
-        proxy = ZK.start([node for node in os.environ['OCHOPOD_ZK'].split(',')])
+        sites = ensembles(os.environ['OCHOPOD_ZK'])
+        if self.readonly and len(sites) > 1:
+            proxy = {site: ZK.start(brokers, stale=True, site=site) for site, brokers in sites}
+        else:
+            proxy = ZK.start(sites[0][1], stale=self.readonly)
+
         try:
 
-            return self.body(args, unknown, proxy)
+            code = self.body(args, unknown, proxy)
+            if self.streaming:
+
+                #
+                # - close the stream with our summary record (which includes the staleness if any)
+                #
+                self.totals['code'] = 0 if code is None else code
+                self.totals['stale'] = degraded['age']
+                logger.info(json.dumps({'summary': self.totals}))
+
+            elif degraded['age'] is not None:
+
+                #
+                # - flag the output as stale if we had to fall back on the registry snapshot
+                # - in json mode use stderr to keep stdout parseable
+                #
+                warning = 'warning, zookeeper is degraded (registry snapshot is %d seconds old)' % degraded['age']
+                if getattr(args, 'json', False):
+                    sys.stderr.write('%s\n' % warning)
+                else:
+                    logger.warning(warning)
+
+            return code
 
         finally:
 
-            shutdown(proxy)
+            report()
+            for actor in proxy.values() if isinstance(proxy, dict) else [proxy]:
+                shutdown(actor)
+
+            #
+            # - if --profile is on report when the first zookeeper query was answered and when we exited (both
+            #   relative to the toolset being loaded)
+            #
+            if args.profile:
+                now = time.time()
+                js = \
+                    {
+                        'zk': 1000.0 * (answered['ts'] - STARTED) if answered['ts'] else None,
+                        'total': 1000.0 * (now - STARTED)
+                    }
+
+                logger.info('profile -> %s' % json.dumps(js))
+
+    def emit(self, key, value):
+        """
+        Streams one record (e.g the outcome for one pod or one cluster) as a single json line. This is a no-op
+        unless --ndjson is used.
+        """
+
+        if self.streaming:
+            logger.info(json.dumps({'key': key, 'value': value}))
+
+    def progress(self, key, out, completed, total):
+        """
+        Progress callback for execute() streaming each automation outcome as soon as it completes.
+        """
+
+        self.emit(key, out)
+        logger.debug('%s : %s (%d/%d completed)' % (key, 'ok' if out['ok'] else 'failed', completed, total))
+
+    def summarize(self, **kwargs):
+        """
+        Adds the specified counters to the summary record closing the stream when --ndjson is used.
+        """
+
+        self.totals.update(kwargs)
 
     def customize(self, parser):
         pass